@@ -0,0 +1,112 @@
+"""
+请求构造基准测试
+对比每次请求重新解析抓取的请求体（旧逻辑）与使用预编译 RequestTemplate 的单次请求准备耗时，
+以及多模态请求重试时每次重新序列化整个请求体与复用已序列化 contents 的耗时
+
+用法:
+    python benchmarks/bench_request_template.py [credentials.json]
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from src.request_template import RequestTemplate, serialize_contents
+
+
+def load_harvest(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    harvest = data.get('harvest', data)
+    if not isinstance(harvest['body'], str):
+        harvest['body'] = json.dumps(harvest['body'])
+    return harvest
+
+
+def legacy_prepare(creds, contents, system_instruction, model):
+    """stream_chat 原有的每次请求准备逻辑（去掉日志输出）"""
+    original_body = json.loads(creds['body'])
+    new_variables = original_body.get('variables', {}).copy()
+    new_variables['contents'] = contents
+    if system_instruction:
+        new_variables['systemInstruction'] = {"parts": [{"text": system_instruction}]}
+    new_variables['safetySettings'] = [
+        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_CIVIC_INTEGRITY", "threshold": "BLOCK_NONE"}
+    ]
+    new_variables['model'] = model
+    gen_config = new_variables.setdefault('generationConfig', {})
+    gen_config['temperature'] = 0.7
+    new_body = {
+        "querySignature": original_body.get('querySignature'),
+        "operationName": original_body.get('operationName'),
+        "variables": new_variables
+    }
+    headers = creds['headers'].copy()
+    headers['content-type'] = 'application/json'
+    for key in ('content-length', 'Content-Length', 'host', 'Host', 'connection', 'Connection', 'accept-encoding'):
+        headers.pop(key, None)
+    return creds['url'], headers, new_body
+
+
+def template_prepare(template, contents, system_instruction, model):
+    gen_config = template.new_generation_config()
+    gen_config['temperature'] = 0.7
+    return template.url, template.headers, template.build_body(contents, system_instruction, model, gen_config)
+
+
+def bench_multimodal_retries(template, model, attempts=3):
+    """一个带 4 MB 图片、多轮引用同一张图片的对话，重试 attempts 次"""
+    image = {"inlineData": {"mimeType": "image/png", "data": "A" * (4 * 1024 * 1024)}}
+    contents = []
+    for turn in range(4):
+        contents.append({"role": "user", "parts": [{"text": f"Question {turn}"}, image]})
+        contents.append({"role": "model", "parts": [{"text": f"Answer {turn}"}]})
+    gen_config = template.new_generation_config()
+
+    def reserialize():
+        for _ in range(attempts):
+            json.dumps(template.build_body(contents, "Be brief.", model, gen_config)).encode("utf-8")
+
+    def reuse():
+        contents_json = serialize_contents(contents)
+        for _ in range(attempts):
+            template.build_body_bytes(contents_json, "Be brief.", model, gen_config)
+
+    assert json.loads(template.build_body_bytes(serialize_contents(contents), "Be brief.", model, gen_config)) == \
+        template.build_body(contents, "Be brief.", model, gen_config)
+    print(f"multimodal request ({attempts} attempts, 4 turns x 4 MB image):")
+    for name, fn in (("reserialize", reserialize), ("reuse", reuse)):
+        best = min(timeit.repeat(fn, number=3, repeat=3))
+        print(f"  {name:<11} {best / 3 * 1e3:8.2f} ms per request")
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), "..", "credentials.json")
+    harvest = load_harvest(path)
+    template = RequestTemplate(harvest)
+    contents = [{"role": "user", "parts": [{"text": "Hello!"}]}]
+    model = "gemini-2.5-pro"
+
+    legacy = legacy_prepare(harvest, contents, "Be brief.", model)
+    compiled = template_prepare(template, contents, "Be brief.", model)
+    assert legacy[2]['variables']['contents'] == compiled[2]['variables']['contents']
+
+    number = 20000
+    print(f"harvested body: {len(harvest['body'])} bytes")
+    for name, fn in (("legacy", lambda: legacy_prepare(harvest, contents, "Be brief.", model)),
+                     ("template", lambda: template_prepare(template, contents, "Be brief.", model))):
+        best = min(timeit.repeat(fn, number=number, repeat=5))
+        print(f"  {name:<9} {best / number * 1e6:8.2f} µs per request")
+
+    bench_multimodal_retries(template, model)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+流式解析基准测试
+对比旧的 str 缓冲 + raw_decode 循环与 JSONArrayStreamParser 的耗时
+
+用法:
+    python benchmarks/bench_stream_parser.py                 # 使用合成的 4K 图片响应
+    python benchmarks/bench_stream_parser.py recorded.json   # 使用录制的原始上游响应
+"""
+
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from src.stream_parser import JSONArrayStreamParser
+
+
+def legacy_parse(chunks):
+    """stream_chat 原有的解析循环（去掉日志输出）"""
+    objects = []
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk.decode("utf-8", errors="replace")
+        while buffer:
+            buffer = buffer.lstrip()
+            if not buffer:
+                break
+            if buffer.startswith('['):
+                buffer = buffer[1:]
+                continue
+            if buffer.startswith(','):
+                buffer = buffer[1:]
+                continue
+            if buffer.startswith(']'):
+                buffer = buffer[1:]
+                continue
+            try:
+                decoder = json.JSONDecoder()
+                obj, idx = decoder.raw_decode(buffer)
+                objects.append(obj)
+                buffer = buffer[idx:]
+            except json.JSONDecodeError:
+                break
+    return objects
+
+
+def incremental_parse(chunks):
+    parser = JSONArrayStreamParser()
+    objects = []
+    for chunk in chunks:
+        objects.extend(parser.feed(chunk))
+    return objects
+
+
+def synthetic_stream(image_bytes: int = 6 * 1024 * 1024) -> bytes:
+    """构造一个与 gemini-3-pro-image-preview-4k 响应结构相同的流"""
+    elements = []
+    for i in range(20):
+        elements.append({"results": [{"data": {"candidates": [{"content": {"parts": [{"text": f"thinking step {i} " * 8, "thought": True}]}}]}}]})
+    image = base64.b64encode(os.urandom(image_bytes * 3 // 4)).decode()
+    elements.append({"results": [{"data": {"candidates": [{"content": {"parts": [{"inlineData": {"mimeType": "image/png", "data": image}}]}, "finishReason": "STOP"}]}}]})
+    return ("[" + ",\r\n".join(json.dumps(e) for e in elements) + "]").encode()
+
+
+def split_chunks(payload: bytes, size: int):
+    return [payload[i:i + size] for i in range(0, len(payload), size)]
+
+
+def bench(name, fn, chunks, repeat=3):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(chunks)
+        best = min(best, time.perf_counter() - start)
+    print(f"  {name:<12} {best * 1000:9.1f} ms  ({len(result)} elements)")
+    return result
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "rb") as f:
+            payloads = [(os.path.basename(sys.argv[1]), f.read())]
+    else:
+        payloads = [("synthetic-1MB", synthetic_stream(1024 * 1024)),
+                    ("synthetic-6MB", synthetic_stream(6 * 1024 * 1024))]
+
+    for label, payload in payloads:
+        # httpx 的默认读取块大小约为 16KB~64KB，这里两种都测
+        for chunk_size in (16 * 1024, 64 * 1024):
+            chunks = split_chunks(payload, chunk_size)
+            print(f"{label}: {len(payload) / 1024 / 1024:.1f} MB in {len(chunks)} chunks of {chunk_size // 1024} KB")
+            old = bench("legacy", legacy_parse, chunks)
+            new = bench("incremental", incremental_parse, chunks)
+            assert old == new, "parsers disagree"
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,57 @@
 import asyncio
 import json
+import math
+import socket
+import tempfile
 import time
 import uuid
+from collections import deque
 import httpx
 import uvicorn
 import sys
 import os
-from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi import FastAPI, Request, Response, HTTPException, Depends
 from fastapi.responses import StreamingResponse, HTMLResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import APIKeyHeader
-from typing import Dict, Any, Optional, List, Generator
-from stats_manager import DailyStatsManager
+from starlette.background import BackgroundTask
+from typing import Callable, Dict, Any, Optional, List, Generator, AsyncIterator, Tuple, Union
+from stats_manager import DailyStatsManager, RateLimitStore, TokenStatsManager
+from src.model_registry import ModelRegistry, ModelRoute
+from src.request_template import RequestTemplate, serialize_contents
+from src.stream_events import ChatDelta, StreamError, Usage, UpstreamStreamError
+from src.token_usage import UsageTracker
+from src.upstream import UpstreamPool, UpstreamStream
+from src.metrics import MetricsRegistry
+from src.response_cache import ResponseCache, canonical_key, is_bypass_requested
+from src.image_store import ImageStore, image_base_url_var, inline_images_var
+from src.media import MediaError, MediaPipeline, extract_image_urls
+from src.rate_limiter import AdaptiveRateLimiter
+from src.admission import DEFAULT_PRIORITY, AdmissionController, AdmissionRejected, parse_priorities
+from src.harvester_hub import HarvesterHub
+from src.credential_hub import CredentialHub, HubClient
+from src.log import LazyJSON, get_logger, new_request_id, setup_logging
+
+setup_logging()
+log = get_logger("main")
 
 # --- Configuration ---
 PORT_API = 7860
 PORT_WS = 28881
 MODELS_CONFIG_FILE = "models.json"
 STATS_FILE = "stats.json"
+# 多 worker 模式：hub 进程负责浏览器 / harvester 和凭证，N 个 worker 进程处理 API 请求
+API_WORKERS = max(1, int(os.environ.get("API_WORKERS", "1")))
+if API_WORKERS > 1 and sys.platform == "win32":
+    # worker 共享监听 socket（pass_fds）和 Unix socket 凭证分发只在 POSIX 上可用
+    log.warning("⚠️ API_WORKERS=%d is not supported on Windows, running a single process", API_WORKERS)
+    API_WORKERS = 1
+HUB_SOCKET = os.environ.get("HUB_SOCKET", os.path.join(tempfile.gettempdir(), f"vertex-proxy-hub-{PORT_API}.sock"))
+WORKER_ID = os.environ.get("PROXY_WORKER_ID", "")  # 由 hub 进程设置，非空表示当前进程是 API worker
+IS_WORKER = bool(WORKER_ID)
 API_KEY = os.environ.get("API_KEY", "your-secret-api-key-here").strip()  # 从环境变量读取并清理空格
+# 额外的 API Key 及其优先级（high / normal / low），格式 "key1:high,key2:low"；API_KEY 本身为 normal
+API_KEY_PRIORITIES = parse_priorities(os.environ.get("API_KEY_PRIORITIES", ""))
 print(f"\n{'='*60}")
 print(f"🔑 API_KEY 配置:")
 print(f"   - 来源: {'环境变量' if 'API_KEY' in os.environ else '默认值'}")
@@ -32,6 +65,10 @@ BROWSER_MODE = os.environ.get("BROWSER_MODE", "manual")  # manual / headful / we
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 security_bearer = HTTPBearer(auto_error=False)
 
+def is_valid_api_key(token: str) -> bool:
+    """API_KEY 或 API_KEY_PRIORITIES 中的任一 key（与准入控制使用同一组 key）"""
+    return token == API_KEY or token in API_KEY_PRIORITIES
+
 async def verify_api_key(bearer: HTTPAuthorizationCredentials = Depends(security_bearer)):
     """验证 API Key - 使用 Authorization: Bearer <token>"""
     if not bearer or not bearer.credentials:
@@ -42,88 +79,189 @@ async def verify_api_key(bearer: HTTPAuthorizationCredentials = Depends(security
     
     token = bearer.credentials.strip()
     
-    if token != API_KEY:
-        print(f"⚠️ API Key 验证失败 (长度不匹配: 期望 {len(API_KEY)}, 收到 {len(token)})")
+    if not is_valid_api_key(token):
+        log.warning("⚠️ API Key 验证失败 (长度不匹配: 期望 %d, 收到 %d)", len(API_KEY), len(token))
         raise HTTPException(status_code=401, detail="Invalid API Key")
     
     return token
 
-# --- Token Stats Manager ---
-class TokenStatsManager:
-    def __init__(self, filepath=STATS_FILE):
-        self.filepath = filepath
-        self.stats = {"total_requests": 0, "total_tokens": 0, "prompt_tokens": 0, "completion_tokens": 0}
-        self.lock = asyncio.Lock()
-        self.load_stats()
+# --- Stats Managers ---
+# worker 只读取统计文件，用量发给 hub 统一累计和落盘
+stats_manager = TokenStatsManager(STATS_FILE, persist=not IS_WORKER)
+daily_stats_manager = DailyStatsManager(persist=not IS_WORKER)
 
-    def load_stats(self):
-        try:
-            with open(self.filepath, 'r', encoding='utf-8') as f:
-                self.stats = json.load(f)
-        except FileNotFoundError:
-            self.save_stats()
-        except Exception as e:
-            print(f"⚠️ Error loading stats: {e}")
-
-    def save_stats(self):
-        try:
-            with open(self.filepath, 'w', encoding='utf-8') as f:
-                json.dump(self.stats, f, indent=2)
-        except Exception as e:
-            print(f"⚠️ Error saving stats: {e}")
+# --- Credential Manager ---
+CREDENTIAL_COOLDOWN = float(os.environ.get("CREDENTIAL_COOLDOWN", "60"))  # 配额耗尽后的冷却秒数
+CREDENTIAL_COOLDOWN_MAX = 600
+CREDENTIAL_MAX_AGE = 3600  # Vertex AI tokens typically last 1 hour
 
-    async def update(self, prompt_tokens, completion_tokens):
-        async with self.lock:
-            self.stats["total_requests"] += 1
-            self.stats["prompt_tokens"] += prompt_tokens
-            self.stats["completion_tokens"] += completion_tokens
-            self.stats["total_tokens"] += (prompt_tokens + completion_tokens)
-            self.save_stats()
+class GenerationSignal:
+    """
+    A monotonically increasing generation counter that waiters can block on.
 
-stats_manager = TokenStatsManager()
-daily_stats_manager = DailyStatsManager()
+    Every bump wakes all waiters and swaps in a fresh event, so no waiter ever
+    clears an event that another request is still waiting on.
+    """
+    def __init__(self):
+        self.generation = 0
+        self._event = asyncio.Event()
+
+    def bump(self):
+        self.generation += 1
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+    async def wait_past(self, generation: int, timeout: float) -> bool:
+        """Waits until the counter moves past `generation`. Returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        while self.generation <= generation:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return self.generation > generation
+        return True
+
+class CredentialSlot:
+    """One independently harvested session (cookie + reCAPTCHA token) in the credential pool."""
+    def __init__(self, slot_id: str, harvest: Optional[Dict[str, Any]] = None, last_updated: float = 0):
+        self.slot_id = slot_id
+        self.harvest: Optional[Dict[str, Any]] = None
+        self.template: Optional[RequestTemplate] = None
+        self.last_updated = last_updated
+        self.in_flight = 0
+        self.total_requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.exhausted_count = 0
+        self.consecutive_exhausted = 0
+        self.cooldown_until: float = 0
+        self.last_used: float = 0
+        if harvest:
+            self.set_harvest(harvest)
+
+    def set_harvest(self, harvest: Dict[str, Any]):
+        """Swaps in a new credential and compiles its request template once."""
+        try:
+            template = RequestTemplate(harvest)
+        except (ValueError, KeyError) as e:
+            log.warning("⚠️ Credential slot '%s' received an unusable harvest: %s", self.slot_id, e)
+            return
+        # Assign both together so readers never see a template from another harvest
+        self.harvest, self.template = harvest, template
+
+    def is_available(self, now: float) -> bool:
+        return self.template is not None and now >= self.cooldown_until
+
+    def to_stats(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "slot": self.slot_id,
+            "age": int(now - self.last_updated) if self.last_updated else None,
+            "in_flight": self.in_flight,
+            "requests": self.total_requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "exhausted": self.exhausted_count,
+            "cooldown_remaining": max(0, int(self.cooldown_until - now)),
+            "healthy": self.is_available(now),
+        }
 
-# --- Credential Manager ---
 class CredentialManager:
-    def __init__(self, filepath="credentials.json"):
+    DEFAULT_SLOT = "default"
+
+    def __init__(self, filepath="credentials.json", pool_filepath="credential_pool.json"):
         self.filepath = filepath
-        self.latest_harvest: Optional[Dict[str, Any]] = None
-        self.last_updated: float = 0
-        self.refresh_event = asyncio.Event() # Event to block requests during refresh
-        self.refresh_complete_event = asyncio.Event() # Event to signal UI is ready after refresh
-        self.refresh_lock = asyncio.Lock() # Lock to ensure only one refresh triggers at a time
-        self.refresh_event.set() # Initially set (not refreshing)
-        self.refresh_complete_event.set()
+        self.pool_filepath = pool_filepath
+        self.slots: Dict[str, CredentialSlot] = {}
+        self._rr_counter = 0
+        self.credentials_signal = GenerationSignal() # Bumped whenever any slot receives new credentials
+        self.ui_ready_signal = GenerationSignal() # Bumped when a frontend reports its refresh sequence is complete
         self.load_from_disk()
 
+    @property
+    def latest_slot(self) -> Optional[CredentialSlot]:
+        """The most recently refreshed slot that holds credentials."""
+        slots = [s for s in self.slots.values() if s.harvest]
+        if not slots:
+            return None
+        return max(slots, key=lambda s: s.last_updated)
+
+    @property
+    def latest_harvest(self) -> Optional[Dict[str, Any]]:
+        slot = self.latest_slot
+        return slot.harvest if slot else None
+
+    @property
+    def last_updated(self) -> float:
+        slot = self.latest_slot
+        return slot.last_updated if slot else 0
+
+    def _get_slot(self, slot_id: str) -> CredentialSlot:
+        slot = self.slots.get(slot_id)
+        if slot is None:
+            slot = CredentialSlot(slot_id)
+            self.slots[slot_id] = slot
+        return slot
+
     def load_from_disk(self):
+        # 先加载凭证池文件；单凭证文件（manual 模式下由用户编辑）比凭证池新时覆盖默认槽位
+        pool_mtime = 0.0
+        try:
+            with open(self.pool_filepath, 'r', encoding='utf-8') as f:
+                pool = json.load(f)
+            pool_mtime = os.path.getmtime(self.pool_filepath)
+            for slot_id, harvest in pool.items():
+                if harvest:
+                    self.slots[slot_id] = CredentialSlot(slot_id, harvest, harvest.get('timestamp', 0))
+            if self.slots:
+                log.info("📂 Loaded %d credential slot(s) from %s", len(self.slots), self.pool_filepath)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.warning("⚠️ Error loading credential pool: %s", e)
+
         try:
+            mtime = os.path.getmtime(self.filepath)
+            if self.slots and mtime <= pool_mtime:
+                # save_to_disk 先写单凭证文件再写凭证池：没有更新的手动修改
+                return
             with open(self.filepath, 'r', encoding='utf-8') as f:
                 data = json.load(f)
                 # 兼容两种格式：旧格式 {'harvest': {...}} 和新格式 {...}
                 if 'harvest' in data:
-                    self.latest_harvest = data.get('harvest')
-                    self.last_updated = data.get('timestamp', 0)
+                    harvest = data.get('harvest')
+                    last_updated = data.get('timestamp', 0)
                 else:
                     # 新格式直接存储凭证
-                    self.latest_harvest = data
-                    self.last_updated = data.get('timestamp', time.time())
-                print(f"📂 Loaded credentials from disk (Age: {int(time.time() - self.last_updated)}s)")
+                    harvest = data
+                    last_updated = data.get('timestamp', time.time())
+                if self.slots:
+                    # 凭证池之后被手动修改 / 替换：视为修改时获取的凭证
+                    last_updated = max(last_updated, mtime)
+                    log.info("📂 %s is newer than the credential pool, using it for slot %s",
+                             self.filepath, self.DEFAULT_SLOT)
+                self.slots[self.DEFAULT_SLOT] = CredentialSlot(self.DEFAULT_SLOT, harvest, last_updated)
+                log.info("📂 Loaded credentials from disk (Age: %ds)", time.time() - last_updated)
         except FileNotFoundError:
-            print("📂 No saved credentials found.")
+            log.info("📂 No saved credentials found.")
         except Exception as e:
-            print(f"⚠️ Error loading credentials: {e}")
+            log.warning("⚠️ Error loading credentials: %s", e)
 
     def save_to_disk(self):
         try:
             with open(self.filepath, 'w', encoding='utf-8') as f:
-                # 直接保存凭证，不嵌套在 'harvest' 键下
+                # 直接保存最新凭证，不嵌套在 'harvest' 键下（manual 模式兼容）
                 json.dump(self.latest_harvest, f, indent=2)
-            print(f"💾 Credentials saved to {self.filepath}")
+            with open(self.pool_filepath, 'w', encoding='utf-8') as f:
+                json.dump({sid: s.harvest for sid, s in self.slots.items() if s.harvest}, f, indent=2)
+            log.debug("💾 Credentials saved to %s", self.filepath)
         except Exception as e:
-            print(f"⚠️ Error saving credentials: {e}")
+            log.warning("⚠️ Error saving credentials: %s", e)
 
-    def update(self, data: Dict[str, Any]):
+    def update(self, data: Dict[str, Any], slot_id: str = DEFAULT_SLOT):
         """
         更新凭证
         
@@ -136,60 +274,119 @@ class CredentialManager:
                     "body": "...",  # 必须是字符串格式
                     "timestamp": 123456
                 }
+            slot_id: 凭证池中的槽位（每个 harvester / 浏览器会话一个）
         """
         # 确保 body 是字符串格式
         if 'body' in data and not isinstance(data['body'], str):
-            print(f"⚠️ Warning: body is not a string, converting...")
+            log.warning("⚠️ Warning: body is not a string, converting...")
             data['body'] = json.dumps(data['body'])
         
-        self.latest_harvest = data
-        self.last_updated = time.time()
-        # 更新时间戳
-        self.latest_harvest['timestamp'] = self.last_updated
+        slot = self._get_slot(slot_id)
+        data['timestamp'] = time.time()
+        slot.set_harvest(data)
+        if slot.harvest is not data:
+            return
+        slot.last_updated = data['timestamp']
+        # 新凭证到达，解除冷却
+        slot.cooldown_until = 0
+        slot.consecutive_exhausted = 0
         
-        print(f"🔄 Credentials updated at {time.strftime('%H:%M:%S')}")
+        log.info("🔄 Credentials updated (slot: %s)", slot_id)
         self.save_to_disk()
-        self.refresh_event.set() # Unblock credential waiting requests
+        self.credentials_signal.bump() # Wake every request waiting for fresh credentials
 
-    def update_token(self, token: str):
-        if self.latest_harvest and 'headers' in self.latest_harvest:
+    def update_token(self, token: str, slot_id: str = DEFAULT_SLOT):
+        slot = self.slots.get(slot_id) or self.latest_slot
+        if slot and slot.harvest and 'headers' in slot.harvest:
             # Debug: Print old token prefix
-            old_val = self.latest_harvest['headers'].get('X-Goog-First-Party-Reauth', 'None')
-            print(f"🔍 Old Token Prefix: {old_val[:20]}...")
+            old_val = slot.harvest['headers'].get('X-Goog-First-Party-Reauth', 'None')
+            log.debug("🔍 Old Token Prefix: %.20s...", old_val)
 
-            # Update the specific header.
+            # Update the specific header. Build a new harvest dict and swap it in so
+            # requests that already read the old one are not affected mid-flight.
             formatted_token = json.dumps([token])
-            self.latest_harvest['headers']['X-Goog-First-Party-Reauth'] = formatted_token
+            headers = dict(slot.harvest['headers'])
+            headers['X-Goog-First-Party-Reauth'] = formatted_token
+            slot.set_harvest({**slot.harvest, 'headers': headers})
             
-            print(f"🔍 New Token Prefix: {formatted_token[:20]}...")
+            log.debug("🔍 New Token Prefix: %.20s...", formatted_token)
             
-            self.last_updated = time.time()
-            print(f"🔄 Token refreshed via WebSocket at {time.strftime('%H:%M:%S')}")
+            slot.last_updated = time.time()
+            slot.cooldown_until = 0
+            log.info("🔄 Token refreshed via WebSocket (slot: %s)", slot.slot_id)
             self.save_to_disk()
-            self.refresh_event.set() # Unblock waiting requests
+            self.credentials_signal.bump() # Wake every request waiting for fresh credentials
 
-    async def wait_for_refresh(self, timeout=30):
-        """Blocks until new credentials are received or timeout occurs."""
-        self.refresh_event.clear() # Start blocking for credentials
-        self.refresh_complete_event.clear() # Also block for UI completion signal
-        try:
-            print("   - Waiting for credentials...")
-            await asyncio.wait_for(self.refresh_event.wait(), timeout=timeout)
-            return True
-        except asyncio.TimeoutError:
-            print("   - Timed out waiting for credentials.")
-            self.refresh_complete_event.set() # Unblock the other wait if this one fails
-            return False
+    def acquire(self, exclude=()) -> Optional[CredentialSlot]:
+        """
+        Picks the least-loaded healthy slot (round-robin among ties) and marks it in use.
+        Falls back to the slot whose cooldown ends first when every slot is cooling down.
+        """
+        now = time.time()
+        candidates = [s for s in self.slots.values() if s.template and s.slot_id not in exclude]
+        if not candidates:
+            return None
+        healthy = [s for s in candidates if s.is_available(now)]
+        # Prefer slots that are still within the token lifetime; stale ones are a last resort
+        fresh = [s for s in healthy if now - s.last_updated < CREDENTIAL_MAX_AGE]
+        healthy = fresh or healthy
+        if healthy:
+            self._rr_counter += 1
+            n = len(healthy)
+            # Rotate the list so ties are broken round-robin
+            offset = self._rr_counter % n
+            rotated = healthy[offset:] + healthy[:offset]
+            slot = min(rotated, key=lambda s: s.in_flight)
+        else:
+            slot = min(candidates, key=lambda s: s.cooldown_until)
+        slot.in_flight += 1
+        slot.total_requests += 1
+        slot.last_used = now
+        return slot
+
+    def release(self, slot: CredentialSlot, success: bool, exhausted: bool = False, cancelled: bool = False):
+        """Returns a slot to the pool and records the outcome of the request."""
+        slot.in_flight = max(0, slot.in_flight - 1)
+        if cancelled:
+            # The losing side of a hedged request says nothing about the slot's health
+            return
+        if success:
+            slot.successes += 1
+            slot.consecutive_exhausted = 0
+            return
+        slot.failures += 1
+        if exhausted:
+            slot.exhausted_count += 1
+            slot.consecutive_exhausted += 1
+            cooldown = min(CREDENTIAL_COOLDOWN * (2 ** (slot.consecutive_exhausted - 1)), CREDENTIAL_COOLDOWN_MAX)
+            slot.cooldown_until = time.time() + cooldown
+            log.warning("🧊 Credential slot '%s' exhausted, cooling down for %ds", slot.slot_id, cooldown)
+
+    def apply(self, slot_id: str, harvest: Dict[str, Any], last_updated: float):
+        """Installs credentials published by the hub process (multi-worker mode; not saved to disk)."""
+        slot = self._get_slot(slot_id)
+        slot.set_harvest(harvest)
+        if slot.harvest is not harvest:
+            return
+        slot.last_updated = last_updated
+        slot.cooldown_until = 0
+        slot.consecutive_exhausted = 0
+        self.credentials_signal.bump()
 
-    async def wait_for_refresh_complete(self, timeout=30):
-        """Blocks until the frontend signals the refresh sequence is fully complete."""
-        try:
-            print("   - Waiting for frontend UI to be ready...")
-            await asyncio.wait_for(self.refresh_complete_event.wait(), timeout=timeout)
-            return True
-        except asyncio.TimeoutError:
-            print("   - Timed out waiting for frontend UI.")
-            return False
+    def available_count(self, exclude=()) -> int:
+        now = time.time()
+        return sum(1 for s in self.slots.values() if s.is_available(now) and s.slot_id not in exclude)
+
+    def get_pool_stats(self) -> List[Dict[str, Any]]:
+        return [s.to_stats() for s in self.slots.values()]
+
+    @property
+    def generation(self) -> int:
+        return self.credentials_signal.generation
+
+    def mark_refresh_complete(self):
+        """Called when a frontend confirms its UI is stable after a refresh."""
+        self.ui_ready_signal.bump()
 
     def get_credentials(self) -> Optional[Dict[str, Any]]:
         if not self.latest_harvest:
@@ -198,16 +395,373 @@ class CredentialManager:
         # Note: Vertex AI tokens are short-lived, but cookies might last longer.
         # We'll just warn for now.
         if time.time() - self.last_updated > 1800: # 30 mins
-            print("⚠️ Warning: Credentials might be stale (>30 mins old).")
+            log.warning("⚠️ Warning: Credentials might be stale (>30 mins old).")
         return self.latest_harvest
 
 cred_manager = CredentialManager()
+model_registry = ModelRegistry(MODELS_CONFIG_FILE)
+
+# --- Metrics ---
+metrics = MetricsRegistry()
+PHASE_SECONDS = metrics.histogram(
+    "vertex_proxy_phase_seconds",
+    "Per-phase request latency: preflight, build, connect, ttfb, first_delta, total, refresh_wait",
+    ("phase", "model", "mode"))
+REQUESTS_TOTAL = metrics.counter("vertex_proxy_requests_total", "Chat requests by outcome", ("model", "mode", "outcome"))
+RETRIES_TOTAL = metrics.counter("vertex_proxy_retries_total", "Upstream attempts retried, by reason", ("model", "reason"))
+REFRESHES_TOTAL = metrics.counter("vertex_proxy_refreshes_total", "Credential refresh requests, by reason and whether they started a new refresh", ("reason", "result"))
+
+def observe_phase(phase: str, model: str, seconds: float):
+    PHASE_SECONDS.observe(seconds, phase=phase, model=model_registry.metric_label(model), mode=BROWSER_MODE)
+
+# --- Refresh Coordinator ---
+def _percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted, non-empty list."""
+    index = max(0, math.ceil(q * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+class RefreshCoordinator:
+    """
+    Single-flight credential refresh shared by every retry path.
+
+    Concurrent callers join the refresh that is already in flight instead of
+    triggering their own, and everyone wakes on the same new credential generation.
+    A caller that saw an older generation than the current one skips the refresh
+    entirely, because someone else already replaced the credentials it failed with.
+    """
+    def __init__(self, cred_manager: CredentialManager, timeout: float = 60):
+        self.cred_manager = cred_manager
+        self.timeout = timeout
+        self._inflight: Optional[asyncio.Task] = None
+        self._ui_generation_at_start = 0
+        self._latencies = deque(maxlen=200)  # seconds, most recent successful refreshes
+        self.stats = {
+            "requested": 0,   # refresh() calls
+            "triggered": 0,   # refreshes actually sent to a harvester / browser
+            "coalesced": 0,   # calls served by an in-flight or already-completed refresh
+            "succeeded": 0,
+            "timeouts": 0,
+            "errors": 0,
+        }
+
+    @property
+    def in_progress(self) -> bool:
+        return self._inflight is not None and not self._inflight.done()
+
+    async def refresh(self, reason: str, timeout: Optional[float] = None,
+                      seen_generation: Optional[int] = None, wait_ui: bool = False) -> bool:
+        """
+        Ensures credentials newer than `seen_generation` exist.
+
+        Args:
+            reason: 触发原因（仅用于日志）
+            timeout: 本调用方最多等待的秒数（不影响共享的刷新任务）
+            seen_generation: 调用方失败时使用的凭证代数
+            wait_ui: 是否额外等待前端确认 UI 已就绪
+        """
+        self.stats["requested"] += 1
+        timeout = self.timeout if timeout is None else timeout
+
+        if seen_generation is not None and self.cred_manager.generation > seen_generation:
+            log.info("♻️ Credentials already refreshed by another request (%s)", reason)
+            self.stats["coalesced"] += 1
+            REFRESHES_TOTAL.inc(reason=reason, result="already_refreshed")
+            return True
+
+        task = self._inflight
+        if task is None or task.done():
+            log.info("🔄 Starting credential refresh (%s)...", reason)
+            self.stats["triggered"] += 1
+            REFRESHES_TOTAL.inc(reason=reason, result="triggered")
+            task = asyncio.create_task(self._run())
+            self._inflight = task
+        else:
+            log.info("⏳ Joining in-flight credential refresh (%s)...", reason)
+            self.stats["coalesced"] += 1
+            REFRESHES_TOTAL.inc(reason=reason, result="joined")
+
+        try:
+            # shield: one caller giving up must not cancel the refresh for everyone else
+            refreshed = await asyncio.wait_for(asyncio.shield(task), timeout=timeout)
+        except asyncio.TimeoutError:
+            log.warning("Timed out waiting for credentials.")
+            return False
+
+        if refreshed and wait_ui:
+            log.info("Waiting for frontend UI to be ready...")
+            if not await self.cred_manager.ui_ready_signal.wait_past(self._ui_generation_at_start, timeout):
+                log.warning("Timed out waiting for frontend UI.")
+                return False
+        return refreshed
+
+    def refresh_in_background(self, reason: str) -> None:
+        """Starts (or joins) a refresh without making the caller wait for it."""
+        task = asyncio.create_task(self.refresh(reason))
+        task.add_done_callback(lambda t: t.exception() if not t.cancelled() else None)
+
+    def latency_stats(self) -> Dict[str, Any]:
+        """Trigger-to-new-credentials latency of recent successful refreshes."""
+        samples = sorted(self._latencies)
+        if not samples:
+            return {"latency_p50_ms": None, "latency_p99_ms": None}
+        return {
+            "latency_p50_ms": round(_percentile(samples, 0.50) * 1000),
+            "latency_p99_ms": round(_percentile(samples, 0.99) * 1000),
+        }
+
+    async def _run(self) -> bool:
+        start_generation = self.cred_manager.generation
+        self._ui_generation_at_start = self.cred_manager.ui_ready_signal.generation
+        started = time.monotonic()
+        # One deadline covers both the trigger (which may block on a harvester) and the wait for
+        # the new credentials, so a dead refresh holds the single-flight slot for at most self.timeout
+        deadline = started + self.timeout
+        try:
+            await trigger_credential_refresh(self.timeout)
+            log.info("Waiting for credentials...")
+            refreshed = await self.cred_manager.credentials_signal.wait_past(
+                start_generation, max(0.0, deadline - time.monotonic()))
+        except Exception as e:
+            log.error("❌ 凭证刷新失败: %s", e)
+            self.stats["errors"] += 1
+            return False
+        if refreshed:
+            self.stats["succeeded"] += 1
+            self._latencies.append(time.monotonic() - started)
+        else:
+            self.stats["timeouts"] += 1
+            log.error("❌ Credential refresh timed out.")
+        return refreshed
+
+refresh_coordinator = RefreshCoordinator(cred_manager)
+
+# --- Proactive Refresher ---
+REFRESH_AHEAD_AGE = float(os.environ.get("REFRESH_AHEAD_AGE", "2400"))  # 凭证达到该年龄时提前刷新（秒）
+REFRESH_ERROR_RATE = float(os.environ.get("REFRESH_ERROR_RATE", "0.5"))  # 滚动错误率超过该值时提前刷新
+
+class ProactiveRefresher:
+    """
+    Background task that refreshes credentials before they expire.
+
+    It refreshes when the newest credential passes REFRESH_AHEAD_AGE, or early when
+    the rolling error rate over the last `window` seconds crosses REFRESH_ERROR_RATE.
+    Requests keep using the current credential meanwhile; the new one is swapped in
+    atomically by CredentialManager.update().
+    """
+    def __init__(self, coordinator: RefreshCoordinator, cred_manager: CredentialManager,
+                 check_interval: float = 15, window: float = 120, min_samples: int = 5,
+                 min_interval: float = 60):
+        self.coordinator = coordinator
+        self.cred_manager = cred_manager
+        self.check_interval = check_interval
+        self.window = window
+        self.min_samples = min_samples
+        self.min_interval = min_interval
+        self._results = deque()  # (timestamp, ok)
+        self._last_refresh = 0.0
+        self.stats = {"age_refreshes": 0, "error_rate_refreshes": 0}
+
+    def record_result(self, ok: bool):
+        now = time.time()
+        self._results.append((now, ok))
+        self._trim(now)
+
+    def _trim(self, now: float):
+        while self._results and now - self._results[0][0] > self.window:
+            self._results.popleft()
+
+    def error_rate(self) -> float:
+        self._trim(time.time())
+        if len(self._results) < self.min_samples:
+            return 0.0
+        failures = sum(1 for _, ok in self._results if not ok)
+        return failures / len(self._results)
+
+    def _reason(self) -> Optional[str]:
+        now = time.time()
+        if now - self._last_refresh < self.min_interval or self.coordinator.in_progress:
+            return None
+        if not self.cred_manager.latest_harvest:
+            return "no credentials"
+        if now - self.cred_manager.last_updated > REFRESH_AHEAD_AGE:
+            return "age"
+        if self.error_rate() >= REFRESH_ERROR_RATE:
+            return "error rate"
+        return None
+
+    async def run(self):
+        log.info("🕒 Proactive credential refresher started (ahead age %ds)", REFRESH_AHEAD_AGE)
+        while True:
+            await asyncio.sleep(self.check_interval)
+            reason = self._reason()
+            if not reason:
+                continue
+            self._last_refresh = time.time()
+            if reason == "error rate":
+                self.stats["error_rate_refreshes"] += 1
+                self._results.clear()
+            else:
+                self.stats["age_refreshes"] += 1
+            try:
+                await self.coordinator.refresh(f"proactive: {reason}")
+            except Exception as e:
+                log.warning("⚠️ Proactive refresh failed: %s", e)
+
+proactive_refresher = ProactiveRefresher(refresh_coordinator, cred_manager)
+
+# --- Upstream Hedging ---
+UPSTREAM_HEDGING = os.environ.get("UPSTREAM_HEDGING", "false").lower() in ("1", "true", "yes", "on")  # 慢请求对冲到第二个凭证槽位
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "0.95"))  # 首包时间超过该分位数时发出对冲请求
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "1.0"))  # 对冲截止时间下限（秒）
+HEDGE_MAX_DELAY = float(os.environ.get("HEDGE_MAX_DELAY", "10.0"))  # 对冲截止时间上限（秒），样本不足时使用
+HEDGE_BUDGET = float(os.environ.get("HEDGE_BUDGET", "0.1"))  # 每个请求积累的对冲额度（0.1 即最多约 10% 的请求被对冲）
+
+class HedgePolicy:
+    """
+    Decides when a slow upstream request gets duplicated onto a second credential slot.
+
+    The deadline is the HEDGE_PERCENTILE of recent time-to-first-element, clamped to
+    [min_delay, max_delay]. A token bucket caps hedges at `budget` per request, and a
+    request is hedged at most once, so upstream load never exceeds 2x.
+    """
+    def __init__(self, enabled: bool = False, percentile: float = 0.95, min_delay: float = 1.0,
+                 max_delay: float = 10.0, budget: float = 0.1, min_samples: int = 20, window: int = 200):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max(min_delay, max_delay)
+        self.budget = min(max(budget, 0.0), 1.0)
+        self.min_samples = min_samples
+        self._ttfb = deque(maxlen=window)  # seconds
+        self._credits = 1.0
+        self._max_credits = max(1.0, self.budget * 10)
+        self.stats = {"hedges": 0, "hedge_wins": 0, "budget_denied": 0, "no_slot": 0}
+
+    def record_ttfb(self, seconds: float):
+        self._ttfb.append(seconds)
+
+    def deadline(self) -> float:
+        if len(self._ttfb) < self.min_samples:
+            return self.max_delay
+        value = _percentile(sorted(self._ttfb), self.percentile)
+        return min(max(value, self.min_delay), self.max_delay)
+
+    def on_request(self):
+        self._credits = min(self._credits + self.budget, self._max_credits)
+
+    def try_hedge(self) -> bool:
+        if self._credits < 1.0:
+            self.stats["budget_denied"] += 1
+            return False
+        self._credits -= 1.0
+        return True
+
+    def to_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "enabled": self.enabled, "deadline_ms": round(self.deadline() * 1000),
+                "samples": len(self._ttfb)}
+
+hedge_policy = HedgePolicy(UPSTREAM_HEDGING, HEDGE_PERCENTILE, HEDGE_MIN_DELAY, HEDGE_MAX_DELAY, HEDGE_BUDGET)
 
 # --- 浏览器模式全局变量 ---
 _headful_browser = None
-_refresh_fail_count = 0
-_REDIRECT_THRESHOLD = 2
-_refresh_lock = None
+_REDIRECT_THRESHOLD = 2  # 标签页连续失败该次数后尝试恢复
+HARVEST_TIMEOUT = 5.0  # 发送测试消息后等待抓取到凭证的秒数
+HEADFUL_TABS = max(1, int(os.environ.get("HEADFUL_TABS", "1")))  # 预热的 Vertex AI Studio 标签页数量
+# 有头浏览器资源拦截：资源类型 / URL 拒绝列表 / URL 允许列表（逗号分隔，设为空字符串可关闭对应规则）
+BROWSER_BLOCK_RESOURCES = os.environ.get("BROWSER_BLOCK_RESOURCES")
+BROWSER_BLOCK_URLS = os.environ.get("BROWSER_BLOCK_URLS")
+BROWSER_ALLOW_URLS = os.environ.get("BROWSER_ALLOW_URLS")
+BROWSER_VIEWPORT = os.environ.get("BROWSER_VIEWPORT", "")  # 例如 1280x720，默认 1920x1080
+
+# --- Upstream Connection Pool ---
+UPSTREAM_HTTP2 = os.environ.get("UPSTREAM_HTTP2", "true").lower() in ("1", "true", "yes", "on")  # 需要安装 httpx[http2]
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.environ.get("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", "120"))  # 空闲连接保留秒数
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", "10"))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", "120"))  # 两个数据块之间的最长间隔
+UPSTREAM_WRITE_TIMEOUT = float(os.environ.get("UPSTREAM_WRITE_TIMEOUT", "30"))
+UPSTREAM_POOL_TIMEOUT = float(os.environ.get("UPSTREAM_POOL_TIMEOUT", "10"))  # 连接池占满时等待空闲连接的秒数
+UPSTREAM_WARM_INTERVAL = float(os.environ.get("UPSTREAM_WARM_INTERVAL", "60"))  # 主机空闲超过该秒数时重新预热，0 表示只在凭证更新时预热
+
+UPSTREAM_POOL_TIMEOUTS = metrics.counter("vertex_proxy_upstream_pool_timeouts_total", "Requests that timed out waiting for a pooled upstream connection")
+
+# --- Response Cache ---
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "false").lower() in ("1", "true", "yes", "on")  # 缓存 temperature=0 的请求
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_MAX_MB = float(os.environ.get("RESPONSE_CACHE_MAX_MB", "64"))  # 内存层上限
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))  # 条目有效秒数
+RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR", "")  # 磁盘层目录，为空表示只使用内存
+
+response_cache = ResponseCache(
+    enabled=RESPONSE_CACHE,
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    max_bytes=int(RESPONSE_CACHE_MAX_MB * 1024 * 1024),
+    ttl=RESPONSE_CACHE_TTL,
+    disk_dir=RESPONSE_CACHE_DIR,
+)
+
+# --- Generated Image Store ---
+IMAGE_DELIVERY = os.environ.get("IMAGE_DELIVERY", "url").lower()  # url: 返回 /v1/images 短链接；data_uri: 内联 base64
+IMAGE_STORE_DIR = os.environ.get("IMAGE_STORE_DIR", "images")
+IMAGE_STORE_MAX_MB = float(os.environ.get("IMAGE_STORE_MAX_MB", "1024"))  # 图片目录大小上限，超出时淘汰最久未访问的图片
+IMAGE_PUBLIC_BASE_URL = os.environ.get("IMAGE_PUBLIC_BASE_URL", "")  # 图片链接的对外地址，为空时使用请求的 Host
+
+# 多 worker 模式下图片目录由所有 worker 共用，只由 hub 定期淘汰
+image_store = ImageStore(IMAGE_STORE_DIR, int(IMAGE_STORE_MAX_MB * 1024 * 1024), public_base_url=IMAGE_PUBLIC_BASE_URL,
+                         shared=API_WORKERS > 1)
+
+# --- Admission Control ---
+ADMISSION_PER_CREDENTIAL = int(os.environ.get("ADMISSION_PER_CREDENTIAL", "8"))  # 每个可用凭证槽位的并发上限，0 表示不限制
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "100"))  # 等待队列长度
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "30"))  # 最长排队秒数，预计超过时直接返回 429
+if IS_WORKER and ADMISSION_PER_CREDENTIAL > 0:
+    # 每个 worker 只分到总并发上限的一份
+    ADMISSION_PER_CREDENTIAL = math.ceil(ADMISSION_PER_CREDENTIAL / API_WORKERS)
+
+admission = AdmissionController(ADMISSION_PER_CREDENTIAL, ADMISSION_QUEUE_SIZE, ADMISSION_MAX_WAIT,
+                                available_slots=lambda: cred_manager.available_count())
+metrics.gauge("vertex_proxy_admission_active", "Requests currently admitted to the upstream",
+              function=lambda: admission.active)
+metrics.gauge("vertex_proxy_admission_queue_depth", "Requests waiting in the admission queue",
+              function=lambda: admission.queue_depth)
+
+# --- Adaptive Rate Limiting ---
+RATE_LIMIT_ADAPTIVE = os.environ.get("RATE_LIMIT_ADAPTIVE", "true").lower() in ("1", "true", "yes", "on")  # 按 429 学习配额并提前限速
+RATE_LIMIT_FILE = os.environ.get("RATE_LIMIT_FILE", "rate_limits.json")  # 学到的速率，重启后继续使用
+RATE_LIMIT_MIN_RPM = float(os.environ.get("RATE_LIMIT_MIN_RPM", "1"))
+RATE_LIMIT_MAX_RPM = float(os.environ.get("RATE_LIMIT_MAX_RPM", "600"))  # 超过后恢复为不限速
+RATE_LIMIT_DECREASE = float(os.environ.get("RATE_LIMIT_DECREASE", "0.5"))  # 配额耗尽时速率乘以的系数
+RATE_LIMIT_INCREASE = float(os.environ.get("RATE_LIMIT_INCREASE", "2"))  # 持续成功时每分钟提高的 RPM
+RATE_LIMIT_MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT", "20"))  # 单个请求最长的限速等待秒数
+if IS_WORKER:
+    # 每个 worker 按自己分到的流量学习，各自保存
+    RATE_LIMIT_FILE = "{0}.worker{2}{1}".format(*os.path.splitext(RATE_LIMIT_FILE), WORKER_ID)
+
+rate_limit_store = RateLimitStore(RATE_LIMIT_FILE)
+rate_limiter = AdaptiveRateLimiter(
+    enabled=RATE_LIMIT_ADAPTIVE,
+    min_rpm=RATE_LIMIT_MIN_RPM,
+    max_rpm=RATE_LIMIT_MAX_RPM,
+    decrease=RATE_LIMIT_DECREASE,
+    increase=RATE_LIMIT_INCREASE,
+    max_wait=RATE_LIMIT_MAX_WAIT,
+    state=rate_limit_store.stats,
+    on_change=rate_limit_store.mark_dirty,
+)
+
+# --- Inbound Media ---
+MEDIA_FETCH_CONCURRENCY = int(os.environ.get("MEDIA_FETCH_CONCURRENCY", "4"))  # 同时下载的远程图片数量
+MEDIA_MAX_IMAGE_MB = float(os.environ.get("MEDIA_MAX_IMAGE_MB", "20"))  # 单张远程图片大小上限
+MEDIA_CACHE_MB = float(os.environ.get("MEDIA_CACHE_MB", "128"))  # 已转换图片的缓存上限
+MEDIA_ALLOW_PRIVATE = os.environ.get("MEDIA_ALLOW_PRIVATE", "false").lower() == "true"  # 允许下载内网地址的图片（仅本地调试）
+
+media_pipeline = MediaPipeline(
+    max_concurrency=MEDIA_FETCH_CONCURRENCY,
+    max_image_bytes=int(MEDIA_MAX_IMAGE_MB * 1024 * 1024),
+    cache_bytes=int(MEDIA_CACHE_MB * 1024 * 1024),
+    allow_private=MEDIA_ALLOW_PRIVATE,
+)
 
 # --- Vertex AI Client ---
 class AuthError(Exception):
@@ -216,48 +770,45 @@ class AuthError(Exception):
 
 class VertexAIClient:
     def __init__(self):
-        # Increase connection limits for concurrency
-        limits = httpx.Limits(max_keepalive_connections=20, max_connections=100)
-        self.client = httpx.AsyncClient(timeout=120.0, limits=limits)
+        self.upstream = UpstreamPool(
+            http2=UPSTREAM_HTTP2,
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive=UPSTREAM_MAX_KEEPALIVE,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+            connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+            read_timeout=UPSTREAM_READ_TIMEOUT,
+            write_timeout=UPSTREAM_WRITE_TIMEOUT,
+            pool_timeout=UPSTREAM_POOL_TIMEOUT,
+        )
+        self.client = self.upstream.client
 
     async def complete_chat(self, messages: List[Dict[str, str]], model: str, **kwargs) -> Dict[str, Any]:
-        """Aggregates the streaming response into a single non-streaming ChatCompletion object."""
+        """Aggregates the internal event stream into a single non-streaming ChatCompletion object."""
         
-        full_content = ""
-        reasoning_content = ""
+        content_parts: List[str] = []
+        reasoning_parts: List[str] = []
         finish_reason = "stop"
+        usage = Usage()
         
-        # Use the existing streaming logic to get chunks
-        async for chunk_data_sse in self.stream_chat(messages, model, **kwargs):
-            # SSE format: "data: {json_chunk}\n\n"
-            if chunk_data_sse.startswith("data: "):
-                json_str = chunk_data_sse[6:].strip()
-                if json_str == "[DONE]":
-                    continue
-                
-                try:
-                    chunk = json.loads(json_str)
-                    choices = chunk.get('choices', [])
-                    if choices:
-                        delta = choices[0].get('delta', {})
-                        
-                        # Aggregate content
-                        if 'content' in delta:
-                            full_content += delta['content']
-                        if 'reasoning_content' in delta:
-                            reasoning_content += delta['reasoning_content']
-                            
-                        # Capture finish reason from the last chunk
-                        if choices[0].get('finish_reason'):
-                            finish_reason = choices[0]['finish_reason']
-                            
-                except json.JSONDecodeError as e:
-                    print(f"Error decoding JSON chunk in complete_chat: {e}")
-                    # Continue to next chunk
+        # Consume typed events directly: no SSE encode/decode round-trip
+        async for event in self.iter_events(messages, model, **kwargs):
+            if isinstance(event, StreamError):
+                raise UpstreamStreamError(event)
+            if isinstance(event, Usage):
+                usage = event
+                continue
+            if event.content:
+                content_parts.append(event.content)
+            if event.reasoning_content:
+                reasoning_parts.append(event.reasoning_content)
+            # Capture finish reason from the last chunk
+            if event.finish_reason:
+                finish_reason = event.finish_reason
+        
+        full_content = "".join(content_parts)
+        reasoning_content = "".join(reasoning_parts)
                     
         # Construct the final non-streaming response
-        # Note: We are not calculating token usage here, as that requires more complex logic
-        # and is usually done by the upstream API. We will use placeholders.
         
         # Combine reasoning and content if reasoning exists
         final_content = full_content
@@ -273,11 +824,7 @@ class VertexAIClient:
             "object": "chat.completion",
             "created": int(time.time()),
             "model": model,
-            "usage": {
-                "prompt_tokens": 0, # Placeholder
-                "completion_tokens": 0, # Placeholder
-                "total_tokens": 0 # Placeholder
-            },
+            "usage": usage.to_openai(),
             "choices": [
                 {
                     "index": 0,
@@ -291,548 +838,631 @@ class VertexAIClient:
         }
         return response
 
-    async def stream_chat(self, messages: List[Dict[str, str]], model: str, **kwargs):
-        # 1. Check Credential Freshness & Auto-Refresh
-        # Vertex AI tokens typically last 1 hour. We'll refresh if older than 50 mins.
-        
-        # Use a lock to prevent multiple requests from triggering refresh simultaneously
-        if not cred_manager.latest_harvest or (time.time() - cred_manager.last_updated > 3000):
-            async with cred_manager.refresh_lock:
-                # Double check inside lock
-                should_refresh = False
-                if not cred_manager.latest_harvest:
-                    should_refresh = True
-                elif time.time() - cred_manager.last_updated > 3000:
-                    print("⚠️ Credentials are stale (>50 mins). Triggering pre-flight refresh...")
-                    should_refresh = True
-                
-                if should_refresh:
-                    # 根据模式选择刷新策略
-                    if BROWSER_MODE == "headful":
-                        await headful_browser_refresh()
-                    else:
-                        await request_token_refresh()
-                    
-                    # Wait for credentials (with a timeout)
-                    print("⏳ Waiting for fresh credentials...")
-                    refreshed = await cred_manager.wait_for_refresh(timeout=60)
-                    
-                    if refreshed:
-                        # Add 1 second delay after token is received and refresh_event is set
-                        await asyncio.sleep(1)
-                    
-                    if not refreshed and not cred_manager.latest_harvest:
-                        # Only fail if we have NO credentials at all.
-                        error_msg = "⚠️ **Proxy Error**: Could not refresh credentials.\n\nPlease ensure **Google Vertex AI Studio** is open in your browser and the Harvester script is active."
-                        chunk = {
-                            "id": "error-no-creds",
-                            "object": "chat.completion.chunk",
-                            "created": int(time.time()),
-                            "model": "vertex-ai-proxy",
-                            "choices": [{"index": 0, "delta": {"content": error_msg}, "finish_reason": "stop"}]
-                        }
-                        yield f"data: {json.dumps(chunk)}\n\n"
-                        yield "data: [DONE]\n\n"
-                        return
+    async def _convert_messages(self, messages: List[Dict[str, Any]],
+                                image_parts: Optional[Dict[str, Dict[str, Any]]] = None):
+        """
+        Converts OpenAI messages into Gemini (contents, system_instruction). Done once per request.
+        `image_parts` are images the endpoint already converted; otherwise they are fetched here.
 
-        # 4. Send Request (with Retry Logic)
-        max_retries = 1
-        content_yielded = False # Track if any content chunk was yielded
+        Raises:
+            MediaError: an image_url could not be fetched or decoded
+        """
+        if image_parts is None:
+            # Fetch / decode every image up front (remote ones concurrently, repeats only once)
+            image_urls = extract_image_urls(messages)
+            image_parts = await media_pipeline.convert(image_urls) if image_urls else {}
+
+        # Extract System Prompt
+        system_instruction = ""
+        chat_history = []
         
-        for attempt in range(max_retries + 1):
-            
-            creds = cred_manager.get_credentials()
-            # Double check in case refresh failed but we have old creds
-            if not creds:
-                # Should be handled above, but just in case
-                # If we are in a retry loop, this means refresh failed completely
-                if attempt > 0:
-                    break
-                return # Should not happen if pre-flight check passed
-
-            # 1. Prepare Request Data
-            original_body = json.loads(creds['body'])
-            
-            # Extract System Prompt
-            system_instruction = ""
-            chat_history = []
-            
-            for msg in messages:
-                if msg['role'] == 'system':
-                    system_instruction += msg['content'] + "\n"
-                elif msg['role'] == 'user':
-                    parts = []
-                    if isinstance(msg['content'], str):
-                        parts.append({"text": msg['content']})
-                    elif isinstance(msg['content'], list):
-                        for part in msg['content']:
-                            if part['type'] == 'text':
-                                parts.append({"text": part['text']})
-                            elif part['type'] == 'image_url':
-                                image_url = part['image_url']['url']
-                                if image_url.startswith('data:'):
-                                    # Extract base64 data
-                                    header, encoded = image_url.split(',', 1)
-                                    mime_type = header.split(':')[1].split(';')[0]
-                                    parts.append({
-                                        "inlineData": {
-                                            "mimeType": mime_type,
-                                            "data": encoded
-                                        }
-                                    })
-                    chat_history.append({"role": "user", "parts": parts})
-                elif msg['role'] == 'assistant':
-                    chat_history.append({"role": "model", "parts": [{"text": msg['content']}]})
-
-            # 2. Construct New Body
-            # We clone the harvested body structure to keep all the magic context/metadata
-            new_variables = original_body.get('variables', {}).copy()
-            
-            # Update contents (Chat History)
-            new_variables['contents'] = chat_history
-            
-            # Update System Instruction
-            if system_instruction:
-                new_variables['systemInstruction'] = {"parts": [{"text": system_instruction.strip()}]}
-
-            # Disable Safety Filters
-            new_variables['safetySettings'] = [
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_CIVIC_INTEGRITY", "threshold": "BLOCK_NONE"}
-            ]
-                
-            # Update Model
-            # Load model mapping from models.json
-            model_map = {}
-            try:
-                with open(MODELS_CONFIG_FILE, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
-                    model_map = config.get('alias_map', {})
-            except Exception as e:
-                print(f"⚠️ Error loading models.json: {e}")
+        for msg in messages:
+            if msg['role'] == 'system':
+                system_instruction += msg['content'] + "\n"
+            elif msg['role'] == 'user':
+                parts = []
+                if isinstance(msg['content'], str):
+                    parts.append({"text": msg['content']})
+                elif isinstance(msg['content'], list):
+                    for part in msg['content']:
+                        if part['type'] == 'text':
+                            parts.append({"text": part['text']})
+                        elif part['type'] == 'image_url':
+                            parts.append(image_parts[part['image_url']['url']])
+                chat_history.append({"role": "user", "parts": parts})
+            elif msg['role'] == 'assistant':
+                chat_history.append({"role": "model", "parts": [{"text": msg['content']}]})
+
+        return chat_history, system_instruction.strip()
+
+    def _prepare_request(self, template: RequestTemplate, route: ModelRoute, contents_json: bytes,
+                         system_instruction: str, model: str, kwargs: Dict[str, Any]):
+        """
+        Builds (url, headers, body bytes) for one upstream attempt from a compiled request template.
+        `contents_json` is serialised once per request and reused by every attempt.
+        """
+        # Update Model (pre-resolved alias / thinking / resolution routing)
+        target_model = route.target_model
+        thinking_mode = route.thinking_mode
+        image_size = route.image_size
 
-            target_model = model_map.get(model, model)
-            
-            # Handle suffixes for thinking and resolution
-            thinking_mode = None
-            resolution_mode = None
-            
-            if target_model.endswith("-low"):
-                target_model = target_model[:-4]
-                thinking_mode = "low"
-            elif target_model.endswith("-high"):
-                target_model = target_model[:-5]
-                thinking_mode = "high"
-                
-            if target_model.endswith("-1k"):
-                resolution_mode = "1k"
-                target_model = target_model[:-3]
-            elif target_model.endswith("-2k"):
-                resolution_mode = "2k"
-                target_model = target_model[:-3]
-            elif target_model.endswith("-4k"):
-                resolution_mode = "4k"
-                target_model = target_model[:-3]
-
-            print(f"🔄 Switching model to: {target_model} (requested: {model})")
-            new_variables['model'] = target_model
+        log.debug("🔄 Switching model to: %s (requested: %s)", target_model, model)
+        
+        # Apply generation parameters from client on a private copy of the harvested config
+        gen_config = template.new_generation_config()
+
+        # Handle Thinking Config
+        # Case 1: Explicit suffixes (-low, -high)
+        if thinking_mode:
+            gen_config['thinkingConfig'] = {"includeThoughts": True}
+            budget = route.thinking_budget
             
-            # Apply generation parameters from client
-            if 'generationConfig' not in new_variables:
-                new_variables['generationConfig'] = {}
+            gen_config['thinkingConfig']['budget_token_count'] = budget
+            gen_config['thinkingConfig']['thinkingBudget'] = budget
+            log.debug("ℹ️ Configured Thinking (Suffix): Mode=%s, Budget=%s", thinking_mode, budget)
+
+        # Case 2: No suffix, but client provided max_tokens (treat as thinking budget for 3-pro)
+        # Only applies if we haven't already set a thinking mode via suffix
+        elif 'gemini-3-pro' in target_model and 'max_tokens' in kwargs and kwargs['max_tokens'] is not None:
+            budget = int(kwargs['max_tokens'])
+            # Only enable thinking if budget is reasonable for thinking (e.g. > 1024)
+            # or if user explicitly wants it. Let's assume max_tokens on 3-pro implies thinking budget.
+            gen_config['thinkingConfig'] = {
+                "includeThoughts": True,
+                "budget_token_count": budget,
+                "thinkingBudget": budget
+            }
+            log.debug("ℹ️ Configured Thinking (Custom): Budget=%s", budget)
+        
+        # Handle Resolution (Image Generation)
+        if image_size:
+            # Ensure responseModalities includes IMAGE
+            if 'responseModalities' not in gen_config:
+                gen_config['responseModalities'] = ["TEXT", "IMAGE"]
+
+            if 'imageConfig' not in gen_config:
+                gen_config['imageConfig'] = {}
             
-            gen_config = new_variables['generationConfig']
-
-            # Handle Thinking Config
-            # Case 1: Explicit suffixes (-low, -high)
-            if thinking_mode:
-                gen_config['thinkingConfig'] = {"includeThoughts": True}
-                if thinking_mode == 'low':
-                     budget = 8192
-                elif thinking_mode == 'high':
-                     budget = 32768
-                
-                gen_config['thinkingConfig']['budget_token_count'] = budget
-                gen_config['thinkingConfig']['thinkingBudget'] = budget
-                print(f"ℹ️ Configured Thinking (Suffix): Mode={thinking_mode}, Budget={budget}")
-
-            # Case 2: No suffix, but client provided max_tokens (treat as thinking budget for 3-pro)
-            # Only applies if we haven't already set a thinking mode via suffix
-            elif 'gemini-3-pro' in target_model and 'max_tokens' in kwargs and kwargs['max_tokens'] is not None:
-                budget = int(kwargs['max_tokens'])
-                # Only enable thinking if budget is reasonable for thinking (e.g. > 1024)
-                # or if user explicitly wants it. Let's assume max_tokens on 3-pro implies thinking budget.
-                gen_config['thinkingConfig'] = {
-                    "includeThoughts": True,
-                    "budget_token_count": budget,
-                    "thinkingBudget": budget
-                }
-                print(f"ℹ️ Configured Thinking (Custom): Budget={budget}")
+            # Vertex AI imageSize strings, e.g. "imageSize": "4K"
+            gen_config['imageConfig']['imageSize'] = image_size
             
-            # Handle Resolution (Image Generation)
-            if resolution_mode:
-                # Ensure responseModalities includes IMAGE
-                if 'responseModalities' not in gen_config:
-                    gen_config['responseModalities'] = ["TEXT", "IMAGE"]
-
-                if 'imageConfig' not in gen_config:
-                    gen_config['imageConfig'] = {}
-                
-                # Map resolution mode to Vertex AI imageSize strings
-                # Based on logs: "imageSize": "4K"
-                size_str_map = {
-                    "1k": "1K", # Assumed based on 4K pattern
-                    "2k": "2K", # Assumed based on 4K pattern
-                    "4k": "4K"  # Confirmed from logs
-                }
-                
-                if resolution_mode in size_str_map:
-                    gen_config['imageConfig']['imageSize'] = size_str_map[resolution_mode]
-                    
-                    # Set other standard image generation parameters from logs
-                    gen_config['imageConfig']['personGeneration'] = "ALLOW_ALL"
-                    
-                    if 'imageOutputOptions' not in gen_config['imageConfig']:
-                        gen_config['imageConfig']['imageOutputOptions'] = {"mimeType": "image/png"}
-                    
-                    # Default to 1:1 if not specified, as resolution suffixes usually imply square
-                    if 'aspectRatio' not in gen_config['imageConfig']:
-                        gen_config['imageConfig']['aspectRatio'] = "1:1"
-                    
-                    print(f"ℹ️ Configured Image Generation: Size={gen_config['imageConfig'].get('imageSize')}, Ratio={gen_config['imageConfig'].get('aspectRatio')}")
+            # Set other standard image generation parameters from logs
+            gen_config['imageConfig']['personGeneration'] = "ALLOW_ALL"
             
-            # CLEANUP: Remove model-specific configurations that might cause conflicts
-            # If we switch models, old generation configs (like thinking) might be invalid.
+            if 'imageOutputOptions' not in gen_config['imageConfig']:
+                gen_config['imageConfig']['imageOutputOptions'] = {"mimeType": "image/png"}
             
-            # Remove 'thinkingConfig' if present, unless the model is explicitly a thinking model
-            if not thinking_mode:
-                gen_config.pop('thinkingConfig', None)
-                # Also check for snake_case just in case
-                gen_config.pop('thinking_config', None)
-
-            # Remove 'imageConfig' if NOT an image model (to be safe)
-            if not resolution_mode:
-                gen_config.pop('imageConfig', None)
-                gen_config.pop('sampleImageSize', None)
-                gen_config.pop('width', None)
-                gen_config.pop('height', None)
+            # Default to 1:1 if not specified, as resolution suffixes usually imply square
+            if 'aspectRatio' not in gen_config['imageConfig']:
+                gen_config['imageConfig']['aspectRatio'] = "1:1"
             
-            # Note: The exact field name might be 'thinkingConfig' or inside 'generationConfig'
-            # Based on common Vertex AI payloads, let's check 'generationConfig'
+            log.debug("ℹ️ Configured Image Generation: Size=%s, Ratio=%s", image_size, gen_config['imageConfig'].get('aspectRatio'))
+        
+        # CLEANUP: Remove model-specific configurations that might cause conflicts
+        # If we switch models, old generation configs (like thinking) might be invalid.
+        
+        # Remove 'thinkingConfig' if present, unless the model is explicitly a thinking model
+        if not thinking_mode:
+            gen_config.pop('thinkingConfig', None)
+            # Also check for snake_case just in case
+            gen_config.pop('thinking_config', None)
+
+        # Remove 'imageConfig' if NOT an image model (to be safe)
+        if not image_size:
+            gen_config.pop('imageConfig', None)
+            gen_config.pop('sampleImageSize', None)
+            gen_config.pop('width', None)
+            gen_config.pop('height', None)
+        
+        # Note: The exact field name might be 'thinkingConfig' or inside 'generationConfig'
+        # Based on common Vertex AI payloads, let's check 'generationConfig'
+        
+        # Fix maxOutputTokens
+        # Allow client to override max_tokens, otherwise default to harvested value or 65535
+        # client_max_tokens = original_body.get('variables', {}).get('generationConfig', {}).get('maxOutputTokens')
+        
+        # Check if client provided max_tokens in the request body (OpenAI format)
+        # Note: 'original_body' here is the harvested body. We need to check the incoming 'messages' or 'body' from the request.
+        # But wait, 'stream_chat' doesn't receive the full request body, only 'messages' and 'model'.
+        # Let's assume we want to restore the high limit.
+        
+        if isinstance(gen_config, dict):
+            # Restore high limit or use a safe default
+            # If the harvested token had a value, we keep it (unless we want to force it)
+            # User requested to put it back to 65535
+            if 'maxOutputTokens' in gen_config:
+                # Ensure it's at least 8192 if it was lowered, or just set to 65535 if missing/low
+                if gen_config['maxOutputTokens'] < 8192:
+                        gen_config['maxOutputTokens'] = 65535
+            else:
+                gen_config['maxOutputTokens'] = 65535
+        
+        if 'temperature' in kwargs and kwargs['temperature'] is not None:
+            gen_config['temperature'] = float(kwargs['temperature'])
+            log.debug("ℹ️ Set temperature: %s", gen_config['temperature'])
             
-            # Fix maxOutputTokens
-            # Allow client to override max_tokens, otherwise default to harvested value or 65535
-            # client_max_tokens = original_body.get('variables', {}).get('generationConfig', {}).get('maxOutputTokens')
+        if 'top_p' in kwargs and kwargs['top_p'] is not None:
+            gen_config['topP'] = float(kwargs['top_p'])
+            log.debug("ℹ️ Set topP: %s", gen_config['topP'])
             
-            # Check if client provided max_tokens in the request body (OpenAI format)
-            # Note: 'original_body' here is the harvested body. We need to check the incoming 'messages' or 'body' from the request.
-            # But wait, 'stream_chat' doesn't receive the full request body, only 'messages' and 'model'.
-            # Let's assume we want to restore the high limit.
+        if 'top_k' in kwargs and kwargs['top_k'] is not None:
+            gen_config['topK'] = int(kwargs['top_k'])
+            log.debug("ℹ️ Set topK: %s", gen_config['topK'])
             
-            if isinstance(gen_config, dict):
-                # Restore high limit or use a safe default
-                # If the harvested token had a value, we keep it (unless we want to force it)
-                # User requested to put it back to 65535
-                if 'maxOutputTokens' in gen_config:
-                    # Ensure it's at least 8192 if it was lowered, or just set to 65535 if missing/low
-                    if gen_config['maxOutputTokens'] < 8192:
-                            gen_config['maxOutputTokens'] = 65535
-                else:
-                    gen_config['maxOutputTokens'] = 65535
+        if 'max_tokens' in kwargs and kwargs['max_tokens'] is not None:
+            gen_config['maxOutputTokens'] = int(kwargs['max_tokens'])
+            log.debug("ℹ️ Set maxOutputTokens: %s", gen_config['maxOutputTokens'])
             
-            if 'temperature' in kwargs and kwargs['temperature'] is not None:
-                gen_config['temperature'] = float(kwargs['temperature'])
-                print(f"ℹ️ Set temperature: {gen_config['temperature']}")
-                
-            if 'top_p' in kwargs and kwargs['top_p'] is not None:
-                gen_config['topP'] = float(kwargs['top_p'])
-                print(f"ℹ️ Set topP: {gen_config['topP']}")
-                
-            if 'top_k' in kwargs and kwargs['top_k'] is not None:
-                gen_config['topK'] = int(kwargs['top_k'])
-                print(f"ℹ️ Set topK: {gen_config['topK']}")
-                
-            if 'max_tokens' in kwargs and kwargs['max_tokens'] is not None:
-                gen_config['maxOutputTokens'] = int(kwargs['max_tokens'])
-                print(f"ℹ️ Set maxOutputTokens: {gen_config['maxOutputTokens']}")
-                
-            if 'stop' in kwargs and kwargs['stop'] is not None:
-                gen_config['stopSequences'] = kwargs['stop'] if isinstance(kwargs['stop'], list) else [kwargs['stop']]
-                print(f"ℹ️ Set stopSequences: {gen_config['stopSequences']}")
-
-            # DEBUG: Print all generation config parameters for inspection
-            if resolution_mode or thinking_mode:
-                print("\n🔍 --- DEBUG: Generation Config Parameters ---")
-                print(json.dumps(gen_config, indent=2))
-                print("---------------------------------------------\n")
-
-            # Reassemble body
-            new_body = {
-                "querySignature": original_body.get('querySignature'), # Might need this?
-                "operationName": original_body.get('operationName'),
-                "variables": new_variables
+        if 'stop' in kwargs and kwargs['stop'] is not None:
+            gen_config['stopSequences'] = kwargs['stop'] if isinstance(kwargs['stop'], list) else [kwargs['stop']]
+            log.debug("ℹ️ Set stopSequences: %s", gen_config['stopSequences'])
+
+        # DEBUG: Log all generation config parameters for inspection
+        if image_size or thinking_mode:
+            log.debug("🔍 Generation Config Parameters: %s", LazyJSON(gen_config))
+
+        # Assemble body from the template (keeps all the magic context/metadata)
+        new_body = template.build_body_bytes(contents_json, system_instruction, target_model, gen_config)
+        url = template.url
+        headers = template.headers
+        return url, headers, new_body
+
+    async def stream_chat(self, messages: List[Dict[str, str]], model: str, include_usage: bool = False, **kwargs):
+        """Encodes the internal event stream as OpenAI-compatible SSE."""
+        # One id / timestamp per response, as OpenAI does
+        chunk_id = f"chatcmpl-proxy-{uuid.uuid4()}"
+        created = int(time.time())
+        
+        async for event in self.iter_events(messages, model, **kwargs):
+            if isinstance(event, StreamError):
+                error_payload = {"error": {"message": event.message, "type": event.type}}
+                yield f"data: {json.dumps(error_payload)}\n\n"
+                return # Stop the stream on fatal error
+            if isinstance(event, Usage):
+                # stream_options.include_usage: one extra chunk with empty choices before [DONE]
+                if include_usage:
+                    chunk = {
+                        "id": chunk_id,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": model,
+                        "choices": [],
+                        "usage": event.to_openai()
+                    }
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                continue
+            chunk = {
+                "id": chunk_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": event.to_openai(), "finish_reason": event.finish_reason}]
             }
+            yield f"data: {json.dumps(chunk)}\n\n"
+        
+        # Ensure the stream is properly terminated with [DONE]
+        yield "data: [DONE]\n\n"
+
+    async def _send_stream(self, slot: CredentialSlot, url: str, headers: Dict[str, str],
+                           body: bytes) -> UpstreamStream:
+        """Opens the upstream stream and, on 200, reads until the first JSON element arrives."""
+        stream = UpstreamStream(slot, self.upstream.stream('POST', url, headers=headers, content=body))
+        try:
+            try:
+                await stream.open()
+            except httpx.PoolTimeout:
+                UPSTREAM_POOL_TIMEOUTS.inc()
+                log.warning("⚠️ Upstream connection pool saturated (%d in flight)", self.upstream.in_flight)
+                raise
+            log.debug("📡 Response Status: %d (slot: %s)", stream.response.status_code, slot.slot_id)
+            if stream.ok:
+                await stream.read_first()
+        except BaseException:
+            await stream.aclose()
+            raise
+        return stream
+
+    def _start_hedge(self, slot: CredentialSlot, route: ModelRoute, contents_json: bytes,
+                     system_instruction: Optional[str], model: str,
+                     kwargs: Dict[str, Any]) -> Optional[Tuple[CredentialSlot, "asyncio.Task"]]:
+        """Duplicates the request onto another healthy slot, if the budget and the pool allow it."""
+        if not hedge_policy.try_hedge():
+            return None
+        backup = cred_manager.acquire(exclude=(slot.slot_id,))
+        if backup is not None and not backup.is_available(time.time()):
+            cred_manager.release(backup, False, cancelled=True)
+            backup = None
+        if backup is not None and admission.enabled and backup.in_flight > ADMISSION_PER_CREDENTIAL:
+            # A hedge must not push the backup slot past its concurrency cap
+            cred_manager.release(backup, False, cancelled=True)
+            backup = None
+        if backup is not None and rate_limiter.delay(route.target_model, backup.slot_id) > 0:
+            # Hedging onto a slot that is being paced would only spend its quota
+            cred_manager.release(backup, False, cancelled=True)
+            backup = None
+        if backup is None:
+            hedge_policy.stats["no_slot"] += 1
+            return None
+        try:
+            url, headers, body = self._prepare_request(backup.template, route, contents_json, system_instruction, model, kwargs)
+        except Exception as e:
+            log.warning("⚠️ Could not prepare hedged request on slot %s: %s", backup.slot_id, e)
+            cred_manager.release(backup, False, cancelled=True)
+            return None
+        rate_limiter.take(route.target_model, backup.slot_id)
+        hedge_policy.stats["hedges"] += 1
+        log.info("🪁 Slow upstream on slot %s, hedging onto slot %s", slot.slot_id, backup.slot_id)
+        return backup, asyncio.create_task(self._send_stream(backup, url, headers, body))
+
+    async def _discard_stream(self, task: "asyncio.Task", slot: CredentialSlot, release: bool = True):
+        """Closes the losing side of a hedged request (already cancelled) and returns its slot."""
+        try:
+            stream = await task
+            await stream.aclose()
+        except (asyncio.CancelledError, Exception):
+            pass
+        finally:
+            if release:
+                cred_manager.release(slot, False, cancelled=True)
+
+    async def _open_stream(self, slot: CredentialSlot, request: Tuple[str, Dict[str, str], bytes],
+                           route: ModelRoute, contents_json: bytes,
+                           system_instruction: Optional[str], model: str,
+                           kwargs: Dict[str, Any]) -> UpstreamStream:
+        """
+        Sends the prepared request on `slot`. With hedging enabled, a request that has not
+        produced its first element by the hedge deadline is duplicated onto a second slot;
+        the first stream with content wins and the other one is cancelled.
+
+        The returned stream's slot is the one the caller now owns. When neither side
+        produces content, the primary's outcome (response or exception) is returned as-is.
+        """
+        started = time.monotonic()
+        hedge_policy.on_request()
+        if not hedge_policy.enabled:
+            stream = await self._send_stream(slot, *request)
+            if stream.ttfb is not None:
+                hedge_policy.record_ttfb(stream.ttfb)
+            return stream
+
+        primary = asyncio.create_task(self._send_stream(slot, *request))
+        tasks = {primary: slot}
+        winner = None
+        try:
+            done, pending = await asyncio.wait({primary}, timeout=hedge_policy.deadline())
+            if pending:
+                hedge = self._start_hedge(slot, route, contents_json, system_instruction, model, kwargs)
+                if hedge is not None:
+                    backup, task = hedge
+                    tasks[task] = backup
+                    pending.add(task)
+            while True:
+                for task in done:
+                    if not task.exception() and task.result().ttfb is not None:
+                        winner = task
+                        break
+                if winner is not None or not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if winner is None:
+                winner = primary  # Neither side produced content; let the caller handle the primary's outcome
+            elif winner is not primary:
+                hedge_policy.stats["hedge_wins"] += 1
+            if winner.exception() is None and winner.result().ttfb is not None:
+                hedge_policy.record_ttfb(time.monotonic() - started)
+            return winner.result()
+        finally:
+            for task, task_slot in tasks.items():
+                if task is winner:
+                    continue
+                task.cancel()
+                # Interrupted before a winner was chosen: the caller still owns the primary slot
+                owned_by_caller = task is primary and winner is None
+                asyncio.create_task(self._discard_stream(task, task_slot, release=not owned_by_caller))
+
+    async def iter_events(self, messages: List[Dict[str, str]], model: str, cache_key: Optional[str] = None,
+                          cached_events: Optional[List[Union[ChatDelta, Usage]]] = None,
+                          **kwargs) -> AsyncIterator[Union[ChatDelta, Usage, StreamError]]:
+        """
+        Runs the upstream request (with refresh / retry) and yields typed events.
+
+        `cached_events` (a response cache hit) are replayed without contacting upstream;
+        with `cache_key`, a response that completes normally is stored under that key.
+        """
+        if cached_events is not None:
+            for event in cached_events:
+                yield event
+            REQUESTS_TOTAL.inc(model=model_registry.metric_label(model), mode=BROWSER_MODE, outcome="cached")
+            return
+
+        started = time.monotonic()
+        outcome = "cancelled"
+        first_delta = False
+        # Only upstream responses end with Usage; proxy-generated messages (e.g. the
+        # "could not refresh credentials" notice) must never count as ok or be cached.
+        from_upstream = False
+        recorded: Optional[List[Union[ChatDelta, Usage]]] = [] if cache_key else None
+        events = self._iter_events(messages, model, started, **kwargs)
+        try:
+            async for event in events:
+                if isinstance(event, StreamError):
+                    outcome = "error"
+                elif isinstance(event, Usage):
+                    from_upstream = True
+                elif not first_delta and isinstance(event, ChatDelta):
+                    first_delta = True
+                    observe_phase("first_delta", model, time.monotonic() - started)
+                if recorded is not None:
+                    recorded.append(event)
+                yield event
+            if outcome != "error":
+                if not first_delta:
+                    outcome = "empty"
+                else:
+                    outcome = "ok" if from_upstream else "error"
+            if outcome == "ok" and recorded is not None:
+                await response_cache.put(cache_key, recorded)
+        finally:
+            # Close the inner generator explicitly so its slot release runs now, not at GC time
+            await events.aclose()
+            observe_phase("total", model, time.monotonic() - started)
+            REQUESTS_TOTAL.inc(model=model_registry.metric_label(model), mode=BROWSER_MODE, outcome=outcome)
+
+    async def _refresh_and_wait(self, model: str, reason: str, timeout: float, seen_generation: int,
+                                wait_ui: bool = False) -> bool:
+        """refresh_coordinator.refresh() that records how long the request was held up."""
+        wait_started = time.monotonic()
+        try:
+            return await refresh_coordinator.refresh(reason, timeout=timeout, seen_generation=seen_generation, wait_ui=wait_ui)
+        finally:
+            observe_phase("refresh_wait", model, time.monotonic() - wait_started)
+
+    async def _iter_events(self, messages: List[Dict[str, str]], model: str, started: float,
+                           image_parts: Optional[Dict[str, Dict[str, Any]]] = None,
+                           **kwargs) -> AsyncIterator[Union[ChatDelta, Usage, StreamError]]:
+        # 1. Check Credential Freshness & Auto-Refresh
+        # Vertex AI tokens typically last 1 hour. We'll refresh if older than 50 mins.
+        
+        # Requests only block when there is no usable credential at all; a stale-but-valid
+        # credential is used as-is while a refresh runs in the background.
+        age = time.time() - cred_manager.last_updated
+        if cred_manager.latest_harvest and 3000 < age <= CREDENTIAL_MAX_AGE:
+            if not refresh_coordinator.in_progress:
+                log.warning("⚠️ Credentials are stale (>50 mins). Refreshing in background...")
+                refresh_coordinator.refresh_in_background("stale")
+        elif not cred_manager.latest_harvest or age > CREDENTIAL_MAX_AGE:
+            if cred_manager.latest_harvest:
+                log.warning("⚠️ Credentials expired (>60 mins). Triggering pre-flight refresh...")
+            seen_generation = cred_manager.generation
             
-            # 3. Prepare Headers
-            headers = creds['headers'].copy() # Copy to avoid mutating the cached credentials
+            # Wait for credentials (with a timeout)
+            log.info("⏳ Waiting for fresh credentials...")
+            refreshed = await self._refresh_and_wait(model, "preflight", 60, seen_generation)
             
-            # Ensure critical headers are present and correct
-            # Note: 'Cookie', 'User-Agent', 'Origin', 'Referer' should now be in creds['headers'] from the harvester
+            if not refreshed and not cred_manager.latest_harvest:
+                # Only fail if we have NO credentials at all.
+                error_msg = "⚠️ **Proxy Error**: Could not refresh credentials.\n\nPlease ensure **Google Vertex AI Studio** is open in your browser and the Harvester script is active."
+                yield ChatDelta(content=error_msg, finish_reason="stop")
+                return
+
+        observe_phase("preflight", model, time.monotonic() - started)
+
+        # Resolve model routing and convert messages once per request (not per attempt)
+        build_started = time.monotonic()
+        route = model_registry.resolve(model)
+        try:
+            contents, system_instruction = await self._convert_messages(messages, image_parts)
+        except MediaError as e:
+            log.warning("⚠️ Rejected request image: %s", e)
+            yield StreamError(str(e), "invalid_request_error")
+            return
+        contents_json = serialize_contents(contents)
+        convert_time = time.monotonic() - build_started
+
+        # 4. Send Request (with Retry Logic)
+        # With a credential pool, an exhausted slot can be retried on another slot
+        max_retries = max(1, len(cred_manager.slots))
+        content_yielded = False # Track if any content chunk was yielded
+        usage_tracker = None
+        
+        for attempt in range(max_retries + 1):
             
-            headers['content-type'] = 'application/json'
+            # Prefer slots whose learned quota allows a request right now
+            throttled = rate_limiter.throttled(route.target_model, cred_manager.slots)
+            slot = (throttled and cred_manager.acquire(exclude=throttled)) or cred_manager.acquire()
+            # Double check in case refresh failed but we have old creds
+            if not slot:
+                # Should be handled above, but just in case
+                # If we are in a retry loop, this means refresh failed completely
+                if attempt > 0:
+                    break
+                return # Should not happen if pre-flight check passed
             
-            # Remove headers that httpx/network layer should handle or that might cause conflicts
-            headers.pop('content-length', None)
-            headers.pop('Content-Length', None)
-            headers.pop('host', None)
-            headers.pop('Host', None)
-            headers.pop('connection', None)
-            headers.pop('Connection', None)
-            headers.pop('accept-encoding', None) # Let httpx handle decompression
-
-            url = creds['url']
+            # Generation of the credentials this attempt uses; lets a failed attempt
+            # notice that another request has already refreshed them.
+            attempt_generation = cred_manager.generation
             
-            print(f"🚀 Sending request to Google Vertex AI (Attempt {attempt+1})...")
+            # Outcome reported back to the pool when this attempt ends (however it ends)
+            slot_ok = False
+            slot_exhausted = False
             try:
-                # Use a try-finally block to ensure we handle cancellation if needed,
-                # though async with handles cleanup automatically.
-                async with self.client.stream('POST', url, headers=headers, json=new_body) as response:
-                    print(f"📡 Response Status: {response.status_code}")
-                    
-                    if response.status_code != 200:
-                        error_text = await response.aread()
-                        error_text_str = error_text.decode() if isinstance(error_text, bytes) else str(error_text)
-                        print(f"❌ Google API Error: {response.status_code} - {error_text_str}")
-                        
-                        # 检测需要刷新凭证的错误模式
-                        should_refresh = False
-                        if response.status_code in [400, 401, 403]:
-                            should_refresh = True
-                        elif any(pattern in error_text_str for pattern in [
-                            "Resource exhausted",
-                            "Timed out waiting for credentials",
-                            "Credential refresh timed out",
-                            "Recaptcha token is invalid"
-                        ]):
-                            should_refresh = True
-                        
-                        # Check for potential token expiration or specific error patterns
-                        if should_refresh and attempt < max_retries:
-                            print(f"⚠️ 检测到需要刷新凭证的错误，触发刷新...")
+                paced = await rate_limiter.acquire(route.target_model, slot.slot_id)
+                if paced:
+                    observe_phase("pace", model, paced)
+
+                build_started = time.monotonic()
+                url, headers, new_body = self._prepare_request(slot.template, route, contents_json, system_instruction, model, kwargs)
+                observe_phase("build", model, convert_time + time.monotonic() - build_started)
+                convert_time = 0.0  # Retries only rebuild the body, not the converted messages
+                
+                log.info("🚀 Sending request to Google Vertex AI (model: %s, attempt %d, slot: %s)", route.target_model, attempt + 1, slot.slot_id)
+                try:
+                    # With hedging enabled the stream may come back on a different slot;
+                    # from here on this attempt owns (and releases) that slot instead.
+                    stream = await self._open_stream(slot, (url, headers, new_body), route, contents_json,
+                                                     system_instruction, model, kwargs)
+                    slot = stream.slot
+                    observe_phase("connect", model, stream.connect_time)
+                    if stream.first_byte is not None:
+                        observe_phase("ttfb", model, stream.first_byte)
+                    async with stream as response:
+                        if response.status_code != 200:
+                            error_text = await response.aread()
+                            error_text_str = error_text.decode() if isinstance(error_text, bytes) else str(error_text)
+                            log.error("❌ Google API Error: %d - %s", response.status_code, error_text_str)
                             
-                            # 根据模式选择刷新策略
-                            if BROWSER_MODE == "headful":
-                                await headful_browser_refresh()
-                            else:
-                                await request_token_refresh()
+                            slot_exhausted = response.status_code == 429 or "Resource exhausted" in error_text_str
                             
-                            # Wait for new credentials
-                            refreshed = await cred_manager.wait_for_refresh(timeout=45)
-                            if refreshed:
-                                print("✅ Credentials refreshed! Waiting 1s before retrying request...")
-                                await asyncio.sleep(1) # Add 1 second delay
-                                # Update headers/url with new credentials
-                                new_creds = cred_manager.get_credentials()
-                                headers = new_creds['headers'].copy()
-                                headers['content-type'] = 'application/json'
-                                headers.pop('content-length', None)
-                                headers.pop('host', None)
-                                url = new_creds['url']
-                                continue # Retry loop
-                            else:
-                                print("❌ Refresh timed out.")
-                        
-                        # If we get here, it's a fatal error or retry failed
-                        error_payload = {"error": {"message": f"Upstream Error: {response.status_code} - {error_text_str}", "type": "upstream_error"}}
-                        yield f"data: {json.dumps(error_payload)}\n\n"
-                        return
-
-                    buffer = ""
-                    chunk_count = 0
-                    
-                    # ... (Stream processing logic) ...
-                    # We need to handle the stream inside the loop, but if it fails mid-stream due to auth (rare for 200 OK), we can't easily retry.
-                    # However, we handled the "200 OK but error inside JSON" case before. We need to adapt that too.
-                    
-                    async for chunk in response.aiter_text():
-                        chunk_count += 1
-                        buffer += chunk
-                        
-                        while buffer:
-                            # Skip whitespace
-                            buffer = buffer.lstrip()
-                            if not buffer:
-                                break
-                                
-                            # Handle Google's JSON array format [obj, obj, ...]
-                            if buffer.startswith('['):
-                                buffer = buffer[1:]
-                                continue
-                            if buffer.startswith(','):
-                                buffer = buffer[1:]
-                                continue
-                            if buffer.startswith(']'):
-                                buffer = buffer[1:]
+                            # 检测需要刷新凭证的错误模式
+                            should_refresh = False
+                            if response.status_code in [400, 401, 403]:
+                                should_refresh = True
+                            elif any(pattern in error_text_str for pattern in [
+                                "Resource exhausted",
+                                "Timed out waiting for credentials",
+                                "Credential refresh timed out",
+                                "Recaptcha token is invalid"
+                            ]):
+                                should_refresh = True
+                            
+                            if slot_exhausted and attempt < max_retries and cred_manager.available_count(exclude=(slot.slot_id,)):
+                                log.warning("🔀 配额耗尽，切换到其他凭证槽位重试...")
+                                RETRIES_TOTAL.inc(model=model_registry.metric_label(model), reason="exhausted")
                                 continue
-
-                            try:
-                                decoder = json.JSONDecoder()
-                                obj, idx = decoder.raw_decode(buffer)
-                                
-                                for chunk_data in self.process_google_response(obj):
-                                    yield chunk_data
-                                    content_yielded = True # Mark that content was successfully yielded
-                                
-                                buffer = buffer[idx:]
-                            except json.JSONDecodeError:
-                                # Incomplete JSON, wait for more data
-                                break
-                            except AuthError as e:
-                                raise e # Re-raise to be caught by the outer try-except
-                            except Exception as e:
-                                print(f"Error parsing stream chunk: {e}")
-                                # Log the start of the buffer to debug unexpected characters
-                                print(f"🐛 Debug Buffer (Start): {buffer[:100].strip()}")
-                                
-                                # Aggressive skip: Find the next JSON start character
-                                next_json_start = -1
-                                for char in ['[', '{']:
-                                    try:
-                                        idx = buffer.index(char)
-                                        if next_json_start == -1 or idx < next_json_start:
-                                            next_json_start = idx
-                                    except ValueError:
-                                        pass
+                            
+                            # Check for potential token expiration or specific error patterns
+                            if should_refresh and attempt < max_retries:
+                                log.warning("⚠️ 检测到需要刷新凭证的错误，触发刷新...")
                                 
-                                if next_json_start != -1:
-                                    print(f"⚠️ Skipping {next_json_start} non-JSON characters.")
-                                    buffer = buffer[next_json_start:]
+                                # Wait for new credentials
+                                refreshed = await self._refresh_and_wait(
+                                    model, f"upstream {response.status_code}", 45, attempt_generation)
+                                if refreshed:
+                                    log.info("✅ Credentials refreshed! Retrying request...")
+                                    RETRIES_TOTAL.inc(model=model_registry.metric_label(model), reason="refreshed")
+                                    continue # Retry loop with the refreshed credentials
                                 else:
-                                    # If no JSON start found, skip one char to avoid infinite loop
-                                    buffer = buffer[1:]
-                    
-                    # If we successfully processed the stream, break the retry loop
-                    break
+                                    log.error("❌ Refresh timed out.")
+                            
+                            # If we get here, it's a fatal error or retry failed
+                            yield StreamError(f"Upstream Error: {response.status_code} - {error_text_str}", "upstream_error")
+                            return
 
-            except AuthError as e:
-                print(f"⚠️ Auth Error caught in stream: {e}")
-                if attempt < max_retries:
-                    print("🔄 Triggering refresh and retrying...")
-                    if BROWSER_MODE == "headful":
-                        await headful_browser_refresh()
-                    else:
-                        await request_token_refresh()
-                    # Step 1: Wait for the new credentials to be harvested
-                    refreshed = await cred_manager.wait_for_refresh(timeout=60)
-                    if refreshed:
-                        # Step 2: Wait for the frontend to confirm the UI is stable
-                        ui_ready = await cred_manager.wait_for_refresh_complete(timeout=60)
-                        if ui_ready:
-                            print("✅ Credentials and UI ready! Waiting 1s before retrying request...")
-                            await asyncio.sleep(1) # Add 1 second delay
-                            # Update headers/url with new credentials
-                            new_creds = cred_manager.get_credentials()
-                            headers = new_creds['headers'].copy()
-                            headers['content-type'] = 'application/json'
-                            headers.pop('content-length', None)
-                            headers.pop('host', None)
-                            url = new_creds['url']
+                        usage_tracker = UsageTracker() # Only the attempt that streams counts
+                        
+                        # Google returns a JSON array [obj, obj, ...] streamed in arbitrary byte chunks.
+                        # The parser splits top-level elements incrementally and decodes each one exactly once.
+                        async for obj in stream.objects():
+                            for event in self.process_google_response(obj, usage_tracker):
+                                yield event
+                                content_yielded = True # Mark that content was successfully yielded
+                        
+                        if stream.parser.pending_bytes:
+                            log.warning("⚠️ Stream ended with %d bytes of incomplete JSON.", stream.parser.pending_bytes)
+                        
+                        # If we successfully processed the stream, break the retry loop
+                        slot_ok = content_yielded
+                        break
+
+                except AuthError as e:
+                    log.warning("⚠️ Auth Error caught in stream: %s", e)
+                    slot_exhausted = "Resource exhausted" in str(e)
+                    # Only retry before the first byte reached the client; afterwards a retry
+                    # would replay content the client already received.
+                    if attempt < max_retries and not content_yielded:
+                        if slot_exhausted and cred_manager.available_count(exclude=(slot.slot_id,)):
+                            log.warning("🔀 配额耗尽，切换到其他凭证槽位重试...")
+                            RETRIES_TOTAL.inc(model=model_registry.metric_label(model), reason="exhausted")
+                            continue
+                        log.info("🔄 Triggering refresh and retrying...")
+                        # Wait for the new credentials and for the frontend to confirm the UI is stable
+                        refreshed = await self._refresh_and_wait(
+                            model, "auth error", 60, attempt_generation, wait_ui=True)
+                        if refreshed:
+                            log.info("✅ Credentials and UI ready! Retrying request...")
+                            RETRIES_TOTAL.inc(model=model_registry.metric_label(model), reason="refreshed")
                             continue # Retry the request
                         else:
-                            print("❌ Frontend UI did not become ready in time.")
-                    else:
-                        print("❌ Credential refresh timed out.")
+                            log.error("❌ Credential refresh timed out.")
 
-                error_payload = {"error": {"message": str(e), "type": "authentication_error"}}
-                yield f"data: {json.dumps(error_payload)}\n\n"
-                return
+                    yield StreamError(str(e), "authentication_error")
+                    return
 
-            except Exception as e:
-                error_msg = str(e)
-                print(f"❌ Request failed: {error_msg}")
-                
-                # 检测是否是需要刷新凭证的错误
-                should_refresh = any(pattern in error_msg for pattern in [
-                    "Timed out waiting for credentials",
-                    "Credential refresh timed out",
-                    "Resource exhausted",
-                    "Recaptcha token is invalid"
-                ])
-                
-                if should_refresh and attempt < max_retries:
-                    print(f"⚠️ 检测到凭证相关错误，触发刷新...")
-                    try:
-                        # 根据模式选择刷新策略
-                        if BROWSER_MODE == "headful":
-                            await headful_browser_refresh()
-                        else:
-                            await request_token_refresh()
-                        
+                except Exception as e:
+                    error_msg = str(e)
+                    log.error("❌ Request failed: %s", error_msg)
+                    slot_exhausted = "Resource exhausted" in error_msg
+                    
+                    # 检测是否是需要刷新凭证的错误
+                    should_refresh = any(pattern in error_msg for pattern in [
+                        "Timed out waiting for credentials",
+                        "Credential refresh timed out",
+                        "Resource exhausted",
+                        "Recaptcha token is invalid"
+                    ])
+                    
+                    if slot_exhausted and attempt < max_retries and not content_yielded \
+                            and cred_manager.available_count(exclude=(slot.slot_id,)):
+                        log.warning("🔀 配额耗尽，切换到其他凭证槽位重试...")
+                        RETRIES_TOTAL.inc(model=model_registry.metric_label(model), reason="exhausted")
+                        continue
+                    
+                    if should_refresh and attempt < max_retries and not content_yielded:
+                        log.warning("⚠️ 检测到凭证相关错误，触发刷新...")
                         # Wait for new credentials
-                        refreshed = await cred_manager.wait_for_refresh(timeout=45)
+                        refreshed = await self._refresh_and_wait(
+                            model, "request error", 45, attempt_generation)
                         if refreshed:
-                            print("✅ Credentials refreshed! Waiting 1s before retrying request...")
-                            await asyncio.sleep(1) # Add 1 second delay
-                            # Update headers/url with new credentials
-                            new_creds = cred_manager.get_credentials()
-                            headers = new_creds['headers'].copy()
-                            headers['content-type'] = 'application/json'
-                            headers.pop('content-length', None)
-                            headers.pop('host', None)
-                            url = new_creds['url']
-                            continue # Retry loop
+                            log.info("✅ Credentials refreshed! Retrying request...")
+                            RETRIES_TOTAL.inc(model=model_registry.metric_label(model), reason="refreshed")
+                            continue # Retry loop with the refreshed credentials
                         else:
-                            print("❌ Refresh timed out.")
-                    except Exception as refresh_error:
-                        print(f"❌ 凭证刷新失败: {refresh_error}")
-                
-                if attempt < max_retries:
-                    continue
+                            log.error("❌ Refresh timed out.")
                     
-                error_payload = {"error": {"message": error_msg, "type": "request_error"}}
-                yield f"data: {json.dumps(error_payload)}\n\n"
-                return # Stop generator on fatal error
+                    if attempt < max_retries and not content_yielded:
+                        RETRIES_TOTAL.inc(model=model_registry.metric_label(model), reason="error")
+                        continue
+                        
+                    # Surface the failure in-band: the response status has already been sent
+                    yield StreamError(error_msg, "request_error")
+                    return # Stop generator on fatal error
+            finally:
+                cred_manager.release(slot, slot_ok, slot_exhausted)
+                rate_limiter.record(route.target_model, slot.slot_id, slot_ok, slot_exhausted)
+                proactive_refresher.record_result(slot_ok)
+                # The hub runs the proactive refresher in multi-worker mode; it needs every outcome
+                forward_to_hub({"type": "result", "ok": slot_ok})
         
         # If we exit the loop without returning, it means we successfully processed the stream.
         
+        if content_yielded and usage_tracker is not None:
+            usage = usage_tracker.result(contents, system_instruction)
+            await record_token_usage(model, usage.prompt_tokens, usage.completion_tokens)
+            yield usage
+        
         if not content_yielded:
             # If the stream finished but yielded no content, log a warning and trigger refresh.
-            print("⚠️ Proxy Warning: Google API returned an empty stream (200 OK but no content).")
+            log.warning("⚠️ Proxy Warning: Google API returned an empty stream (200 OK but no content).")
             
-            # 检测到空流时触发凭证刷新
-            print("🔄 检测到空流，触发凭证刷新...")
-            try:
-                if BROWSER_MODE == "headful":
-                    await headful_browser_refresh()
-                else:
-                    await request_token_refresh()
-                
-                # 等待凭证刷新
-                refreshed = await cred_manager.wait_for_refresh(timeout=60)
-                if refreshed:
-                    print("✅ 空流检测触发的凭证刷新成功")
-                else:
-                    print("❌ 空流检测触发的凭证刷新超时")
-            except Exception as e:
-                print(f"❌ 空流检测触发凭证刷新失败: {e}")
-            
-        # Ensure the stream is properly terminated with [DONE]
-        yield "data: [DONE]\n\n"
+            # 检测到空流时触发凭证刷新（后台进行，不阻塞当前响应的结束）
+            log.info("🔄 检测到空流，触发凭证刷新...")
+            refresh_coordinator.refresh_in_background("empty stream")
 
-    def process_google_response(self, data: Dict[str, Any]) -> Generator[str, None, None]:
-            """Converts Google's response format to OpenAI's SSE format, handling text and images."""
+    def process_google_response(self, data: Dict[str, Any], usage: Optional[UsageTracker] = None) -> Generator[ChatDelta, None, None]:
+            """Converts Google's response format to typed deltas, handling text and images.
+
+            When a UsageTracker is given, usageMetadata and a local output estimate are recorded on it.
+            """
             try:
-                if not data:
+                if not data or not isinstance(data, dict):
+                    # Scalars / strings are not part of the protocol (the parser already logged them)
                     return
                 
-                # Debug: Log the raw data received from Google
-                print(f"🔍 Google Raw Chunk: {json.dumps(data, indent=2)[:500]}...")
+                # Debug: Log the raw data received from Google (serialised only when DEBUG is enabled)
+                log.debug("🔍 Google Raw Chunk: %.500s", LazyJSON(data))
     
                 if 'error' in data:
-                    print(f"⚠️ Google Stream Error: {data['error']}")
+                    log.warning("⚠️ Google Stream Error: %s", data['error'])
                     # This error is usually not fatal, just a part of the stream.
                     return
     
@@ -843,7 +1473,7 @@ class VertexAIClient:
                         if 'errors' in result:
                             for err in result['errors']:
                                 msg = err.get('message', 'Unknown Error')
-                                print(f"⚠️ Google API Error: {msg}")
+                                log.warning("⚠️ Google API Error: %s", msg)
                                 
                                 # 检测需要刷新凭证的错误模式
                                 if ("Recaptcha" in msg or
@@ -858,6 +1488,9 @@ class VertexAIClient:
     
                         result_data = result.get('data')
                         if not result_data: continue
+                        
+                        if usage is not None and 'usageMetadata' in result_data:
+                            usage.observe_metadata(result_data['usageMetadata'])
     
                         candidates = result_data.get('candidates')
                         if not candidates: continue
@@ -867,14 +1500,16 @@ class VertexAIClient:
                             parts = content.get('parts') or []
     
                             for part in parts:
-                                delta = {}
+                                delta = ChatDelta()
                                 # --- Text Part ---
                                 text = part.get('text', '')
                                 if text:
                                     if part.get('thought', False):
-                                        delta['reasoning_content'] = text
+                                        delta.reasoning_content = text
                                     else:
-                                        delta['content'] = text
+                                        delta.content = text
+                                    if usage is not None:
+                                        usage.add_text(text, delta.reasoning_content is not None)
     
                                 # --- Image Part (inline data) ---
                                 inline_data = part.get('inlineData')
@@ -884,24 +1519,19 @@ class VertexAIClient:
                                     mime_type = inline_data.get('mimeType')
                                     b64_data = inline_data.get('data')
                                     if mime_type and b64_data:
-                                        # Format as a markdown image data URI
-                                        image_md = f"![Generated Image](data:{mime_type};base64,{b64_data})"
-                                        delta['content'] = image_md
+                                        # Decoded once into the image store; the client gets a short URL
+                                        # (or the data URI when it asked for inline images)
+                                        delta.content = image_store.markdown_for(mime_type, b64_data)
+                                        if usage is not None:
+                                            usage.add_image()
                                 elif uri:
                                     # Format as a markdown image URL
                                     image_md = f"![Generated Image]({uri})"
-                                    delta['content'] = image_md
+                                    delta.content = image_md
     
-                                # --- Yield Chunk if we have content ---
-                                if delta:
-                                    chunk = {
-                                        "id": f"chatcmpl-proxy-{uuid.uuid4()}",
-                                        "object": "chat.completion.chunk",
-                                        "created": int(time.time()),
-                                        "model": "vertex-ai-proxy",
-                                        "choices": [{"index": 0, "delta": delta, "finish_reason": None}]
-                                    }
-                                    yield f"data: {json.dumps(chunk)}\n\n"
+                                # --- Yield Delta if we have content ---
+                                if delta.content is not None or delta.reasoning_content is not None:
+                                    yield delta
     
                             # Check finish reason for the candidate
                             finish_reason = candidate.get('finishReason')
@@ -911,23 +1541,20 @@ class VertexAIClient:
                             is_thought_part = any(p.get('thought', False) for p in parts)
                             
                             if finish_reason in ['STOP', 'MAX_TOKENS'] and not is_thought_part:
-                                finish_chunk = {
-                                    "id": f"chatcmpl-proxy-finish-{uuid.uuid4()}",
-                                    "object": "chat.completion.chunk",
-                                    "created": int(time.time()),
-                                    "model": "vertex-ai-proxy",
-                                    "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason.lower()}]
-                                }
-                                yield f"data: {json.dumps(finish_chunk)}\n\n"
+                                yield ChatDelta(finish_reason=finish_reason.lower())
                             elif finish_reason in ['STOP', 'MAX_TOKENS'] and is_thought_part:
-                                print("⚠️ Suppressing premature finishReason due to active thinking mode.")
+                                log.debug("⚠️ Suppressing premature finishReason due to active thinking mode.")
             except AuthError:
                 raise # Re-raise to be caught by the retry logic
             except Exception as e:
-                print(f"Error processing response object: {e}")
-                print(f"🐛 Debug Data causing error: {json.dumps(data, indent=2)}")
+                log.exception("Error processing response object: %s", e)
+                log.debug("🐛 Debug Data causing error: %s", LazyJSON(data))
 
 vertex_client = VertexAIClient()
+metrics.gauge("vertex_proxy_upstream_in_flight", "Upstream requests currently in flight",
+              function=lambda: vertex_client.upstream.in_flight)
+metrics.gauge("vertex_proxy_upstream_pool_saturation", "Upstream in-flight requests / max connections",
+              function=lambda: vertex_client.upstream.to_stats()["saturation"] or 0)
 
 # --- FastAPI App ---
 app = FastAPI()
@@ -949,7 +1576,7 @@ async def dashboard():
 async def verify_dashboard_access(bearer: HTTPAuthorizationCredentials = Depends(security_bearer)):
     """验证仪表盘访问权限 - 使用 Authorization: Bearer <token>"""
     if not bearer or not bearer.credentials:
-        print("❌ Dashboard验证失败: 未提供 Bearer token")
+        log.warning("❌ Dashboard验证失败: 未提供 Bearer token")
         raise HTTPException(
             status_code=401,
             detail="API Key is required. Please provide Authorization: Bearer <token> header."
@@ -957,36 +1584,78 @@ async def verify_dashboard_access(bearer: HTTPAuthorizationCredentials = Depends
     
     token = bearer.credentials.strip()
     
-    if token != API_KEY:
-        print(f"⚠️ Dashboard验证失败 (长度不匹配: 期望 {len(API_KEY)}, 收到 {len(token)})")
+    if not is_valid_api_key(token):
+        log.warning("⚠️ Dashboard验证失败 (长度不匹配: 期望 %d, 收到 %d)", len(API_KEY), len(token))
         raise HTTPException(status_code=401, detail="Invalid API Key")
     
-    print("✅ Dashboard验证成功")
+    log.info("✅ Dashboard验证成功")
     return {"status": "ok"}
 
+def refresh_stats() -> Dict[str, Any]:
+    return {**refresh_coordinator.stats, **proactive_refresher.stats,
+            **refresh_coordinator.latency_stats(),
+            "error_rate": round(proactive_refresher.error_rate(), 3)}
+
 @app.get("/dashboard/stats")
 async def get_dashboard_stats(api_key: str = Depends(verify_api_key)):
     """获取仪表盘统计数据"""
     today_stats = daily_stats_manager.get_today_stats()
-    return {
+    stats = {
         "today": today_stats,
-        "date": daily_stats_manager.get_beijing_date()
+        "date": daily_stats_manager.get_beijing_date(),
+        "credentials": cred_manager.get_pool_stats(),
+        "refresh": refresh_stats(),
+        "harvesters": {**harvester_hub.stats, "clients": harvester_hub.get_stats()},
+        "hedging": hedge_policy.to_stats(),
+        "admission": admission.to_stats(),
+        "rate_limits": rate_limiter.to_stats(),
+        "response_cache": response_cache.to_stats(),
+        "images": image_store.to_stats(),
+        "inbound_media": media_pipeline.to_stats(),
+        "upstream_pool": {**vertex_client.upstream.to_stats(),
+                          "pool_timeouts": sum(UPSTREAM_POOL_TIMEOUTS.totals().values())},
+        "latency": PHASE_SECONDS.summary(by=("phase",)),
+        "retries": RETRIES_TOTAL.totals(by=("reason",)),
+        "browser_tabs": _headful_browser.get_pool_stats() if _headful_browser else [],
+        "browser_resources": _headful_browser.get_resource_stats() if _headful_browser else {}
     }
+    if hub_client is not None:
+        # 凭证刷新、harvester 和浏览器都在 hub 进程中，使用 hub 推送的数据
+        stats.update({key: hub_stats[key] for key in HUB_STATS_KEYS if key in hub_stats})
+        # 其余部分只反映处理本次请求的 worker；各 worker 的概况来自 hub 汇总
+        workers = dict(hub_stats.get("workers", {}))
+        workers[WORKER_ID] = worker_summary()
+        stats["worker"] = {"id": WORKER_ID, "workers": API_WORKERS, "hub": hub_client.to_stats(),
+                           "all": dict(sorted(workers.items()))}
+    return stats
+
+@app.get("/metrics")
+async def get_metrics(api_key: str = Depends(verify_api_key)):
+    """Prometheus 格式的指标（抓取时使用 Bearer API_KEY 认证）"""
+    if hub_client is not None:
+        # 多 worker 模式：hub 合并的所有进程样本（带 worker 标签），无论哪个 worker 响应抓取结果都一致
+        if "metrics" in hub_stats:
+            return Response(content=hub_stats["metrics"], media_type=MetricsRegistry.CONTENT_TYPE)
+        return Response(content=metrics.render_merged([metrics.export({"worker": WORKER_ID})]),
+                        media_type=MetricsRegistry.CONTENT_TYPE)
+    return Response(content=metrics.render(), media_type=MetricsRegistry.CONTENT_TYPE)
+
+@app.get("/v1/images/{name}")
+async def get_image(name: str):
+    """生成的图片（文件名为内容的 SHA-256，无需认证，便于聊天客户端直接渲染）"""
+    found = await image_store.open(name)
+    if found is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    path, media_type = found
+    return FileResponse(path, media_type=media_type,
+                        headers={"Cache-Control": "public, max-age=31536000, immutable"})
 
 @app.get("/v1/models")
 async def list_models(api_key: str = Depends(verify_api_key)):
     # Return a list of common Vertex AI models
     # This helps clients know what's available
     current_time = int(time.time())
-    models = []
-    try:
-        with open(MODELS_CONFIG_FILE, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-            models = config.get('models', [])
-    except Exception as e:
-        print(f"⚠️ Error loading models.json: {e}")
-        # Fallback
-        models = ["gemini-1.5-pro", "gemini-1.5-flash"]
+    models = model_registry.models
 
     data = {
         "object": "list",
@@ -997,15 +1666,71 @@ async def list_models(api_key: str = Depends(verify_api_key)):
     }
     return data
 
+async def relay_until_disconnect(request: Request, generator, poll_interval: float = 0.5,
+                                 on_finish: Optional[Callable[[], None]] = None):
+    """
+    Relays SSE chunks from `generator` to the client.
+
+    The upstream generator runs in its own task so that a client disconnect can be
+    noticed even while we are still waiting on Google. On disconnect the task is
+    cancelled, which exits the `httpx` stream context and closes the upstream connection.
+    `on_finish` runs once the upstream task has ended, however the relay ends.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=16)
+    done = object()
+
+    async def pump():
+        try:
+            async for chunk in generator:
+                await queue.put(chunk)
+            await queue.put(done)
+        except Exception:
+            try:
+                queue.put_nowait(done)
+            except asyncio.QueueFull:
+                pass
+            raise
+
+    pump_task = asyncio.create_task(pump())
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(queue.get(), timeout=poll_interval)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    log.info("🔌 Client disconnected, cancelling upstream stream")
+                    break
+                if pump_task.done() and queue.empty():
+                    break
+                continue
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        if not pump_task.done():
+            pump_task.cancel()
+        try:
+            await pump_task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log.error("❌ Stream relay error: %s", e)
+        if on_finish is not None:
+            on_finish()
+
 @app.post("/v1/chat/completions")
-async def chat_completions(request: Request, api_key: str = Depends(verify_api_key)):
+async def chat_completions(request: Request, response: Response, api_key: str = Depends(verify_api_key)):
+    # Correlation id: tags every log line of this request (inherited by the tasks it spawns)
+    request_id = new_request_id()
+    # Generated images link back to this proxy; some clients need them inline instead
+    image_base_url_var.set(str(request.base_url))
+    inline_images_var.set(request.headers.get("x-image-delivery", IMAGE_DELIVERY).lower() == "data_uri")
     try:
         body = await request.json()
         messages = body.get('messages', [])
         model = body.get('model', 'gemini-1.5-pro')
         stream = body.get('stream', False)  # 默认关闭流式输出
-        # 强制关闭流式输出
-        stream = False
+        include_usage = bool((body.get('stream_options') or {}).get('include_usage'))
         
         # Extract generation parameters
         temperature = body.get('temperature')
@@ -1017,192 +1742,291 @@ async def chat_completions(request: Request, api_key: str = Depends(verify_api_k
         if not messages:
             raise HTTPException(status_code=400, detail="No messages provided")
 
-        # 记录请求到每日统计
-        await daily_stats_manager.record_request(model)
+        # 响应缓存：只对确定性请求（temperature=0）生效
+        cache_key = None
+        cached_events = None
+        cache_status = None
+        if response_cache.enabled and response_cache.cacheable(temperature):
+            if is_bypass_requested(request.headers):
+                response_cache.stats["bypassed"] += 1
+                cache_status = "BYPASS"
+            else:
+                route = model_registry.resolve(model)
+                # Generated images are rendered per delivery mode / base URL, so they are part of the key
+                inline_images = inline_images_var.get()
+                cache_key = canonical_key(
+                    messages,
+                    {"target_model": route.target_model, "thinking_budget": route.thinking_budget,
+                     "image_size": route.image_size, "inline_images": inline_images,
+                     "image_base_url": None if inline_images else image_store.url_for("")},
+                    {"temperature": temperature, "top_p": top_p, "top_k": top_k,
+                     "max_tokens": max_tokens, "stop": stop})
+                cached_events = await response_cache.get(cache_key)
+                if cached_events is not None and not inline_images and not image_store.available(
+                        "".join(e.content or "" for e in cached_events if isinstance(e, ChatDelta))):
+                    # The cached response links to images the store has since evicted
+                    log.info("📦 Cached response references evicted images, discarding (%s)", cache_key[:12])
+                    await response_cache.invalidate(cache_key)
+                    cached_events = None
+                cache_status = "HIT" if cached_events is not None else "MISS"
+                if cached_events is not None:
+                    log.info("📦 Response cache hit (%s)", cache_key[:12])
+        extra_headers = {"X-Cache": cache_status} if cache_status else {}
+
+        # 图片在准入之前获取 / 解码：无效图片是客户端错误（400），不占用并发名额
+        image_parts = None
+        if cached_events is None:
+            image_urls = extract_image_urls(messages)
+            if image_urls:
+                try:
+                    image_parts = await media_pipeline.convert(image_urls)
+                except MediaError as e:
+                    log.warning("⚠️ Rejected request image: %s", e)
+                    raise HTTPException(status_code=400, detail={"error": {"message": str(e),
+                                                                           "type": "invalid_request_error"}})
+
+        # 准入控制：缓存命中不占用上游并发
+        ticket = None
+        if cached_events is None:
+            priority = API_KEY_PRIORITIES.get(api_key, DEFAULT_PRIORITY)
+            try:
+                ticket = await admission.acquire(priority)
+            except AdmissionRejected as e:
+                log.warning("🚦 Request rejected by admission control (%s): %s", priority, e.reason)
+                raise HTTPException(status_code=429, headers={"Retry-After": str(e.retry_after)},
+                                    detail={"error": {"message": f"Server overloaded: {e.reason}",
+                                                      "type": "rate_limit_error"}})
+        release_ticket = ticket.release if ticket else None
+
+        # 记录请求到每日统计（只统计通过准入的请求，被拒绝的 429 / 503 不计入）
+        await record_request_usage(model)
 
         if stream:
             return StreamingResponse(
-                vertex_client.stream_chat(
+                relay_until_disconnect(
+                    request,
+                    vertex_client.stream_chat(
+                        messages,
+                        model,
+                        include_usage=include_usage,
+                        cache_key=cache_key,
+                        cached_events=cached_events,
+                        image_parts=image_parts,
+                        temperature=temperature,
+                        top_p=top_p,
+                        top_k=top_k,
+                        max_tokens=max_tokens,
+                        stop=stop
+                    ),
+                    on_finish=release_ticket
+                ),
+                # Safety net in case the stream never starts (release is idempotent)
+                background=BackgroundTask(release_ticket) if release_ticket else None,
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Request-ID": request_id,
+                         **extra_headers}
+            )
+        else:
+            # Non-streaming request
+            response.headers["X-Request-ID"] = request_id
+            response.headers.update(extra_headers)
+            try:
+                response_data = await vertex_client.complete_chat(
                     messages,
                     model,
+                    cache_key=cache_key,
+                    cached_events=cached_events,
+                    image_parts=image_parts,
                     temperature=temperature,
                     top_p=top_p,
                     top_k=top_k,
                     max_tokens=max_tokens,
                     stop=stop
-                ),
-                media_type="text/event-stream"
-            )
-        else:
-            # Non-streaming request
-            response_data = await vertex_client.complete_chat(
-                messages,
-                model,
-                temperature=temperature,
-                top_p=top_p,
-                top_k=top_k,
-                max_tokens=max_tokens,
-                stop=stop
-            )
+                )
+            finally:
+                if release_ticket:
+                    release_ticket()
             return response_data
 
+    except HTTPException:
+        raise
+    except UpstreamStreamError as e:
+        log.error("Upstream error in endpoint: %s", e)
+        raise HTTPException(status_code=502, detail={"error": {"message": e.error.message, "type": e.error.type}})
     except Exception as e:
-        print(f"Error in endpoint: {e}")
+        log.exception("Error in endpoint: %s", e)
         # FastAPI handles exceptions better, but for compatibility:
         raise HTTPException(status_code=500, detail={"error": str(e)})
 
 # --- WebSocket Server (For Harvester) ---
 import websockets
 
-# Store connected harvester clients
-harvester_clients = set()
+HARVESTER_HEDGE_AFTER = float(os.environ.get("HARVESTER_HEDGE_AFTER", "10"))  # 刷新请求多少秒未返回后对冲给第二个 harvester
+
+def _slot_available(slot_id: str) -> bool:
+    slot = cred_manager.slots.get(slot_id)
+    return slot is None or slot.is_available(time.time())
+
+# Registry of connected harvesters (one credential pool slot each)
+harvester_hub = HarvesterHub(hedge_after=HARVESTER_HEDGE_AFTER, slot_available=_slot_available)
 
 async def websocket_handler(websocket):
-    print("🔌 WebSocket client connected")
-    harvester_clients.add(websocket)
+    log.info("🔌 WebSocket client connected")
+    client = harvester_hub.register(websocket)
     try:
         async for message in websocket:
             try:
+                harvester_hub.touch(websocket)
                 data = json.loads(message)
                 msg_type = data.get("type")
+                slot_id = data.get("slot") or client.slot_id
                 if msg_type == "credentials_harvested":
-                    cred_manager.update(data.get("data"))
+                    cred_manager.update(data.get("data"), slot_id)
+                    harvester_hub.delivered(websocket)
                 elif msg_type == "token_refreshed":
-                    cred_manager.update_token(data.get("token"))
+                    cred_manager.update_token(data.get("token"), slot_id)
+                    harvester_hub.delivered(websocket)
                 elif msg_type == "refresh_complete":
-                    print("✅ Frontend confirms refresh is complete.")
-                    cred_manager.refresh_complete_event.set()
+                    log.info("✅ Frontend confirms refresh is complete.")
+                    cred_manager.mark_refresh_complete()
                 elif msg_type == "identify":
-                    print(f"👋 Client identified: {data.get('client')}")
+                    client_name = data.get('client') or "harvester"
+                    client = harvester_hub.identify(websocket, client_name, data.get("slot"))
+                    log.info("👋 Client identified: %s (slot: %s)", client_name, client.slot_id)
             except Exception as e:
-                print(f"WS Error: {e}")
+                log.warning("WS Error: %s", e)
     except websockets.ConnectionClosed:
-        print("🔌 WebSocket client disconnected")
-        harvester_clients.remove(websocket)
+        log.info("🔌 WebSocket client disconnected")
     except Exception as e:
-        print(f"WS Handler Error: {e}")
-        if websocket in harvester_clients:
-            harvester_clients.remove(websocket)
-
-async def request_token_refresh():
-    print("🔄 Requesting token refresh from frontend...")
-    if not harvester_clients:
-        print("⚠️ No harvester clients connected!")
+        log.error("WS Handler Error: %s", e)
+    finally:
+        harvester_hub.unregister(websocket)
+
+async def request_token_refresh(timeout: float):
+    """Asks one healthy harvester to refresh (hedging to a second one after a deadline)."""
+    if not len(harvester_hub):
+        log.warning("⚠️ No harvester clients connected!")
         return
+    log.info("🔄 Requesting token refresh from frontend...")
+    winner = await harvester_hub.refresh(timeout=timeout)
+    if winner is not None:
+        log.info("✅ Harvester %s delivered fresh credentials", winner.slot_id)
+
+async def trigger_credential_refresh(timeout: float) -> None:
+    """根据浏览器模式触发一次凭证刷新（由 RefreshCoordinator 调用，最多阻塞 timeout 秒）"""
+    if hub_client is not None:
+        # worker 进程：请 hub 刷新，新凭证随后由 hub 推送过来
+        hub_client.send({"type": "refresh", "worker": WORKER_ID, "last_updated": cred_manager.last_updated})
+    elif BROWSER_MODE == "headful":
+        await headful_browser_refresh(timeout)
+    else:
+        await request_token_refresh(timeout)
+
+async def _send_and_await_harvest(tab) -> Optional[float]:
+    """在标签页上发送测试消息，等待抓取回调直接唤醒；返回从发送到拿到凭证的秒数，失败返回 None"""
+    # 必须在触发请求前登记，避免凭证在等待开始前就已到达
+    harvest = tab.expect_harvest()
+    started = time.monotonic()
+    if not await tab.send_test_message():
+        return None
+    try:
+        await asyncio.wait_for(harvest, timeout=HARVEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        log.warning("⚠️ 有头浏览器模式: 消息已发送但凭证未更新 (%s, 可能被 recaptcha 拦截)", tab.slot_id)
+        return None
+    return time.monotonic() - started
+
+async def _harvest_on_tab(browser, tab) -> bool:
+    """在一个标签页上触发一次抓取；连续失败时恢复 / 回收该标签页"""
+    try:
+        # 先尝试关闭任何可能的 overlay
+        await tab._dismiss_overlays()
+        
+        latency = await _send_and_await_harvest(tab)
+        if latency is not None:
+            log.info("✅ 有头浏览器模式: 凭证已更新 (%s, 延迟 %.2f秒)", tab.slot_id, latency)
+            tab.fail_count = 0
+            tab.harvest_count += 1
+            await tab.sample_metrics()
+            return True
+    except Exception as e:
+        log.error("❌ 有头浏览器模式: 凭证刷新异常 (%s): %s", tab.slot_id, e)
+    
+    # 失败处理
+    tab.fail_count += 1
+    log.warning("❌ 有头浏览器模式: 凭证刷新失败 (%s, 连续失败 %d/%d)", tab.slot_id, tab.fail_count, _REDIRECT_THRESHOLD)
     
-    message = json.dumps({"type": "refresh_token"})
-    # Broadcast to all connected harvesters
-    for ws in list(harvester_clients):
+    # 连续失败达到阈值，恢复该标签页（不影响其他标签页，也不重启浏览器）
+    if tab.fail_count >= _REDIRECT_THRESHOLD:
+        log.warning("🔄 有头浏览器模式: %s 重复失败，尝试恢复...", tab.slot_id)
+        tab.fail_count = 0
         try:
-            await ws.send(message)
+            if await browser.recover_tab(tab) and await _send_and_await_harvest(tab) is not None:
+                log.info("✅ %s 恢复成功", tab.slot_id)
+                tab.harvest_count += 1
+                return True
         except Exception as e:
-            print(f"Failed to send refresh request: {e}")
-            harvester_clients.remove(ws)
+            log.warning("⚠️ %s 恢复失败: %.50s", tab.slot_id, e)
+        log.warning("⚠️ 有头浏览器模式: %s 所有恢复策略失败", tab.slot_id)
+    return False
 
-async def headful_browser_refresh() -> None:
-    """有头浏览器模式凭证刷新"""
-    global _headful_browser, _refresh_fail_count, _refresh_lock
+async def _run_tab_harvest(browser, tab) -> bool:
+    try:
+        return await _harvest_on_tab(browser, tab)
+    finally:
+        browser.release_tab(tab)
+
+def _pick_refresh_tabs(browser) -> List[Any]:
+    """选择要刷新的空闲标签页：所有凭证缺失 / 过旧 / 冷却中的标签页，否则凭证最旧的一个"""
+    idle = browser.idle_tabs()
+    if not idle:
+        return []
+    now = time.time()
     
-    # 延迟初始化锁（在异步上下文中）
-    if _refresh_lock is None:
-        _refresh_lock = asyncio.Lock()
+    def slot_age(tab):
+        slot = cred_manager.slots.get(tab.slot_id)
+        return now - slot.last_updated if slot and slot.template else float('inf')
     
-    # 获取刷新锁，防止并发刷新
-    if _refresh_lock.locked():
-        print("⏳ 检测到正在进行的凭证刷新，等待完成...")
-        async with _refresh_lock:
-            print("✅ 凭证刷新已由其他请求完成")
-            return
+    def needs_refresh(tab):
+        slot = cred_manager.slots.get(tab.slot_id)
+        return slot_age(tab) > REFRESH_AHEAD_AGE or not slot.is_available(now)
     
-    async with _refresh_lock:
-        if _headful_browser and _headful_browser.is_running:
-            print("🔄 有头浏览器模式: 按需刷新凭证...")
-        
-            try:
-                # 记录刷新前的凭证时间戳
-                old_timestamp = cred_manager.last_updated
-                print(f"   🔍 刷新前凭证时间戳: {old_timestamp}")
-                
-                # 先尝试关闭任何可能的 overlay
-                await _headful_browser._dismiss_overlays()
-                
-                success = await _headful_browser.send_test_message()
-                if success:
-                    # 等待凭证实际更新（最多等待 5 秒）
-                    for i in range(10):
-                        await asyncio.sleep(0.5)
-                        if cred_manager.last_updated > old_timestamp:
-                            new_timestamp = cred_manager.last_updated
-                            print(f"✅ 有头浏览器模式: 凭证已更新")
-                            print(f"   新凭证时间戳: {new_timestamp} (延迟 {new_timestamp - old_timestamp:.1f}秒)")
-                            _refresh_fail_count = 0
-                            
-                            # 立即设置事件
-                            cred_manager.refresh_event.set()
-                            cred_manager.refresh_complete_event.set()
-                            return  # 成功，直接返回
-                    
-                    print("⚠️ 有头浏览器模式: 消息已发送但凭证未更新 (可能被 recaptcha 拦截)")
-                
-                # 失败处理
-                _refresh_fail_count += 1
-                print(f"❌ 有头浏览器模式: 凭证刷新失败 (连续失败 {_refresh_fail_count}/{_REDIRECT_THRESHOLD})")
-                
-                # 连续失败达到阈值，尝试恢复
-                if _refresh_fail_count >= _REDIRECT_THRESHOLD:
-                    print("🔄 有头浏览器模式: 重复失败，尝试恢复...")
-                    _refresh_fail_count = 0
-                    
-                    recovered = False
-                    
-                    # 策略1: 刷新当前页面
-                    try:
-                        print("   📍 策略1: 刷新当前页面...")
-                        if _headful_browser.page:
-                            await _headful_browser._dismiss_overlays()
-                            await _headful_browser.page.reload(wait_until="domcontentloaded", timeout=15000)
-                            await asyncio.sleep(2)
-                            await _headful_browser._dismiss_overlays()
-                            
-                            retry_success = await _headful_browser.send_test_message()
-                            if retry_success:
-                                print("   ✅ 页面刷新后恢复成功")
-                                recovered = True
-                    except Exception as e:
-                        print(f"   ⚠️ 页面刷新失败: {str(e)[:50]}")
-                    
-                    # 策略2: 重定向到 Vertex AI Studio
-                    if not recovered:
-                        try:
-                            print("   📍 策略2: 重定向到 Vertex AI Studio...")
-                            if _headful_browser.page:
-                                await _headful_browser.page.goto(
-                                    _headful_browser.VERTEX_AI_URL,
-                                    wait_until="domcontentloaded",
-                                    timeout=30000
-                                )
-                                print("   ✅ 已重定向，等待页面加载...")
-                                await asyncio.sleep(3)
-                                
-                                await _headful_browser._dismiss_overlays()
-                                
-                                retry_success = await _headful_browser.send_test_message()
-                                if retry_success:
-                                    print("   ✅ 重定向后恢复成功")
-                                    recovered = True
-                                else:
-                                    print("   ⚠️ 重定向后仍然失败")
-                        except Exception as e:
-                            print(f"   ⚠️ 重定向失败: {str(e)[:50]}")
-                    
-                    if not recovered:
-                        print("⚠️ 有头浏览器模式: 所有恢复策略失败")
-                        
-            except Exception as e:
-                print(f"❌ 有头浏览器模式: 凭证刷新异常: {e}")
-                _refresh_fail_count += 1
-        else:
-            print("⚠️ 有头浏览器模式: 浏览器未运行，无法刷新凭证")
+    stale = [tab for tab in idle if needs_refresh(tab)]
+    return stale or [max(idle, key=slot_age)]
+
+def start_tab_harvests(browser, tabs) -> List[asyncio.Task]:
+    """在多个标签页上并行触发抓取，每个标签页同一时间只运行一个抓取"""
+    tasks = []
+    for tab in tabs:
+        if browser.acquire_tab(tab):
+            tasks.append(asyncio.create_task(_run_tab_harvest(browser, tab)))
+    return tasks
+
+async def headful_browser_refresh(timeout: float) -> None:
+    """有头浏览器模式凭证刷新：在选中的标签页上并行抓取，任一标签页拿到凭证或超时即返回"""
+    browser = _headful_browser
+    if not browser or not browser.is_running:
+        log.warning("⚠️ 有头浏览器模式: 浏览器未运行，无法刷新凭证")
+        return
+    
+    tasks = start_tab_harvests(browser, _pick_refresh_tabs(browser))
+    if not tasks:
+        # 所有标签页都在抓取中，等待它们的结果即可（RefreshCoordinator 会等待凭证代数变化）
+        log.info("⏳ 所有标签页都在刷新中，等待完成...")
+        return
+    
+    log.info("🔄 有头浏览器模式: 按需刷新凭证 (%d 个标签页)...", len(tasks))
+    deadline = time.monotonic() + timeout
+    pending = set(tasks)
+    while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            # 超时：抓取任务继续在后台运行，RefreshCoordinator 按剩余时间等待凭证
+            return
+        done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+        if any(not t.cancelled() and t.exception() is None and t.result() for t in done):
+            # 其余标签页继续在后台完成抓取
+            return
 
 
 async def start_headful_browser_mode() -> None:
@@ -1212,6 +2036,8 @@ async def start_headful_browser_mode() -> None:
     try:
         from src.browser import HeadfulBrowser
         from src.harvester import CredentialHarvester
+        from src.resource_policy import (ResourcePolicy, parse_list, DEFAULT_BLOCKED_TYPES,
+                                         DEFAULT_DENY_URLS, DEFAULT_ALLOW_URLS)
     except ImportError as e:
         print(f"❌ 无法导入浏览器模块: {e}")
         print("   请确保已安装 playwright: pip install playwright && playwright install chromium")
@@ -1220,12 +2046,29 @@ async def start_headful_browser_mode() -> None:
     print("🌐 有头浏览器模式启动中...")
     
     # 创建浏览器实例
-    browser = HeadfulBrowser()
+    viewport = None
+    if BROWSER_VIEWPORT:
+        try:
+            width, height = (int(v) for v in BROWSER_VIEWPORT.lower().split("x", 1))
+            viewport = (width, height)
+        except ValueError:
+            print(f"⚠️ 无效的 BROWSER_VIEWPORT: {BROWSER_VIEWPORT}，使用默认窗口大小")
+    resource_policy = ResourcePolicy(
+        blocked_types=parse_list(BROWSER_BLOCK_RESOURCES, DEFAULT_BLOCKED_TYPES),
+        deny_urls=parse_list(BROWSER_BLOCK_URLS, DEFAULT_DENY_URLS),
+        allow_urls=parse_list(BROWSER_ALLOW_URLS, DEFAULT_ALLOW_URLS),
+    )
+    browser = HeadfulBrowser(pool_size=HEADFUL_TABS, viewport=viewport, resource_policy=resource_policy)
     _headful_browser = browser
     
-    def on_credentials(data):
-        cred_manager.update(data)
-        cred_manager.refresh_complete_event.set()
+    def on_credentials(data, slot_id=None):
+        slot_id = slot_id or "headful"
+        cred_manager.update(data, slot_id)
+        cred_manager.mark_refresh_complete()
+        slot = cred_manager.slots.get(slot_id)
+        if slot and slot.harvest is data:
+            # 直接唤醒等待该标签页抓取结果的刷新，无需轮询
+            browser.notify_harvest(slot_id)
     
     harvester = CredentialHarvester(on_credentials=on_credentials)
     
@@ -1246,7 +2089,8 @@ async def start_headful_browser_mode() -> None:
         return
     
     print("🔄 有头浏览器模式: 获取初始凭证...")
-    await browser.send_test_message()
+    # 所有标签页并行抓取，各自填充自己的凭证槽位
+    await asyncio.gather(*start_tab_harvests(browser, browser.tabs))
     
     print("✅ 有头浏览器模式已就绪 (按需刷新)")
     print("   👁️ 浏览器窗口已打开，您可以看到浏览器操作")
@@ -1260,12 +2104,224 @@ async def start_headful_browser_mode() -> None:
         _headful_browser = None
 
 
+# --- Multi-Worker Mode ---
+# hub 进程：credential_hub 把凭证推送给 worker；worker 进程：hub_client 接收凭证、发回刷新请求和用量
+credential_hub: Optional[CredentialHub] = None
+hub_client: Optional[HubClient] = None
+hub_stats: Dict[str, Any] = {}  # worker 端：hub 最近一次推送的共享统计
+HUB_STATS_KEYS = ("refresh", "harvesters", "browser_tabs", "browser_resources")
+HUB_STATS_INTERVAL = 2.0
+
+worker_reports: Dict[str, Dict[str, Any]] = {}  # hub 端：各 worker 最近一次上报的指标和概况
+IMAGE_SWEEP_INTERVAL = 30.0
+
+def forward_to_hub(message: Dict[str, Any]) -> None:
+    """worker 进程把用量等消息发给 hub（单进程模式下什么也不做）"""
+    if hub_client is not None:
+        hub_client.send(message)
+
+async def record_request_usage(model: str) -> None:
+    """记录一次请求；worker 只发给 hub，由 hub 统一累计（本地计数会和 hub 推送的数据重复）"""
+    if hub_client is not None:
+        forward_to_hub({"type": "request", "model": model})
+        return
+    await daily_stats_manager.record_request(model)
+
+async def record_token_usage(model: str, prompt_tokens: int, completion_tokens: int) -> None:
+    if hub_client is not None:
+        forward_to_hub({"type": "tokens", "model": model,
+                        "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens})
+        return
+    await stats_manager.update(prompt_tokens, completion_tokens)
+    await daily_stats_manager.record_tokens(model, prompt_tokens, completion_tokens)
+
+def worker_summary() -> Dict[str, Any]:
+    """面板上每个 worker 一行的概况"""
+    return {
+        "admission": {key: value for key, value in admission.to_stats().items()
+                      if key in ("active", "capacity", "queue_depth", "rejected_full", "rejected_deadline")},
+        "requests": REQUESTS_TOTAL.totals(by=("outcome",)),
+        "upstream_in_flight": vertex_client.upstream.in_flight,
+    }
+
+async def report_to_hub(interval: float) -> None:
+    """worker 端：定期把本进程的指标样本和概况发给 hub，由 hub 合并后推送给所有 worker"""
+    while True:
+        await asyncio.sleep(interval)
+        forward_to_hub({"type": "report", "worker": WORKER_ID,
+                        "metrics": metrics.export({"worker": WORKER_ID}), "summary": worker_summary()})
+
+async def sweep_images(interval: float) -> None:
+    """hub 端：按共用图片目录的实际大小淘汰（worker 之间互不知道对方写入的图片）"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(image_store.sweep)
+        except OSError as e:
+            log.warning("⚠️ Image sweep failed: %s", e)
+
+def _credential_messages() -> List[Dict[str, Any]]:
+    return [{"type": "credentials", "slot": s.slot_id, "harvest": s.harvest, "last_updated": s.last_updated}
+            for s in cred_manager.slots.values() if s.harvest]
+
+def _shared_stats_message() -> Dict[str, Any]:
+    return {
+        "type": "stats",
+        "date": daily_stats_manager.get_beijing_date(),
+        "today": daily_stats_manager.get_today_stats(),
+        "totals": stats_manager.stats,
+        "refresh": refresh_stats(),
+        "harvesters": {**harvester_hub.stats, "clients": harvester_hub.get_stats()},
+        "browser_tabs": _headful_browser.get_pool_stats() if _headful_browser else [],
+        "browser_resources": _headful_browser.get_resource_stats() if _headful_browser else {},
+        # 只推送一份合并后的结果，而不是把每个 worker 的原始样本转发给所有 worker
+        "workers": {wid: report["summary"] for wid, report in worker_reports.items()},
+        "metrics": metrics.render_merged(
+            [metrics.export({"worker": "hub"})] + [report["metrics"] for _, report in sorted(worker_reports.items())]),
+    }
+
+async def _on_worker_message(message: Dict[str, Any]) -> None:
+    """hub 端：处理 worker 发来的消息"""
+    kind = message.get("type")
+    if kind == "refresh":
+        if cred_manager.last_updated > message.get("last_updated", 0):
+            # 该 worker 用的凭证已经被替换，新凭证正在推送的路上
+            REFRESHES_TOTAL.inc(reason="worker", result="already_refreshed")
+            return
+        refresh_coordinator.refresh_in_background("worker")
+    elif kind == "report":
+        worker_reports[str(message["worker"])] = {"metrics": message["metrics"], "summary": message["summary"]}
+    elif kind == "result":
+        proactive_refresher.record_result(bool(message["ok"]))
+    elif kind == "request":
+        await daily_stats_manager.record_request(message["model"])
+    elif kind == "tokens":
+        await stats_manager.update(message["prompt_tokens"], message["completion_tokens"])
+        await daily_stats_manager.record_tokens(message["model"], message["prompt_tokens"], message["completion_tokens"])
+    elif kind == "hello":
+        log.info("👷 API worker %s connected to the credential hub", message.get("worker"))
+
+async def _on_hub_message(message: Dict[str, Any]) -> None:
+    """worker 端：处理 hub 推送的消息"""
+    kind = message.get("type")
+    if kind == "credentials":
+        cred_manager.apply(message["slot"], message["harvest"], message["last_updated"])
+        log.info("🔄 Credentials received from hub (slot: %s)", message["slot"])
+    elif kind == "ui_ready":
+        cred_manager.mark_refresh_complete()
+    elif kind == "stats":
+        daily_stats_manager.stats[message["date"]] = message["today"]
+        stats_manager.stats = message["totals"]
+        hub_stats.update(message)
+
+async def publish_to_workers(hub: CredentialHub) -> None:
+    """hub 端：凭证更新和前端就绪通知立即推送，共享统计定时推送"""
+    published = {m["slot"]: m["last_updated"] for m in _credential_messages()}
+    generation = cred_manager.generation
+    ui_generation = cred_manager.ui_ready_signal.generation
+    last_stats = 0.0
+    while True:
+        # 凭证更新时立即醒来；否则每隔 HUB_STATS_INTERVAL 秒推送一次统计
+        await cred_manager.credentials_signal.wait_past(generation, HUB_STATS_INTERVAL)
+        generation = cred_manager.generation
+        for message in _credential_messages():
+            if published.get(message["slot"]) != message["last_updated"]:
+                published[message["slot"]] = message["last_updated"]
+                hub.broadcast(message)
+        if cred_manager.ui_ready_signal.generation > ui_generation:
+            ui_generation = cred_manager.ui_ready_signal.generation
+            hub.broadcast({"type": "ui_ready"})
+        if hub.workers and time.monotonic() - last_stats >= HUB_STATS_INTERVAL:
+            last_stats = time.monotonic()
+            hub.broadcast(_shared_stats_message())
+
+def bind_api_socket() -> socket.socket:
+    """hub 预先绑定 API 端口，所有 worker 共享同一个监听 socket（由内核分配连接）"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", PORT_API))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+async def supervise_worker(index: int, sock: socket.socket) -> None:
+    """启动一个 API worker 进程，异常退出时自动重启"""
+    env = {**os.environ, "PROXY_WORKER_ID": str(index), "API_SOCKET_FD": str(sock.fileno()),
+           "HUB_SOCKET": HUB_SOCKET, "NOGUI": "true"}
+    while True:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), env=env, pass_fds=(sock.fileno(),))
+        log.info("👷 Started API worker %d (pid %d)", index, process.pid)
+        try:
+            code = await process.wait()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.terminate()
+                try:
+                    await asyncio.wait_for(process.wait(), timeout=10)
+                except asyncio.TimeoutError:
+                    process.kill()
+            raise
+        log.warning("⚠️ API worker %d exited with code %s, restarting...", index, code)
+        await asyncio.sleep(1)
+
+def api_tasks() -> List[asyncio.Task]:
+    """处理 API 请求的进程（单进程模式或 worker）需要的后台任务"""
+    return [
+        # 监听 models.json 变化并热重载
+        asyncio.create_task(model_registry.watch()),
+        asyncio.create_task(rate_limit_store.run_flusher()),
+        # 预热上游连接：启动时、凭证更新后（目标主机可能变化）以及连接空闲时
+        asyncio.create_task(vertex_client.upstream.run_warmer(
+            cred_manager.credentials_signal,
+            lambda: [s.template.url for s in cred_manager.slots.values() if s.template],
+            UPSTREAM_WARM_INTERVAL)),
+    ]
+
+async def run_worker():
+    """API worker 进程：从 hub 接收凭证，在 hub 绑定的 socket 上处理请求"""
+    global hub_client
+    sock = socket.socket(fileno=int(os.environ["API_SOCKET_FD"]))
+    hub_client = HubClient(HUB_SOCKET, WORKER_ID, _on_hub_message)
+    background = [asyncio.create_task(hub_client.run()),
+                  asyncio.create_task(report_to_hub(HUB_STATS_INTERVAL))]
+    try:
+        await asyncio.wait_for(hub_client.connected_event.wait(), timeout=10)
+    except asyncio.TimeoutError:
+        log.warning("⚠️ Worker %s could not reach the credential hub at %s yet", WORKER_ID, HUB_SOCKET)
+    background.extend(api_tasks())
+
+    server = uvicorn.Server(uvicorn.Config(app, log_level="info"))
+    try:
+        await server.serve(sockets=[sock])
+    finally:
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+
 async def main():
     """启动服务器"""
+    if IS_WORKER:
+        await run_worker()
+        return
+
+    global credential_hub
+    multi_worker = API_WORKERS > 1
     print(f"\n📋 浏览器模式: {BROWSER_MODE}")
     
     tasks = []
     
+    if not multi_worker:
+        tasks.extend(api_tasks())
+    
+    # 统计数据后台批量落盘
+    tasks.append(asyncio.create_task(stats_manager.run_flusher()))
+    tasks.append(asyncio.create_task(daily_stats_manager.run_flusher()))
+    
+    # 凭证自动刷新模式下，后台提前刷新凭证
+    if BROWSER_MODE in ("websocket", "headful"):
+        tasks.append(asyncio.create_task(proactive_refresher.run()))
+    
     # 根据模式启动相应的服务
     if BROWSER_MODE == "websocket":
         # WebSocket 模式（原有模式）
@@ -1285,19 +2341,34 @@ async def main():
             print("⚠️ 未找到凭证文件，请先运行其他模式获取凭证")
     
     # 启动 API 服务器
-    config = uvicorn.Config(app, host="0.0.0.0", port=PORT_API, log_level="info")
-    server = uvicorn.Server(config)
+    if multi_worker:
+        sock = bind_api_socket()
+        credential_hub = CredentialHub(HUB_SOCKET, _credential_messages, _on_worker_message)
+        await credential_hub.start()
+        tasks.append(asyncio.create_task(publish_to_workers(credential_hub)))
+        tasks.append(asyncio.create_task(sweep_images(IMAGE_SWEEP_INTERVAL)))
+        tasks.extend(asyncio.create_task(supervise_worker(i + 1, sock)) for i in range(API_WORKERS))
+    else:
+        config = uvicorn.Config(app, host="0.0.0.0", port=PORT_API, log_level="info")
+        server = uvicorn.Server(config)
+        tasks.append(server.serve())
 
     print(f"\n🚀 Proxy 服务已启动")
-    print(f"   - API: http://0.0.0.0:{PORT_API}")
+    print(f"   - API: http://0.0.0.0:{PORT_API}" + (f" ({API_WORKERS} workers)" if multi_worker else ""))
     if BROWSER_MODE == "websocket":
         print(f"   - WS:  ws://0.0.0.0:{PORT_WS}")
         print("   👉 请确保浏览器中的 Harvester 脚本正在运行")
     elif BROWSER_MODE == "headful":
         print("   👁️ 浏览器窗口将自动打开")
 
-    tasks.append(server.serve())
-    await asyncio.gather(*tasks)
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # 关闭前把内存中的统计数据写入磁盘
+        stats_manager.flush_sync()
+        daily_stats_manager.flush_sync()
+        if credential_hub is not None:
+            await credential_hub.close()
 
 if __name__ == "__main__":
     import os
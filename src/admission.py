@@ -0,0 +1,218 @@
+"""
+准入控制模块
+限制同时发往上游的请求数（每个可用凭证槽位 N 个），超出的请求按优先级排队；
+队列已满或预计等待超过截止时间时立即拒绝（429 + Retry-After），避免突发流量把所有请求
+同时打到同一个会话上、集体触发配额耗尽和刷新风暴
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+# 优先级类别（数值越小越优先）
+PRIORITY_CLASSES = {"high": 0, "normal": 1, "low": 2}
+DEFAULT_PRIORITY = "normal"
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+def parse_priorities(value: str) -> Dict[str, str]:
+    """解析 "key1:high,key2:low" 形式的配置"""
+    priorities = {}
+    for item in (value or "").split(","):
+        key, sep, priority = item.strip().rpartition(":")
+        if not sep or not key:
+            continue
+        priority = priority.strip().lower()
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class '{priority}' (expected one of {', '.join(PRIORITY_CLASSES)})")
+        priorities[key.strip()] = priority
+    return priorities
+
+
+class AdmissionTicket:
+    """一个已准入的请求；release() 可重复调用，只生效一次"""
+    __slots__ = ("_controller", "admitted_at", "_released")
+
+    def __init__(self, controller: "AdmissionController", admitted_at: float):
+        self._controller = controller
+        self.admitted_at = admitted_at
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._controller.release(self.admitted_at)
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "future", "enqueued")
+
+    def __init__(self, priority: int, seq: int, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.enqueued = time.monotonic()
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AdmissionController:
+    """
+    按优先级排队的并发准入
+
+    容量 = per_credential × 当前可用凭证槽位数（至少按 1 个计算），随凭证池变化自动调整。
+    """
+
+    def __init__(self, per_credential: int = 8, queue_size: int = 100, max_wait: float = 30.0,
+                 available_slots: Optional[Callable[[], int]] = None):
+        """
+        Args:
+            per_credential: 每个凭证槽位的并发上限，<= 0 表示不限制
+            queue_size: 等待队列长度上限
+            max_wait: 排队的最长秒数；预计等待超过该值的请求直接拒绝
+            available_slots: 返回当前可用凭证槽位数
+        """
+        self.per_credential = per_credential
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.available_slots = available_slots or (lambda: 1)
+        self.active = 0
+        self._queue: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._durations = deque(maxlen=100)  # 最近请求的占用时长（秒）
+        self._waits = deque(maxlen=500)      # 最近排队请求的等待时长（秒）
+        self.stats = {"admitted": 0, "queued": 0, "rejected_full": 0, "rejected_deadline": 0,
+                      "timed_out": 0, "preempted": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.per_credential > 0
+
+    @property
+    def capacity(self) -> int:
+        return self.per_credential * max(1, self.available_slots())
+
+    def _estimate_wait(self, ahead: int) -> float:
+        """前面还有 ahead 个请求排队时的预计等待秒数"""
+        if not self._durations:
+            return 0.0
+        average = sum(self._durations) / len(self._durations)
+        return average * (ahead + 1) / self.capacity
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def _ahead_of(self, priority: int) -> int:
+        return sum(1 for w in self._queue if w.priority <= priority)
+
+    async def acquire(self, priority_class: str = DEFAULT_PRIORITY) -> AdmissionTicket:
+        """
+        等待准入
+
+        Returns:
+            准入凭据，请求结束时调用其 release()
+
+        Raises:
+            AdmissionRejected: 队列已满、预计等待超过 max_wait 或排队超时
+        """
+        self._wake()  # 容量可能随凭证池增大
+        if not self.enabled or (self.active < self.capacity and not self._queue):
+            self.active += 1
+            self.stats["admitted"] += 1
+            return AdmissionTicket(self, time.monotonic())
+
+        priority = PRIORITY_CLASSES.get(priority_class, PRIORITY_CLASSES[DEFAULT_PRIORITY])
+        estimate = self._estimate_wait(self._ahead_of(priority))
+        if estimate > self.max_wait:
+            self.stats["rejected_deadline"] += 1
+            raise AdmissionRejected("estimated queue wait exceeds the deadline", estimate)
+        if len(self._queue) >= self.queue_size:
+            # 队列已满：比队尾优先级高的请求挤掉最低优先级中最晚到达的一个
+            worst = max(self._queue)
+            if worst.priority <= priority:
+                self.stats["rejected_full"] += 1
+                raise AdmissionRejected("admission queue is full", self._estimate_wait(len(self._queue)))
+            self._queue.remove(worst)
+            heapq.heapify(self._queue)
+            worst.future.set_exception(AdmissionRejected("preempted by a higher-priority request",
+                                                         self._estimate_wait(len(self._queue))))
+            self.stats["preempted"] += 1
+
+        waiter = _Waiter(priority, next(self._seq), asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queue, waiter)
+        self.stats["queued"] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            self._drop(waiter)
+            self.stats["timed_out"] += 1
+            raise AdmissionRejected("timed out in the admission queue", self._estimate_wait(len(self._queue)))
+        except asyncio.CancelledError:
+            # 客户端断开：如果恰好已被准入，把名额交还
+            if not self._drop(waiter) and waiter.future.done() and waiter.future.exception() is None:
+                self.release(None)
+            raise
+        self._waits.append(time.monotonic() - waiter.enqueued)
+        return AdmissionTicket(self, waiter.future.result())
+
+    def _drop(self, waiter: _Waiter) -> bool:
+        """从队列中移除仍在等待的请求，返回是否移除成功"""
+        if waiter.future.done():
+            return False
+        waiter.future.cancel()
+        try:
+            self._queue.remove(waiter)
+            heapq.heapify(self._queue)
+        except ValueError:
+            pass
+        return True
+
+    def release(self, admitted_at: Optional[float]) -> None:
+        """请求结束，把名额交给队列中优先级最高的请求"""
+        if admitted_at is not None:
+            self._durations.append(time.monotonic() - admitted_at)
+        self.active = max(0, self.active - 1)
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._queue and self.active < self.capacity:
+            waiter = heapq.heappop(self._queue)
+            if waiter.future.done():
+                continue
+            self.active += 1
+            self.stats["admitted"] += 1
+            waiter.future.set_result(time.monotonic())
+
+    def to_stats(self) -> Dict[str, object]:
+        waits = sorted(self._waits)
+
+        def percentile(q: float) -> Optional[int]:
+            if not waits:
+                return None
+            return round(waits[max(0, math.ceil(q * len(waits)) - 1)] * 1000)
+
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "active": self.active,
+            "capacity": self.capacity if self.enabled else None,
+            "queue_depth": self.queue_depth,
+            "queue_by_priority": {name: sum(1 for w in self._queue if w.priority == value)
+                                  for name, value in PRIORITY_CLASSES.items()},
+            "wait_p50_ms": percentile(0.50),
+            "wait_p99_ms": percentile(0.99),
+        }
@@ -1,121 +1,185 @@
 """
 浏览器管理模块 - 有头模式版本
 基于 vvv 的实现，修改为可见浏览器窗口
+
+同一个持久化上下文中可以打开多个预热的 Vertex AI Studio 标签页，
+每个标签页对应凭证池中的一个槽位，可以各自独立地触发凭证抓取
 """
 
 import asyncio
-from typing import Optional, Callable
+import os
+import time
+from typing import Optional, Callable, List, Dict, Any
 from pathlib import Path
 
+from src.harvester import TARGET_URL_PATTERN
+from src.log import get_logger
+from src.resource_policy import ResourcePolicy
+
 try:
     from playwright.async_api import async_playwright, Browser, Page, BrowserContext
     PLAYWRIGHT_AVAILABLE = True
 except ImportError:
     PLAYWRIGHT_AVAILABLE = False
 
+log = get_logger(__name__)
 
-class HeadfulBrowser:
-    """有头浏览器管理器 - 可见窗口版本"""
+
+def browser_rss_mb() -> Optional[float]:
+    """
+    当前进程所有子孙进程（Playwright 驱动 + Chromium 各进程）的 RSS 之和，用于评估资源拦截的内存效果
+
+    共享页会被重复计算，只适合对比同一环境下开关拦截的差异；非 Linux 平台返回 None
+    """
+    try:
+        children: Dict[int, List[int]] = {}
+        rss_pages: Dict[int, int] = {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat", "rb") as f:
+                    # comm 可能包含空格 / 括号，从最后一个 ")" 之后开始解析
+                    fields = f.read().rsplit(b")", 1)[1].split()
+            except OSError:
+                continue
+            pid = int(entry)
+            children.setdefault(int(fields[1]), []).append(pid)
+            rss_pages[pid] = int(fields[21])
+    except OSError:
+        return None
+    total = 0
+    stack = list(children.get(os.getpid(), []))
+    while stack:
+        pid = stack.pop()
+        total += rss_pages.get(pid, 0)
+        stack.extend(children.get(pid, []))
+    return round(total * os.sysconf("SC_PAGE_SIZE") / 1048576, 1)
+
+# Vertex AI Studio URL
+VERTEX_AI_URL = "https://console.cloud.google.com/vertex-ai/studio/multimodal?mode=prompt&model=gemini-2.5-flash-lite-preview-09-2025"
+
+
+class BrowserTab:
+    """一个预热的 Vertex AI Studio 标签页"""
     
-    # Vertex AI Studio URL
-    VERTEX_AI_URL = "https://console.cloud.google.com/vertex-ai/studio/multimodal?mode=prompt&model=gemini-2.5-flash-lite-preview-09-2025"
+    VERTEX_AI_URL = VERTEX_AI_URL
     
-    # 用户数据目录 (保存登录态)
-    USER_DATA_DIR = "browser_data"
+    def __init__(self, page: "Page", index: int):
+        self.page = page
+        self.index = index
+        # 该标签页抓取到的凭证写入的槽位
+        self.slot_id = f"headful-{index}"
+        self.busy = False
+        self.fail_count = 0
+        self.harvest_count = 0
+        self.recycle_count = 0
+        self.last_load_ms: Optional[int] = None   # 导航到输入框可用的耗时（不含登录等待）
+        self.js_heap_mb: Optional[float] = None
+        self._harvest_waiter: Optional[asyncio.Future] = None
     
-    def __init__(self):
-        self.playwright = None
-        self.browser: Optional[Browser] = None
-        self.context: Optional[BrowserContext] = None
-        self.page: Optional[Page] = None
-        self._is_running = False
+    # 输入框选择器（与页面内 JS 查找顺序一致）
+    INPUT_SELECTOR = ', '.join([
+        'div[contenteditable="true"]',
+        'textarea[aria-label*="message"]',
+        'textarea[placeholder*="message"]',
+        'textarea[placeholder*="prompt"]',
+        '[role="textbox"]',
+    ])
     
-    @staticmethod
-    def check_availability() -> bool:
-        """检查 Playwright 是否可用"""
-        if not PLAYWRIGHT_AVAILABLE:
-            print("❌ Playwright 未安装，请运行: pip install playwright && playwright install chromium")
-            return False
-        return True
+    # 输入框已清空（消息已发送）
+    _INPUT_CLEARED_JS = '''() => {
+        const input = document.querySelector('div[contenteditable="true"], textarea[aria-label*="message"], textarea[placeholder*="message"]');
+        return input ? (input.value || input.textContent || '').trim() === '' : false;
+    }'''
     
-    async def start(self, headless: bool = False) -> bool:
-        """
-        启动浏览器 - 有头模式
-        
-        Args:
-            headless: 是否无头模式 (默认 False，显示窗口)
-        """
-        if not self.check_availability():
+    async def _wait_for_input(self, timeout: float = 10000) -> bool:
+        """等待输入框可见（页面可交互），代替固定等待"""
+        try:
+            await self.page.wait_for_selector(self.INPUT_SELECTOR, state="visible", timeout=timeout)
+            return True
+        except Exception:
             return False
-        
+    
+    async def _wait_for_input_cleared(self, timeout: float = 1000) -> bool:
+        """等待输入框被清空（消息已发出），清空后立即返回"""
         try:
-            print(f"🌐 正在启动浏览器 ({'无头' if headless else '有头'}模式)...")
-            
-            # 确保用户数据目录存在
-            user_data_path = Path(self.USER_DATA_DIR)
-            user_data_path.mkdir(parents=True, exist_ok=True)
-            
-            self.playwright = await async_playwright().start()
-            
-            # 启动参数
-            launch_args = [
-                '--no-sandbox',
-                '--disable-setuid-sandbox',
-                '--disable-dev-shm-usage',
-                '--disable-blink-features=AutomationControlled',
-            ]
-            
-            self.context = await self.playwright.chromium.launch_persistent_context(
-                user_data_dir=str(user_data_path),
-                headless=headless,
-                viewport={'width': 1920, 'height': 1080},
-                screen={'width': 1920, 'height': 1080},
-                device_scale_factor=1.0,
-                locale="en-US",
-                timezone_id="America/New_York",
-                args=launch_args,
-            )
-            
-            # 获取或创建页面
-            if self.context.pages:
-                self.page = self.context.pages[0]
-            else:
-                self.page = await self.context.new_page()
-            
-            self._is_running = True
-            print(f"✅ 浏览器已启动 (窗口: 1920x1080)")
+            await self.page.wait_for_function(self._INPUT_CLEARED_JS, timeout=timeout)
             return True
-            
-        except Exception as e:
-            print(f"❌ 浏览器启动失败: {e}")
+        except Exception:
             return False
     
+    async def _wait_hidden(self, selector: str, timeout: float = 1000) -> None:
+        """等待元素消失（对话框 / 遮罩关闭），超时不视为错误"""
+        try:
+            await self.page.wait_for_selector(selector, state="hidden", timeout=timeout)
+        except Exception:
+            pass
+    
+    def expect_harvest(self) -> "asyncio.Future":
+        """创建一个在该标签页下次抓取到凭证时完成的 future（需在触发请求前调用）"""
+        if self._harvest_waiter is None or self._harvest_waiter.done():
+            self._harvest_waiter = asyncio.get_running_loop().create_future()
+        return self._harvest_waiter
+    
+    def harvest_delivered(self) -> None:
+        """凭证已写入该标签页的槽位，唤醒等待者"""
+        waiter = self._harvest_waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(True)
+        self._harvest_waiter = None
+    
+    async def sample_metrics(self) -> None:
+        """采样页面 JS 堆占用（只含 JS 对象；图片解码等内存见 HeadfulBrowser 的进程 RSS）"""
+        try:
+            used = await self.page.evaluate("() => performance.memory ? performance.memory.usedJSHeapSize : null")
+            self.js_heap_mb = round(used / 1048576, 1) if used else None
+        except Exception:
+            pass
+    
+    def to_stats(self) -> Dict[str, Any]:
+        return {
+            "slot_id": self.slot_id,
+            "busy": self.busy,
+            "fail_count": self.fail_count,
+            "harvest_count": self.harvest_count,
+            "recycle_count": self.recycle_count,
+            "load_ms": self.last_load_ms,
+            "js_heap_mb": self.js_heap_mb,
+        }
+    
     async def navigate_to_vertex(self) -> bool:
         """导航到 Vertex AI Studio"""
         if not self.page:
-            print("❌ 浏览器未启动")
+            log.error("❌ 浏览器未启动")
             return False
         
         try:
-            print(f"🔗 正在导航到 Vertex AI Studio...")
+            log.info("🔗 正在导航到 Vertex AI Studio...")
             
             # 导航到页面
+            load_started = time.monotonic()
             await self.page.goto(self.VERTEX_AI_URL, wait_until="domcontentloaded", timeout=30000)
             
             # 检查是否需要登录
             current_url = self.page.url
             if "accounts.google.com" in current_url:
-                print("⚠️ 需要登录 Google 账号")
-                print("   请在浏览器窗口中完成登录...")
+                log.warning("⚠️ 需要登录 Google 账号")
+                log.info("   请在浏览器窗口中完成登录...")
                 # 等待用户登录 (最多5分钟)
                 try:
                     await self.page.wait_for_url("**/vertex-ai/**", timeout=300000)
-                    print("✅ 登录成功")
+                    log.info("✅ 登录成功")
+                    load_started = time.monotonic()
                 except:
-                    print("❌ 登录超时")
+                    log.error("❌ 登录超时")
                     return False
             
-            await asyncio.sleep(3)
+            # 等待输入框出现（页面可交互）即可，不做固定等待
+            if await self._wait_for_input(15000):
+                self.last_load_ms = round((time.monotonic() - load_started) * 1000)
+                log.debug("   ⏱️ 页面可交互耗时: %s ms", self.last_load_ms)
+            await self.sample_metrics()
             
             # 检查并处理条款对话框
             await self._check_and_accept_terms()
@@ -123,11 +187,11 @@ class HeadfulBrowser:
             # 关闭其他 overlay
             await self._dismiss_overlays()
             
-            print("✅ 已到达 Vertex AI Studio")
+            log.info("✅ 已到达 Vertex AI Studio")
             return True
             
         except Exception as e:
-            print(f"❌ 导航失败: {e}")
+            log.error("❌ 导航失败: %s", e)
             return False
     
     async def _check_and_accept_terms(self) -> bool:
@@ -174,7 +238,7 @@ class HeadfulBrowser:
             if not terms_element:
                 return False
             
-            print("📜 检测到服务条款对话框，正在自动同意...")
+            log.info("📜 检测到服务条款对话框，正在自动同意...")
             
             # 3. 智能滚动条款内容到底部
             await self.page.evaluate('''() => {
@@ -195,7 +259,7 @@ class HeadfulBrowser:
                             // 平滑滚动到底部
                             container.scrollTo({
                                 top: container.scrollHeight,
-                                behavior: 'smooth'
+                                behavior: 'instant'
                             });
                         }
                     }
@@ -204,13 +268,11 @@ class HeadfulBrowser:
                 // 备选：查找条款文本并滚动
                 const termsText = document.querySelector('p.notranslate');
                 if (termsText) {
-                    termsText.scrollIntoView({ block: 'end', behavior: 'smooth' });
+                    termsText.scrollIntoView({ block: 'end', behavior: 'instant' });
                 }
             }''')
             
-            # 最小等待滚动完成
-            await asyncio.sleep(0.1)
-            print("   ✓ 已滚动到条款底部")
+            log.debug("   ✓ 已滚动到条款底部")
             
             # 4. 尝试勾选同意复选框（如果存在）
             CHECKBOX_SELECTORS = [
@@ -238,10 +300,9 @@ class HeadfulBrowser:
                     is_checked = await checkbox.is_checked()
                     if not is_checked:
                         await checkbox.click()
-                        await asyncio.sleep(0.05)
-                    print("   ✓ 已勾选同意复选框")
+                    log.debug("   ✓ 已勾选同意复选框")
                 except:
-                    print("   ℹ️ 复选框处理失败（可能不需要）")
+                    log.debug("   ℹ️ 复选框处理失败（可能不需要）")
             
             # 5. 点击同意按钮（快速版本）
             BUTTON_SELECTORS = [
@@ -274,19 +335,19 @@ class HeadfulBrowser:
             if agree_button:
                 # 直接点击，最小化延迟
                 await agree_button.click()
-                await asyncio.sleep(0.2)
-                print("   ✓ 已点击同意按钮")
-                print("✅ 条款已自动同意")
+                await self._wait_hidden('[role="dialog"]', 2000)
+                log.debug("   ✓ 已点击同意按钮")
+                log.info("✅ 条款已自动同意")
                 return True
             else:
                 # 备选：尝试按 Enter 键
-                print("   ⚠️ 未找到同意按钮，尝试按 Enter...")
+                log.warning("   ⚠️ 未找到同意按钮，尝试按 Enter...")
                 await self.page.keyboard.press("Enter")
-                await asyncio.sleep(0.2)
+                await self._wait_hidden('[role="dialog"]', 2000)
                 return True
             
         except Exception as e:
-            print(f"   ⚠️ 处理条款对话框时出错: {e}")
+            log.warning("   ⚠️ 处理条款对话框时出错: %s", e)
             return False
     
     async def _dismiss_overlays(self) -> None:
@@ -328,10 +389,10 @@ class HeadfulBrowser:
                 }
             }''')
             
-            await asyncio.sleep(0.3)
+            await self._wait_hidden('.cdk-overlay-backdrop-showing')
             
         except Exception as e:
-            print(f"   ⚠️ 关闭 overlay 时出错: {e}")
+            log.warning("   ⚠️ 关闭 overlay 时出错: %s", e)
     
     async def send_test_message(self, max_retries: int = 3) -> bool:
         """发送测试消息触发 API 请求 - 增强版"""
@@ -341,18 +402,16 @@ class HeadfulBrowser:
         for attempt in range(max_retries):
             try:
                 if attempt > 0:
-                    print(f"💬 重试发送测试消息 ({attempt + 1}/{max_retries})...")
+                    log.info("💬 重试发送测试消息 (%s/%s)...", attempt + 1, max_retries)
                 else:
-                    print("💬 正在发送测试消息...")
+                    log.info("💬 正在发送测试消息...")
                 
-                # 1. 先检查条款，再关闭其他 overlay
+                # 1. 先检查条款，再关闭其他 overlay（两者都会等待对话框 / 遮罩消失）
                 await self._check_and_accept_terms()
-                await asyncio.sleep(0.5)
                 await self._dismiss_overlays()
-                await asyncio.sleep(0.5)
                 
-                # 2. 等待页面稳定
-                await asyncio.sleep(1)
+                # 2. 等待输入框可用
+                await self._wait_for_input(5000)
                 
                 # 3. 使用增强的 JavaScript 输入和发送逻辑
                 result = await self.page.evaluate('''() => {
@@ -416,14 +475,13 @@ class HeadfulBrowser:
                 
                 if not result.get('success'):
                     if attempt < max_retries - 1:
-                        print(f"   ⚠️ {result.get('error', '未知错误')}，重试中...")
-                        await asyncio.sleep(1)
+                        log.warning("   ⚠️ %s，重试中...", result.get('error', '未知错误'))
+                        await self._wait_for_input(2000)
                         continue
-                    print(f"❌ 发送失败: {result.get('error')}")
+                    log.error("❌ 发送失败: %s", result.get('error'))
                     return False
                 
-                print(f"   ✍️ 已输入消息到 {result.get('inputType')} 元素")
-                await asyncio.sleep(0.3)
+                log.debug("   ✍️ 已输入消息到 %s 元素", result.get('inputType'))
                 
                 # 4. 尝试多种发送方式
                 sent = await self.page.evaluate('''() => {
@@ -439,39 +497,27 @@ class HeadfulBrowser:
                             cancelable: true
                         });
                         input.dispatchEvent(enterEvent);
-                        
-                        // 等待一小段时间检查是否清空
-                        return new Promise(resolve => {
-                            setTimeout(() => {
-                                const cleared = (input.value || input.textContent || '').trim() === '';
-                                resolve({ method: 'enter', cleared });
-                            }, 500);
-                        });
+                        return { method: 'enter', dispatched: true };
                     }
-                    return { method: 'none', cleared: false };
+                    return { method: 'none', dispatched: false };
                 }''')
                 
-                if sent.get('cleared'):
-                    print(f"   ✅ 消息已通过 {sent.get('method')} 方式发送")
+                # 输入框一清空就说明已发送，不再固定等待
+                if sent.get('dispatched') and await self._wait_for_input_cleared(500):
+                    log.debug("   ✅ 消息已通过 %s 方式发送", sent.get('method'))
                     return True
                 
                 # 方法 2: 按 Enter 键（通过 Playwright）
-                print("   → 尝试 Playwright keyboard.press...")
+                log.debug("   → 尝试 Playwright keyboard.press...")
                 await self.page.keyboard.press("Enter")
-                await asyncio.sleep(0.5)
                 
                 # 检查是否清空
-                cleared = await self.page.evaluate('''() => {
-                    const input = document.querySelector('div[contenteditable="true"], textarea[aria-label*="message"], textarea[placeholder*="message"]');
-                    return input ? (input.value || input.textContent || '').trim() === '' : false;
-                }''')
-                
-                if cleared:
-                    print("   ✅ 消息已发送（输入框已清空）")
+                if await self._wait_for_input_cleared(500):
+                    log.debug("   ✅ 消息已发送（输入框已清空）")
                     return True
                 
                 # 方法 3: 查找并点击发送按钮
-                print("   → 尝试查找发送按钮...")
+                log.debug("   → 尝试查找发送按钮...")
                 button_clicked = await self.page.evaluate('''() => {
                     const buttonSelectors = [
                         'button[aria-label*="Send"]',
@@ -494,53 +540,298 @@ class HeadfulBrowser:
                 }''')
                 
                 if button_clicked:
-                    await asyncio.sleep(0.5)
-                    cleared = await self.page.evaluate('''() => {
-                        const input = document.querySelector('div[contenteditable="true"], textarea[aria-label*="message"], textarea[placeholder*="message"]');
-                        return input ? (input.value || input.textContent || '').trim() === '' : false;
-                    }''')
-                    
-                    if cleared:
-                        print("   ✅ 消息已通过按钮发送")
+                    if await self._wait_for_input_cleared(500):
+                        log.debug("   ✅ 消息已通过按钮发送")
                         return True
                 
                 if attempt < max_retries - 1:
-                    print("   ⚠️ 消息未能发送，重试中...")
-                    await asyncio.sleep(1)
+                    log.warning("   ⚠️ 消息未能发送，重试中...")
+                    await self._wait_for_input(2000)
                     continue
                 
-                print("❌ 所有发送方式均失败")
+                log.error("❌ 所有发送方式均失败")
                 return False
                 
             except Exception as e:
                 error_msg = str(e)
                 if "intercepts pointer events" in error_msg and attempt < max_retries - 1:
-                    print(f"   ⚠️ 检测到 overlay 遮挡，尝试关闭...")
+                    log.warning("   ⚠️ 检测到 overlay 遮挡，尝试关闭...")
                     await self._dismiss_overlays()
-                    await asyncio.sleep(0.5)
                     continue
                 elif attempt < max_retries - 1:
-                    print(f"   ⚠️ 发送失败: {error_msg[:50]}，重试中...")
-                    await asyncio.sleep(1)
+                    log.warning("   ⚠️ 发送失败: %s，重试中...", error_msg[:50])
+                    await self._wait_for_input(2000)
                     continue
                 else:
-                    print(f"❌ 发送消息失败: {e}")
+                    log.error("❌ 发送消息失败: %s", e)
                     return False
         
         return False
+
+
+class HeadfulBrowser:
+    """有头浏览器管理器 - 可见窗口版本，管理一个标签页池"""
     
-    async def setup_request_interception(self, on_request: Callable) -> None:
-        """设置请求拦截"""
-        if not self.page:
+    VERTEX_AI_URL = VERTEX_AI_URL
+    
+    # 用户数据目录 (保存登录态)
+    USER_DATA_DIR = "browser_data"
+    
+    DEFAULT_VIEWPORT = (1920, 1080)
+    
+    # 浏览器进程树 RSS 的最短采样间隔（秒）
+    RSS_SAMPLE_INTERVAL = 10.0
+    
+    def __init__(self, pool_size: int = 1, viewport: Optional[tuple] = None,
+                 resource_policy: Optional[ResourcePolicy] = None):
+        """
+        Args:
+            pool_size: 预热的标签页数量（每个标签页一个凭证槽位）
+            viewport: 窗口大小 (宽, 高)，较小的窗口可以降低渲染开销
+            resource_policy: 资源拦截策略，None 表示不拦截
+        """
+        self.viewport = tuple(viewport) if viewport else self.DEFAULT_VIEWPORT
+        self.resource_policy = resource_policy
+        self.playwright = None
+        self.browser: Optional[Browser] = None
+        self.context: Optional[BrowserContext] = None
+        self.pool_size = max(1, pool_size)
+        self.tabs: List[BrowserTab] = []
+        self._on_request: Optional[Callable] = None
+        self._is_running = False
+        self._rss_mb: Optional[float] = None
+        self._rss_sampled = 0.0
+        self._rss_task: Optional["asyncio.Future"] = None
+    
+    @staticmethod
+    def check_availability() -> bool:
+        """检查 Playwright 是否可用"""
+        if not PLAYWRIGHT_AVAILABLE:
+            log.error("❌ Playwright 未安装，请运行: pip install playwright && playwright install chromium")
+            return False
+        return True
+    
+    @property
+    def page(self) -> Optional["Page"]:
+        """第一个标签页（兼容单页面用法）"""
+        return self.tabs[0].page if self.tabs else None
+    
+    async def start(self, headless: bool = False) -> bool:
+        """
+        启动浏览器 - 有头模式
+        
+        Args:
+            headless: 是否无头模式 (默认 False，显示窗口)
+        """
+        if not self.check_availability():
+            return False
+        
+        try:
+            log.info("🌐 正在启动浏览器 (%s模式, %s 个标签页)...", '无头' if headless else '有头', self.pool_size)
+            
+            # 确保用户数据目录存在
+            user_data_path = Path(self.USER_DATA_DIR)
+            user_data_path.mkdir(parents=True, exist_ok=True)
+            
+            self.playwright = await async_playwright().start()
+            
+            # 启动参数
+            launch_args = [
+                '--no-sandbox',
+                '--disable-setuid-sandbox',
+                '--disable-dev-shm-usage',
+                '--disable-blink-features=AutomationControlled',
+            ]
+            if self.pool_size > 1:
+                # 后台标签页也需要及时响应（否则定时器会被节流）
+                launch_args += [
+                    '--disable-background-timer-throttling',
+                    '--disable-backgrounding-occluded-windows',
+                    '--disable-renderer-backgrounding',
+                ]
+            
+            self.context = await self.playwright.chromium.launch_persistent_context(
+                user_data_dir=str(user_data_path),
+                headless=headless,
+                viewport={'width': self.viewport[0], 'height': self.viewport[1]},
+                screen={'width': self.viewport[0], 'height': self.viewport[1]},
+                device_scale_factor=1.0,
+                locale="en-US",
+                timezone_id="America/New_York",
+                args=launch_args,
+            )
+            
+            # URL 拒绝列表在上下文级别生效，覆盖所有（包括回收后新建的）标签页
+            if self.resource_policy and self.resource_policy.route_pattern is not None:
+                await self.context.route(self.resource_policy.route_pattern, self.resource_policy.handle_route)
+            
+            # 获取或创建页面
+            pages = list(self.context.pages)
+            while len(pages) < self.pool_size:
+                pages.append(await self.context.new_page())
+            self.tabs = [BrowserTab(page, i) for i, page in enumerate(pages[:self.pool_size])]
+            for tab in self.tabs:
+                await self._attach_resource_policy(tab)
+            if self.resource_policy and self.resource_policy.enabled:
+                log.info("🚫 资源拦截已启用: %s", ', '.join(sorted(self.resource_policy.blocked_types)) or '仅 URL 规则')
+            
+            self._is_running = True
+            log.info("✅ 浏览器已启动 (窗口: %sx%s)", self.viewport[0], self.viewport[1])
+            return True
+            
+        except Exception as e:
+            log.error("❌ 浏览器启动失败: %s", e)
+            return False
+    
+    async def navigate_to_vertex(self) -> bool:
+        """所有标签页导航到 Vertex AI Studio（第一个标签页负责登录，其余标签页随后并发打开）"""
+        if not self.tabs:
+            log.error("❌ 浏览器未启动")
+            return False
+        
+        if not await self.tabs[0].navigate_to_vertex():
+            return False
+        
+        if len(self.tabs) > 1:
+            results = await asyncio.gather(*(tab.navigate_to_vertex() for tab in self.tabs[1:]))
+            log.info("✅ 标签页池就绪: %s/%s", 1 + sum(results), len(self.tabs))
+        return True
+    
+    async def _dismiss_overlays(self) -> None:
+        """关闭第一个标签页上的 overlay（兼容单页面用法）"""
+        if self.tabs:
+            await self.tabs[0]._dismiss_overlays()
+    
+    async def send_test_message(self, max_retries: int = 3) -> bool:
+        """在第一个标签页发送测试消息（兼容单页面用法）"""
+        if not self.tabs:
+            return False
+        return await self.tabs[0].send_test_message(max_retries)
+    
+    def acquire_tab(self, tab: BrowserTab) -> bool:
+        """标记标签页为使用中；已被占用时返回 False"""
+        if tab.busy or tab not in self.tabs:
+            return False
+        tab.busy = True
+        return True
+    
+    def release_tab(self, tab: BrowserTab) -> None:
+        tab.busy = False
+    
+    def idle_tabs(self) -> List[BrowserTab]:
+        return [tab for tab in self.tabs if not tab.busy]
+    
+    async def recover_tab(self, tab: BrowserTab) -> bool:
+        """
+        恢复卡住的标签页，不重启浏览器：先刷新页面，再重新导航，最后关闭并替换为新标签页
+        
+        Returns:
+            标签页是否已恢复到可用状态（不保证已抓取到新凭证）
+        """
+        # 策略1: 刷新当前页面
+        try:
+            log.debug("   📍 [%s] 策略1: 刷新当前页面...", tab.slot_id)
+            await tab._dismiss_overlays()
+            await tab.page.reload(wait_until="domcontentloaded", timeout=15000)
+            if not await tab._wait_for_input(15000):
+                raise TimeoutError("input not ready after reload")
+            await tab._dismiss_overlays()
+            return True
+        except Exception as e:
+            log.warning("   ⚠️ [%s] 页面刷新失败: %s", tab.slot_id, str(e)[:50])
+        
+        # 策略2: 重定向到 Vertex AI Studio
+        try:
+            log.debug("   📍 [%s] 策略2: 重定向到 Vertex AI Studio...", tab.slot_id)
+            if await tab.navigate_to_vertex():
+                return True
+        except Exception as e:
+            log.warning("   ⚠️ [%s] 重定向失败: %s", tab.slot_id, str(e)[:50])
+        
+        # 策略3: 关闭标签页，在同一个上下文中打开新的标签页
+        return await self.recycle_tab(tab)
+    
+    async def recycle_tab(self, tab: BrowserTab) -> bool:
+        """关闭卡住的标签页并在原位置打开一个新的（沿用同一个槽位）"""
+        if not self.context:
+            return False
+        log.info("♻️ [%s] 回收标签页...", tab.slot_id)
+        try:
+            await tab.page.close()
+        except Exception:
+            pass
+        try:
+            tab.page = await self.context.new_page()
+        except Exception as e:
+            log.error("❌ [%s] 无法创建新标签页: %s", tab.slot_id, e)
+            return False
+        tab.recycle_count += 1
+        tab.fail_count = 0
+        await self._attach_resource_policy(tab)
+        await self._attach_interception(tab)
+        return await tab.navigate_to_vertex()
+    
+    async def _attach_resource_policy(self, tab: BrowserTab) -> None:
+        """资源类型拦截在 CDP 层按标签页启用"""
+        if not self.resource_policy:
+            return
+        try:
+            await self.resource_policy.attach(self.context, tab.page)
+        except Exception as e:
+            log.warning("⚠️ [%s] 资源类型拦截启用失败: %s", tab.slot_id, e)
+    
+    async def _attach_interception(self, tab: BrowserTab) -> None:
+        if not self._on_request:
             return
+        on_request = self._on_request
         
-        async def handle_request(request):
-            url = request.url
-            if "batchGraphql" in url or "StreamGenerateContent" in url:
-                await on_request(request)
+        async def handle_route(route):
+            # 先放行，抓取不阻塞页面自身的请求
+            await route.continue_()
+            await on_request(route.request, tab.slot_id)
         
-        self.page.on("request", handle_request)
-        print("🔍 请求拦截已设置")
+        # URL 过滤在 Playwright 中完成：控制台的静态资源、埋点等请求不会进入 Python
+        await tab.page.route(TARGET_URL_PATTERN, handle_route)
+    
+    async def setup_request_interception(self, on_request: Callable) -> None:
+        """
+        设置请求拦截（只拦截 batchGraphql / StreamGenerateContent）
+        
+        Args:
+            on_request: 回调 (request, slot_id)，slot_id 为发出请求的标签页对应的槽位
+        """
+        self._on_request = on_request
+        for tab in self.tabs:
+            await self._attach_interception(tab)
+        log.info("🔍 请求拦截已设置")
+    
+    def notify_harvest(self, slot_id: str) -> None:
+        """凭证回调：唤醒在该槽位对应标签页上等待抓取结果的刷新"""
+        for tab in self.tabs:
+            if tab.slot_id == slot_id:
+                tab.harvest_delivered()
+                return
+    
+    def get_pool_stats(self) -> List[Dict[str, Any]]:
+        return [tab.to_stats() for tab in self.tabs]
+    
+    def get_resource_stats(self) -> Dict[str, Any]:
+        stats = self.resource_policy.to_stats() if self.resource_policy else {}
+        self._sample_rss()
+        return {**stats, "browser_rss_mb": self._rss_mb}
+    
+    def _sample_rss(self) -> None:
+        """在线程池中重新采样进程 RSS（扫描 /proc 不阻塞事件循环），返回的是上一次的采样值"""
+        if self._rss_task is not None or time.monotonic() - self._rss_sampled < self.RSS_SAMPLE_INTERVAL:
+            return
+        self._rss_sampled = time.monotonic()
+        self._rss_task = asyncio.ensure_future(asyncio.to_thread(browser_rss_mb))
+        self._rss_task.add_done_callback(self._rss_sampled_done)
+    
+    def _rss_sampled_done(self, task: "asyncio.Future") -> None:
+        self._rss_task = None
+        if not task.cancelled() and task.exception() is None:
+            self._rss_mb = task.result()
     
     async def close(self) -> None:
         """关闭浏览器"""
@@ -549,14 +840,14 @@ class HeadfulBrowser:
         if self.context:
             await self.context.close()
             self.context = None
-            self.page = None
+            self.tabs = []
         
         if self.playwright:
             await self.playwright.stop()
             self.playwright = None
         
-        print("🔒 浏览器已关闭")
+        log.info("🔒 浏览器已关闭")
     
     @property
     def is_running(self) -> bool:
-        return self._is_running
\ No newline at end of file
+        return self._is_running
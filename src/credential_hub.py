@@ -0,0 +1,180 @@
+"""
+多进程凭证分发模块
+一个 hub 进程（浏览器 / harvester、凭证管理、刷新协调）通过 Unix socket 把凭证推送给 N 个 API worker 进程，
+worker 把刷新请求和用量统计发回 hub。消息为换行分隔的 JSON，新连接的 worker 先收到完整快照
+"""
+
+import asyncio
+import inspect
+import json
+import os
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Union
+
+from src.log import get_logger
+
+log = get_logger(__name__)
+
+MAX_MESSAGE_BYTES = 16 * 1024 * 1024
+# 单个 worker 未读取的广播数据上限；超过时断开该 worker（它会重连并重新收到完整快照）
+MAX_PENDING_BYTES = 4 * MAX_MESSAGE_BYTES
+
+Message = Dict[str, Any]
+Handler = Callable[[Message], Union[None, Awaitable[None]]]
+
+
+def encode(message: Message) -> bytes:
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+async def _dispatch(handler: Handler, message: Message) -> None:
+    result = handler(message)
+    if inspect.isawaitable(result):
+        await result
+
+
+class CredentialHub:
+    """hub 端：接受 worker 连接、广播消息、处理 worker 发来的消息"""
+
+    def __init__(self, path: str, snapshot: Callable[[], List[Message]], on_message: Handler):
+        """
+        Args:
+            path: Unix socket 路径
+            snapshot: 返回新连接的 worker 需要的全部消息（当前所有凭证等）
+            on_message: 处理 worker 发来的消息
+        """
+        self.path = path
+        self.snapshot = snapshot
+        self.on_message = on_message
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers: Set[asyncio.StreamWriter] = set()
+        self.stats = {"connections": 0, "published": 0, "received": 0, "errors": 0, "dropped": 0}
+
+    @property
+    def workers(self) -> int:
+        return len(self._writers)
+
+    async def start(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)  # 上次异常退出留下的 socket 文件
+        self._server = await asyncio.start_unix_server(self._handle, path=self.path, limit=MAX_MESSAGE_BYTES)
+        os.chmod(self.path, 0o600)
+
+    async def close(self) -> None:
+        for writer in list(self._writers):
+            writer.close()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.stats["connections"] += 1
+        try:
+            # 先登记再写快照（两者之间没有 await）：等待 drain 期间的广播排在快照之后，不会漏掉
+            self._writers.add(writer)
+            for message in self.snapshot():
+                writer.write(encode(message))
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.stats["received"] += 1
+                try:
+                    await _dispatch(self.on_message, json.loads(line))
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    log.warning("⚠️ Error handling worker message: %s", e)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+            log.warning("⚠️ Worker connection error: %s", e)
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    def broadcast(self, message: Message) -> None:
+        """发给所有已连接的 worker（只写入缓冲区，不等待；读取跟不上的 worker 被断开，缓冲不会无限增长）"""
+        data = encode(message)
+        for writer in list(self._writers):
+            if writer.is_closing():
+                self._writers.discard(writer)
+                continue
+            if writer.transport.get_write_buffer_size() + len(data) > MAX_PENDING_BYTES:
+                log.warning("⚠️ Worker is not reading its messages, disconnecting it")
+                self.stats["dropped"] += 1
+                self._writers.discard(writer)
+                writer.close()
+                continue
+            writer.write(data)
+        self.stats["published"] += 1
+
+    def to_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "workers": self.workers}
+
+
+class HubClient:
+    """worker 端：连接 hub、接收推送、发送消息（断线期间的消息暂存，重连后补发）"""
+
+    def __init__(self, path: str, worker_id: str, on_message: Handler,
+                 reconnect_delay: float = 1.0, backlog: int = 1000):
+        self.path = path
+        self.worker_id = worker_id
+        self.on_message = on_message
+        self.reconnect_delay = reconnect_delay
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._backlog = deque(maxlen=backlog)
+        self.connected_event = asyncio.Event()
+        self.stats = {"connects": 0, "sent": 0, "received": 0, "dropped": 0}
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    def send(self, message: Message) -> None:
+        if self.connected:
+            self._writer.write(encode(message))
+            self.stats["sent"] += 1
+            return
+        if len(self._backlog) == self._backlog.maxlen:
+            self.stats["dropped"] += 1
+        self._backlog.append(message)
+
+    async def run(self) -> None:
+        """连接并持续接收 hub 的消息，断线后自动重连"""
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=MAX_MESSAGE_BYTES)
+            except OSError:
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+            self._writer = writer
+            self.stats["connects"] += 1
+            self.send({"type": "hello", "worker": self.worker_id})
+            while self._backlog:
+                self.send(self._backlog.popleft())
+            self.connected_event.set()
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    self.stats["received"] += 1
+                    try:
+                        await _dispatch(self.on_message, json.loads(line))
+                    except Exception as e:
+                        log.warning("⚠️ Error handling hub message: %s", e)
+            except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+                log.warning("⚠️ Lost connection to credential hub: %s", e)
+            finally:
+                self._writer = None
+                self.connected_event.clear()
+                writer.close()
+            log.info("🔌 Credential hub disconnected, reconnecting...")
+            await asyncio.sleep(self.reconnect_delay)
+
+    def to_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "connected": self.connected, "backlog": len(self._backlog)}
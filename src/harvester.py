@@ -3,22 +3,35 @@
 从浏览器拦截的请求中提取凭证信息
 """
 
-import json
+import re
 import time
 from typing import Dict, Any, Optional, Callable
 
+from src.log import get_logger
+
+log = get_logger(__name__)
+
+# 目标请求 URL 特征
+TARGET_PATTERNS = [
+    "batchGraphql",
+    "StreamGenerateContent"
+]
+
+# 供 Playwright page.route 使用：只有匹配的请求才会进入 Python
+TARGET_URL_PATTERN = re.compile("|".join(re.escape(p) for p in TARGET_PATTERNS))
+
+# 只捕获实际的生成内容请求（请求体中的关键字）
+CONTENT_KEYWORDS = ('StreamGenerateContent', 'generateContent', 'Predict', 'Image')
+
 
 class CredentialHarvester:
     """凭证抓取器"""
     
-    # 目标请求 URL 特征
-    TARGET_PATTERNS = [
-        "batchGraphql",
-        "StreamGenerateContent"
-    ]
+    TARGET_PATTERNS = TARGET_PATTERNS
+    TARGET_URL_PATTERN = TARGET_URL_PATTERN
     
     # 需要提取的 Headers
-    IMPORTANT_HEADERS = [
+    IMPORTANT_HEADERS = (
         "authorization",
         "x-goog-authuser",
         "x-goog-first-party-reauth",
@@ -33,12 +46,12 @@ class CredentialHarvester:
         "sec-fetch-site",
         "sec-fetch-mode",
         "sec-fetch-dest",
-    ]
+    )
     
     def __init__(self, on_credentials: Optional[Callable] = None):
         """
         Args:
-            on_credentials: 获取到凭证时的回调函数
+            on_credentials: 获取到凭证时的回调函数 (credentials, slot_id)
         """
         self.on_credentials = on_credentials
         self.last_credentials: Optional[Dict[str, Any]] = None
@@ -46,14 +59,15 @@ class CredentialHarvester:
     
     def is_target_request(self, url: str) -> bool:
         """检查是否为目标请求"""
-        return any(pattern in url for pattern in self.TARGET_PATTERNS)
+        return self.TARGET_URL_PATTERN.search(url) is not None
     
-    async def handle_request(self, request) -> None:
+    async def handle_request(self, request, slot_id: Optional[str] = None) -> None:
         """
         处理拦截到的请求
         
         Args:
             request: Playwright Request 对象
+            slot_id: 发出请求的标签页对应的凭证槽位
         """
         url = request.url
         
@@ -61,36 +75,29 @@ class CredentialHarvester:
             return
         
         try:
-            # 提取 Headers
+            # 提取请求体（同步属性，无需往返浏览器）
+            try:
+                body_str = request.post_data or ""
+            except Exception:
+                body_str = ""
+            
+            # 过滤：只捕获实际的生成内容请求。先按关键字判断，避免为无关请求读取 Headers；
+            # 不在这里解析 JSON，请求体会在编译请求模板时解析一次
+            if not any(kw in body_str for kw in CONTENT_KEYWORDS):
+                return
+            
+            # 提取 Headers：一次遍历建立小写索引，再按需查找
             all_headers = await request.all_headers()
+            header_index = {h_key.lower(): (h_key, h_value) for h_key, h_value in all_headers.items()}
             headers = {}
-            
             for key in self.IMPORTANT_HEADERS:
-                for h_key, h_value in all_headers.items():
-                    if h_key.lower() == key.lower():
-                        headers[h_key] = h_value
-                        break
+                hit = header_index.get(key)
+                if hit is not None:
+                    headers[hit[0]] = hit[1]
             
             # 提取 Cookie
-            cookies = all_headers.get("cookie", "")
-            
-            # 提取请求体
-            body_str = ""
-            try:
-                post_data = request.post_data
-                if post_data:
-                    body_str = post_data
-                    # 验证是否为有效的 JSON
-                    json.loads(body_str)
-            except:
-                pass
-            
-            # 过滤：只捕获实际的生成内容请求
-            CONTENT_KEYWORDS = ['StreamGenerateContent', 'generateContent', 'Predict', 'Image']
-            is_content_request = any(kw in body_str for kw in CONTENT_KEYWORDS)
-            
-            if not is_content_request:
-                return
+            cookie = header_index.get("cookie")
+            cookies = cookie[1] if cookie else ""
             
             # 创建凭证对象 - 注意 body 必须是字符串格式，与 main.py 中的 json.loads(creds['body']) 匹配
             credentials = {
@@ -104,26 +111,26 @@ class CredentialHarvester:
             self.last_credentials = credentials
             self._capture_count += 1
             
-            print(f"🎯 捕获凭证 #{self._capture_count}")
-            print(f"   URL: {url[:80]}...")
-            print(f"   Headers: {len(headers)} 个")
+            log.info("🎯 捕获凭证 #%s%s", self._capture_count, f" ({slot_id})" if slot_id else "")
+            log.debug("   URL: %s...", url[:80])
+            log.debug("   Headers: %s 个", len(headers))
             
             # 调用回调
             if self.on_credentials:
-                await self._call_callback(credentials)
+                await self._call_callback(credentials, slot_id)
                 
         except Exception as e:
-            print(f"⚠️ 处理请求时出错: {e}")
+            log.warning("⚠️ 处理请求时出错: %s", e)
     
-    async def _call_callback(self, credentials: Dict[str, Any]) -> None:
+    async def _call_callback(self, credentials: Dict[str, Any], slot_id: Optional[str]) -> None:
         """调用凭证回调"""
         try:
-            result = self.on_credentials(credentials)
+            result = self.on_credentials(credentials, slot_id)
             # 支持异步回调
             if hasattr(result, '__await__'):
                 await result
         except Exception as e:
-            print(f"⚠️ 凭证回调出错: {e}")
+            log.warning("⚠️ 凭证回调出错: %s", e)
     
     def get_credentials(self) -> Optional[Dict[str, Any]]:
         """获取最新凭证"""
@@ -0,0 +1,247 @@
+"""
+Harvester 注册表模块
+跟踪每个通过 WebSocket 连接的油猴脚本（身份、最近活跃时间、成功率、刷新延迟），
+刷新请求只发给一个健康的 harvester，超过截止时间仍未返回凭证时再对冲发给第二个
+"""
+
+import asyncio
+import json
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+from src.log import get_logger
+
+log = get_logger(__name__)
+
+
+class HarvesterClient:
+    """一个已连接的 harvester"""
+
+    # 计算成功率时使用的先验（新连接的 harvester 视为 50% 成功率，避免被饿死）
+    PRIOR_SUCCESSES = 1
+    PRIOR_ATTEMPTS = 2
+
+    def __init__(self, websocket: Any, slot_id: str, client_name: str = "harvester"):
+        self.websocket = websocket
+        self.slot_id = slot_id
+        self.client_name = client_name
+        self.connected_at = time.time()
+        self.last_seen = self.connected_at
+        self.refresh_requests = 0
+        self.refresh_successes = 0
+        self.refresh_failures = 0
+        self.latencies = deque(maxlen=50)  # 秒
+        self._pending: Optional[asyncio.Future] = None
+        self._sent_at = 0.0
+
+    @property
+    def busy(self) -> bool:
+        """是否有尚未完成的刷新请求"""
+        return self._pending is not None and not self._pending.done()
+
+    @property
+    def success_rate(self) -> float:
+        return (self.refresh_successes + self.PRIOR_SUCCESSES) / (self.refresh_requests + self.PRIOR_ATTEMPTS)
+
+    @property
+    def median_latency(self) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[len(ordered) // 2]
+
+    def begin_refresh(self) -> "asyncio.Future":
+        self._pending = asyncio.get_running_loop().create_future()
+        self._sent_at = time.monotonic()
+        self.refresh_requests += 1
+        return self._pending
+
+    def delivered(self) -> None:
+        """该 harvester 发来了新凭证"""
+        self.last_seen = time.time()
+        if self.busy:
+            self.latencies.append(time.monotonic() - self._sent_at)
+            self.refresh_successes += 1
+            self._pending.set_result(True)
+
+    def abandon_refresh(self) -> None:
+        """刷新请求超时或发送失败"""
+        if self.busy:
+            self.refresh_failures += 1
+            self._pending.cancel()
+        self._pending = None
+
+    def to_stats(self, now: Optional[float] = None) -> Dict[str, Any]:
+        now = now or time.time()
+        median = self.median_latency
+        return {
+            "client": self.client_name,
+            "slot": self.slot_id,
+            "connected_for": int(now - self.connected_at),
+            "last_seen": int(now - self.last_seen),
+            "busy": self.busy,
+            "requests": self.refresh_requests,
+            "successes": self.refresh_successes,
+            "failures": self.refresh_failures,
+            "success_rate": round(self.success_rate, 3),
+            "latency_p50_ms": round(median * 1000) if median is not None else None,
+        }
+
+
+class HarvesterHub:
+    """WebSocket harvester 注册表 + 定向刷新"""
+
+    REFRESH_MESSAGE = json.dumps({"type": "refresh_token"})
+
+    def __init__(self, hedge_after: float = 10.0, stale_after: float = 120.0,
+                 slot_available: Optional[Callable[[str], bool]] = None):
+        """
+        Args:
+            hedge_after: 第一个 harvester 超过该秒数仍未返回凭证时，对冲发给第二个
+            stale_after: 超过该秒数没有任何消息的 harvester 优先级降到最低
+            slot_available: 判断 harvester 对应凭证槽位是否可用（冷却中的槽位不优先）
+        """
+        self.hedge_after = hedge_after
+        self.stale_after = stale_after
+        self.slot_available = slot_available
+        self.clients: Dict[Any, HarvesterClient] = {}
+        self.stats = {"targeted": 0, "hedged": 0, "hedge_wins": 0, "no_harvester": 0, "timeouts": 0}
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    def _next_slot_id(self, client_name: str) -> str:
+        """每个 harvester 一个槽位，重连时复用最小的空闲编号"""
+        in_use = {c.slot_id for c in self.clients.values()}
+        index = 0
+        while f"ws-{client_name}-{index}" in in_use:
+            index += 1
+        return f"ws-{client_name}-{index}"
+
+    def register(self, websocket: Any) -> HarvesterClient:
+        client = HarvesterClient(websocket, self._next_slot_id("harvester"))
+        self.clients[websocket] = client
+        return client
+
+    def identify(self, websocket: Any, client_name: str, slot_id: Optional[str] = None) -> HarvesterClient:
+        client = self.clients.get(websocket)
+        if client is None:
+            client = self.register(websocket)
+        client.client_name = client_name
+        client.slot_id = None  # 释放当前编号再重新分配
+        client.slot_id = slot_id or self._next_slot_id(client_name)
+        client.last_seen = time.time()
+        return client
+
+    def unregister(self, websocket: Any) -> None:
+        """可重复调用（断线和发送失败都可能触发）"""
+        client = self.clients.pop(websocket, None)
+        if client is not None:
+            client.abandon_refresh()
+
+    def get(self, websocket: Any) -> Optional[HarvesterClient]:
+        return self.clients.get(websocket)
+
+    def touch(self, websocket: Any) -> None:
+        client = self.clients.get(websocket)
+        if client is not None:
+            client.last_seen = time.time()
+
+    def delivered(self, websocket: Any) -> None:
+        client = self.clients.get(websocket)
+        if client is not None:
+            client.delivered()
+
+    def _rank(self, client: HarvesterClient, now: float):
+        stale = now - client.last_seen > self.stale_after
+        unavailable = self.slot_available is not None and not self.slot_available(client.slot_id)
+        median = client.median_latency
+        return (stale, unavailable, -client.success_rate, median if median is not None else 0.0)
+
+    def pick(self, exclude: tuple = ()) -> Optional[HarvesterClient]:
+        """选择最健康的空闲 harvester：活跃、槽位可用、成功率高、延迟低"""
+        now = time.time()
+        candidates = [c for c in self.clients.values() if not c.busy and c not in exclude]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda c: self._rank(c, now))
+
+    async def _send_refresh(self, client: HarvesterClient) -> Optional["asyncio.Future"]:
+        future = client.begin_refresh()
+        try:
+            await client.websocket.send(self.REFRESH_MESSAGE)
+        except Exception as e:
+            log.warning("⚠️ Failed to send refresh request to %s: %s", client.slot_id, e)
+            self.unregister(client.websocket)
+            return None
+        return future
+
+    async def _send_next(self, attempts: Dict["asyncio.Future", HarvesterClient]) -> bool:
+        """把刷新请求发给尚未尝试过的最健康的 harvester（发送失败的换下一个）"""
+        while True:
+            client = self.pick(exclude=tuple(attempts.values()))
+            if client is None:
+                return False
+            future = await self._send_refresh(client)
+            if future is not None:
+                attempts[future] = client
+                return True
+
+    async def refresh(self, timeout: float = 45.0) -> Optional[HarvesterClient]:
+        """
+        向一个 harvester 请求刷新；超过 hedge_after 仍未返回凭证时再请求第二个。
+        正在等待的 harvester 全部断开（请求被取消）时，用剩余时间改请求下一个
+
+        Returns:
+            先返回凭证的 harvester；超时或没有可用 harvester 时返回 None
+        """
+        attempts: Dict["asyncio.Future", HarvesterClient] = {}
+        if not await self._send_next(attempts):
+            self.stats["no_harvester"] += 1
+            return None
+        self.stats["targeted"] += 1
+        primary = next(iter(attempts.values()))
+
+        started = time.monotonic()
+        deadline = started + timeout
+        hedge_at = started + self.hedge_after
+        hedged = False
+        winner = None
+        try:
+            pending = set(attempts)
+            while pending:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                until = deadline if hedged else min(hedge_at, deadline)
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, until - now),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                winner = next((attempts[f] for f in done if not f.cancelled()), None)
+                if winner is not None:
+                    break
+                if pending and (hedged or time.monotonic() < hedge_at):
+                    continue
+                if pending:
+                    # 对冲：第一个 harvester 超过截止时间，再请求第二个（第一个仍可能先返回）
+                    hedged = True
+                    if await self._send_next(attempts):
+                        self.stats["hedged"] += 1
+                else:
+                    # 所有请求都被取消（harvester 断开）：改请求下一个
+                    await self._send_next(attempts)
+                pending = {f for f in attempts if not f.done()}
+            if winner is None:
+                self.stats["timeouts"] += 1
+            elif winner is not primary:
+                self.stats["hedge_wins"] += 1
+            return winner
+        finally:
+            # 未返回的请求记为失败；对冲中落后的一方如果稍后返回凭证，仍会正常写入其槽位
+            for future, client in attempts.items():
+                if not future.done():
+                    client.abandon_refresh()
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        return [c.to_stats(now) for c in self.clients.values()]
@@ -0,0 +1,212 @@
+"""
+图片存储模块
+上游返回的 inlineData 图片只解码一次，按内容哈希写入本地目录，响应中只返回短 URL
+（/v1/images/{hash}.{ext}），由 FileResponse 直接从磁盘发送；目录总大小超过上限时淘汰最久未访问的图片
+"""
+
+import asyncio
+import binascii
+import contextvars
+import hashlib
+import os
+import re
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from src.log import get_logger
+
+log = get_logger(__name__)
+
+# 当前请求的对外地址（例如 http://localhost:7860），用于拼接图片的绝对 URL
+image_base_url_var: contextvars.ContextVar[str] = contextvars.ContextVar("image_base_url", default="")
+# 当前请求是否要求内联 data URI（兼容无法访问代理地址的客户端）
+inline_images_var: contextvars.ContextVar[bool] = contextvars.ContextVar("inline_images", default=False)
+
+MIME_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+}
+EXTENSION_MIMES = {ext: mime for mime, ext in MIME_EXTENSIONS.items()}
+NAME_PATTERN = re.compile(r"^[0-9a-f]{64}\.(?:png|jpg|webp|gif)$")
+IMAGE_REF_PATTERN = re.compile(r"/v1/images/([0-9a-f]{64}\.(?:png|jpg|webp|gif))")
+
+
+class ImageStore:
+    """按内容寻址的本地图片存储"""
+
+    def __init__(self, directory: str = "images", max_bytes: int = 1024 * 1024 * 1024,
+                 route_prefix: str = "/v1/images", public_base_url: str = "", shared: bool = False):
+        """
+        Args:
+            directory: 图片目录
+            max_bytes: 目录总大小上限，超出时按最久未访问淘汰
+            route_prefix: 图片 URL 路径前缀（与 FastAPI 路由一致）
+            public_base_url: 固定的对外地址（反向代理后面时设置）；为空时使用当前请求的地址
+            shared: 目录由多个进程共用（多 worker 模式）；此时本进程不淘汰，由一个进程定期调用 sweep()
+        """
+        self.directory = directory
+        self.shared = shared
+        self.max_bytes = max_bytes
+        self.route_prefix = route_prefix.rstrip("/")
+        self.public_base_url = public_base_url.rstrip("/")
+        self._index: "OrderedDict[str, int]" = OrderedDict()  # 文件名 -> 字节数，按访问顺序
+        self._bytes = 0
+        self._pending: Dict[str, asyncio.Future] = {}  # 正在写入的文件
+        self.stats = {"stored": 0, "deduplicated": 0, "evicted": 0, "served": 0, "inlined": 0}
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self) -> None:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and NAME_PATTERN.match(entry.name):
+                stat = entry.stat()
+                entries.append((stat.st_atime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._index[name] = size
+            self._bytes += size
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def url_for(self, name: str) -> str:
+        base = self.public_base_url or image_base_url_var.get().rstrip("/")
+        return f"{base}{self.route_prefix}/{name}"
+
+    def markdown_for(self, mime_type: str, b64_data: str) -> str:
+        """把一张 inlineData 图片转换为 markdown（默认存储后返回 URL，按请求也可内联 data URI）"""
+        if inline_images_var.get() or mime_type not in MIME_EXTENSIONS:
+            self.stats["inlined"] += 1
+            return f"![Generated Image](data:{mime_type};base64,{b64_data})"
+        try:
+            name = self.store(mime_type, b64_data)
+        except (binascii.Error, ValueError, OSError) as e:
+            log.warning("⚠️ Failed to store generated image, inlining it instead: %s", e)
+            self.stats["inlined"] += 1
+            return f"![Generated Image](data:{mime_type};base64,{b64_data})"
+        return f"![Generated Image]({self.url_for(name)})"
+
+    def store(self, mime_type: str, b64_data: str) -> str:
+        """解码并登记图片，返回文件名；写盘在线程池中进行，读取时会等待写入完成"""
+        data = binascii.a2b_base64(b64_data)
+        name = hashlib.sha256(data).hexdigest() + MIME_EXTENSIONS[mime_type]
+        if name in self._index:
+            self._index.move_to_end(name)
+            self.stats["deduplicated"] += 1
+            return name
+        self._index[name] = len(data)
+        self._bytes += len(data)
+        self.stats["stored"] += 1
+        future = asyncio.get_running_loop().run_in_executor(None, self._write, name, data)
+        self._pending[name] = future
+        future.add_done_callback(lambda f, n=name: self._write_done(n, f))
+        if not self.shared:
+            self._evict(keep=name)
+        return name
+
+    def _write_done(self, name: str, future: asyncio.Future) -> None:
+        self._pending.pop(name, None)
+        if future.cancelled() or future.exception() is not None:
+            log.warning("⚠️ Failed to write image %s: %s", name, future.exception() if not future.cancelled() else 'cancelled')
+            size = self._index.pop(name, None)
+            if size is not None:
+                self._bytes -= size
+
+    def _write(self, name: str, data: bytes) -> None:
+        path = self._path(name)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _evict(self, keep: str) -> None:
+        while self._bytes > self.max_bytes and len(self._index) > 1:
+            name, size = next(iter(self._index.items()))
+            if name == keep:
+                self._index.move_to_end(name)
+                continue
+            del self._index[name]
+            self._bytes -= size
+            self.stats["evicted"] += 1
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+
+    def sweep(self) -> None:
+        """
+        按目录的实际内容淘汰（共用目录时由唯一的一个进程定期调用，在线程池中执行）
+
+        各进程读取图片时会更新文件时间，按最近访问 / 写入时间淘汰。
+        """
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and NAME_PATTERN.match(entry.name):
+                stat = entry.stat()
+                entries.append((max(stat.st_atime, stat.st_mtime), entry.name, stat.st_size))
+                total += stat.st_size
+        entries.sort()
+        for _, name, size in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                continue
+            total -= size
+            self.stats["evicted"] += 1
+
+    def available(self, text: str) -> bool:
+        """
+        text 中引用的本地图片是否都还在（缓存的响应可能指向已被淘汰的图片）
+
+        仍然存在的图片会被标记为最近访问，避免缓存命中后不久即被淘汰。
+        """
+        for name in IMAGE_REF_PATTERN.findall(text):
+            if name in self._index and not self.shared:
+                self._index.move_to_end(name)
+            elif not os.path.exists(self._path(name)):
+                self._forget(name)
+                return False
+        return True
+
+    def _forget(self, name: str) -> None:
+        size = self._index.pop(name, None)
+        if size is not None:
+            self._bytes -= size
+
+    async def open(self, name: str) -> Optional[Tuple[str, str]]:
+        """返回 (文件路径, MIME 类型)；不存在时返回 None"""
+        if not NAME_PATTERN.match(name):
+            return None
+        if name not in self._index:
+            # 多 worker 模式下图片可能由另一个进程写入
+            try:
+                size = os.stat(self._path(name)).st_size
+            except OSError:
+                return None
+            self._index[name] = size
+            self._bytes += size
+        pending = self._pending.get(name)
+        if pending is not None:
+            try:
+                await asyncio.shield(pending)
+            except OSError:
+                return None
+        path = self._path(name)
+        if self.shared:
+            # 另一个进程可能已经淘汰了这张图片；同时更新文件时间供 sweep() 判断最近访问
+            try:
+                os.utime(path)
+            except OSError:
+                self._forget(name)
+                return None
+        self._index.move_to_end(name)
+        self.stats["served"] += 1
+        return path, EXTENSION_MIMES[os.path.splitext(name)[1]]
+
+    def to_stats(self) -> Dict[str, object]:
+        return {**self.stats, "images": len(self._index), "bytes": self._bytes}
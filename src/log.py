@@ -0,0 +1,130 @@
+"""
+日志模块
+分级、惰性格式化的日志；调用方只把记录放入队列，由后台线程负责格式化和写出，
+每条日志带上当前请求的关联 ID
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import uuid
+from typing import Any, Optional
+
+
+LOGGER_NAME = "vertex_proxy"
+LOG_FORMAT = "%(asctime)s %(levelname).1s [%(request_id)s] %(message)s"
+LOG_DATE_FORMAT = "%H:%M:%S"
+
+# 当前请求的关联 ID（asyncio 任务间按上下文隔离，create_task 时自动继承）
+request_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class _RequestIdFilter(logging.Filter):
+    """在调用方线程 / 任务中捕获关联 ID（后台线程中已无法读取上下文）"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """每次写出时使用当前的 sys.stdout（GUI 模式下 stdout 会被重定向到 Tk）"""
+
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    只在调用方完成 %-格式化（保证参数在入队时的取值），时间戳和整行格式化留给后台线程
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        record.exc_text = None
+        if record.exc_info:
+            # 异常对象不跨线程传递，提前格式化堆栈
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LazyJSON:
+    """仅在日志真正输出时才序列化的 JSON 参数，例如 log.debug("%.500s", LazyJSON(data))"""
+
+    __slots__ = ("data",)
+
+    def __init__(self, data: Any):
+        self.data = data
+
+    def __str__(self) -> str:
+        try:
+            return json.dumps(self.data, ensure_ascii=False)
+        except (TypeError, ValueError):
+            return repr(self.data)
+
+
+def setup_logging(level: Optional[str] = None) -> logging.Logger:
+    """
+    初始化日志（可重复调用）
+
+    Args:
+        level: 日志级别，默认读取环境变量 LOG_LEVEL（INFO）
+    """
+    global _listener
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel((level or os.environ.get("LOG_LEVEL", "INFO")).upper())
+    if _listener is not None:
+        return logger
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    queue_handler = _DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(_RequestIdFilter())
+
+    output = _StdoutHandler()
+    output.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, output)
+    _listener.start()
+    atexit.register(shutdown_logging)
+    return logger
+
+
+def shutdown_logging() -> None:
+    """停止后台写出线程，写完队列中剩余的日志"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    """获取子模块 logger（共享 vertex_proxy 的级别和处理器）"""
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+def new_request_id() -> str:
+    """为当前请求生成并设置关联 ID"""
+    request_id = uuid.uuid4().hex[:8]
+    request_id_var.set(request_id)
+    return request_id
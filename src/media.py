@@ -0,0 +1,239 @@
+"""
+入站媒体模块
+把 OpenAI 消息中的 image_url（data URI 或 http(s) 地址）转换为 Gemini inlineData 部件：
+远程图片在有界并发下同时下载，同一张图片（按内容哈希）在多轮对话中只保留一份，转换结果缓存复用。
+远程地址只允许解析到公网地址（每次重定向都重新检查），并直接连接检查过的地址（防止 DNS rebinding），
+避免被用来访问内网 / 云元数据服务
+"""
+
+import asyncio
+import base64
+import hashlib
+import ipaddress
+import socket
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import unquote_to_bytes, urljoin, urlsplit
+
+import httpx
+
+MAX_REDIRECTS = 5
+
+
+class MediaError(ValueError):
+    """图片无法获取或格式不受支持"""
+
+
+def _key(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+def _content_key(part: Dict[str, Any]) -> str:
+    inline = part["inlineData"]
+    return _key(f"{inline['mimeType']}:{inline['data']}")
+
+
+def extract_image_urls(messages: List[Dict[str, Any]]) -> List[str]:
+    """消息中所有用户图片的 image_url"""
+    return [part['image_url']['url']
+            for msg in messages if msg.get('role') == 'user' and isinstance(msg.get('content'), list)
+            for part in msg['content'] if part.get('type') == 'image_url']
+
+
+def _parse_data_uri(url: str) -> Dict[str, Any]:
+    try:
+        header, payload = url.split(",", 1)
+        mime_type = header.split(":", 1)[1].split(";")[0]
+    except (ValueError, IndexError):
+        raise MediaError("Malformed data URI in image_url")
+    if ";base64" not in header:
+        # 非 base64 的 data URI（百分号编码）：解码后转成 base64
+        payload = base64.b64encode(unquote_to_bytes(payload)).decode("ascii")
+    return {"inlineData": {"mimeType": mime_type or "application/octet-stream", "data": payload}}
+
+
+def _is_public(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+class MediaPipeline:
+    """image_url -> inlineData 转换（带缓存）"""
+
+    def __init__(self, max_concurrency: int = 4, max_image_bytes: int = 20 * 1024 * 1024,
+                 cache_bytes: int = 128 * 1024 * 1024, fetch_timeout: float = 15.0,
+                 allow_private: bool = False, url_cache_size: int = 4096):
+        """
+        Args:
+            max_concurrency: 同时下载的远程图片数量上限（所有请求共享）
+            max_image_bytes: 单张远程图片的大小上限
+            cache_bytes: 已转换部件缓存的（base64）字节上限
+            allow_private: 允许下载解析到内网 / 回环 / 链路本地地址的图片（仅用于本地调试）
+            url_cache_size: 记住的 地址 -> 内容 映射条数
+        """
+        self.max_image_bytes = max_image_bytes
+        self.cache_bytes = cache_bytes
+        self.allow_private = allow_private
+        self.url_cache_size = url_cache_size
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()  # 内容哈希 -> 部件
+        self._urls: "OrderedDict[str, str]" = OrderedDict()  # 地址哈希 -> 内容哈希
+        self._cached_bytes = 0
+        self._inflight: Dict[str, asyncio.Future] = {}  # 同一地址的并发下载合并为一次
+        self._client: Optional[httpx.AsyncClient] = None
+        self.fetch_timeout = fetch_timeout
+        self.stats = {"converted": 0, "cache_hits": 0, "deduplicated": 0, "fetched": 0, "fetch_errors": 0,
+                      "fetched_bytes": 0, "blocked": 0}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            # 重定向由 _fetch 逐跳处理，每一跳都重新检查并固定目标地址；
+            # 不使用环境变量中的代理（代理会自行解析主机名，绕过地址检查）
+            self._client = httpx.AsyncClient(timeout=self.fetch_timeout, follow_redirects=False, trust_env=False)
+        return self._client
+
+    def _remember(self, url_key: str, part: Dict[str, Any]) -> Dict[str, Any]:
+        """按内容哈希登记部件，返回共享的部件对象（相同内容的不同地址得到同一个对象）"""
+        content_key = _content_key(part)
+        existing = self._cache.get(content_key)
+        if existing is not None:
+            self._cache.move_to_end(content_key)
+            self.stats["deduplicated"] += 1
+            part = existing
+        else:
+            size = len(part["inlineData"]["data"])
+            if size > self.cache_bytes:
+                return part
+            self._cache[content_key] = part
+            self._cached_bytes += size
+            while self._cached_bytes > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted["inlineData"]["data"])
+        self._urls[url_key] = content_key
+        self._urls.move_to_end(url_key)
+        while len(self._urls) > self.url_cache_size:
+            self._urls.popitem(last=False)
+        return part
+
+    async def _resolve_target(self, url: str) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        """
+        拒绝解析到非公网地址的目标（内网、回环、链路本地 / 云元数据等），并把地址固定为检查过的 IP
+
+        Returns:
+            (请求 URL, 请求头, httpx extensions)：URL 中的主机名替换为检查过的 IP，
+            Host 头和 TLS SNI / 证书校验仍使用原主机名，连接时不会再次解析 DNS
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise MediaError(f"Unsupported image_url: {url[:64]}")
+        if self.allow_private:
+            return url, {}, {}
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(
+                parts.hostname, parts.port or (443 if parts.scheme == "https" else 80), type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            raise MediaError(f"Could not resolve image_url host {parts.hostname}: {e}")
+        if not infos or not all(_is_public(info[4][0]) for info in infos):
+            self.stats["blocked"] += 1
+            raise MediaError(f"image_url host is not a public address: {parts.hostname}")
+
+        address = infos[0][4][0].split("%", 1)[0]
+        host = f"[{parts.hostname}]" if ":" in parts.hostname else parts.hostname
+        pinned = f"[{address}]" if ":" in address else address
+        port = f":{parts.port}" if parts.port else ""
+        request_url = parts._replace(netloc=f"{pinned}{port}").geturl()
+        return request_url, {"Host": f"{host}{port}"}, {"sni_hostname": parts.hostname}
+
+    async def _fetch(self, url: str) -> Dict[str, Any]:
+        async with self._semaphore:
+            try:
+                target = url
+                for _ in range(MAX_REDIRECTS + 1):
+                    request_url, headers, extensions = await self._resolve_target(target)
+                    async with self.client.stream("GET", request_url, headers=headers,
+                                                  extensions=extensions) as response:
+                        if response.is_redirect:
+                            location = response.headers.get("location")
+                            if not location:
+                                raise MediaError(f"image_url redirect without a Location header: {url}")
+                            # 相对地址按原主机名解析（response.url 是固定 IP 后的地址）
+                            target = urljoin(target, location)
+                            continue
+                        response.raise_for_status()
+                        mime_type = response.headers.get("content-type", "").split(";")[0].strip()
+                        if not mime_type.startswith("image/"):
+                            raise MediaError(f"image_url did not return an image ({mime_type or 'no content type'}): {url}")
+                        declared = response.headers.get("content-length")
+                        if declared and declared.isdigit() and int(declared) > self.max_image_bytes:
+                            raise MediaError(f"image_url exceeds {self.max_image_bytes} bytes: {url}")
+                        chunks = []
+                        received = 0
+                        async for chunk in response.aiter_bytes():
+                            received += len(chunk)
+                            if received > self.max_image_bytes:
+                                raise MediaError(f"image_url exceeds {self.max_image_bytes} bytes: {url}")
+                            chunks.append(chunk)
+                        break
+                else:
+                    raise MediaError(f"image_url redirected more than {MAX_REDIRECTS} times: {url}")
+            except httpx.HTTPError as e:
+                self.stats["fetch_errors"] += 1
+                raise MediaError(f"Failed to fetch image_url {url}: {e}") from e
+            except MediaError:
+                self.stats["fetch_errors"] += 1
+                raise
+        self.stats["fetched"] += 1
+        self.stats["fetched_bytes"] += received
+        data = base64.b64encode(b"".join(chunks)).decode("ascii")
+        return {"inlineData": {"mimeType": mime_type, "data": data}}
+
+    async def _convert(self, url: str) -> Dict[str, Any]:
+        key = _key(url)
+        content_key = self._urls.get(key)
+        part = self._cache.get(content_key) if content_key else None
+        if part is not None:
+            self._cache.move_to_end(content_key)
+            self._urls.move_to_end(key)
+            self.stats["cache_hits"] += 1
+            return part
+
+        if url.startswith("data:"):
+            part = _parse_data_uri(url)
+        elif url.startswith(("http://", "https://")):
+            pending = self._inflight.get(key)
+            if pending is not None:
+                return await asyncio.shield(pending)
+            task = asyncio.ensure_future(self._fetch(url))
+            self._inflight[key] = task
+            try:
+                part = await asyncio.shield(task)
+            finally:
+                if task.done():
+                    self._inflight.pop(key, None)
+                else:
+                    task.add_done_callback(lambda _t: self._inflight.pop(key, None))
+        else:
+            raise MediaError(f"Unsupported image_url scheme: {url[:32]}")
+
+        self.stats["converted"] += 1
+        return self._remember(key, part)
+
+    async def convert(self, urls: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        转换一批 image_url（同一请求中重复的地址只转换一次）
+
+        Returns:
+            url -> inlineData 部件（同一张图片在各轮对话中共享同一个部件对象）
+
+        Raises:
+            MediaError: 任一图片无法获取
+        """
+        unique = list(dict.fromkeys(urls))
+        parts = await asyncio.gather(*(self._convert(url) for url in unique))
+        return dict(zip(unique, parts))
+
+    def to_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "cached_parts": len(self._cache), "cached_bytes": self._cached_bytes}
@@ -0,0 +1,235 @@
+"""
+指标模块
+无第三方依赖的 Counter / Gauge / Histogram，导出 Prometheus 文本格式（/metrics），
+并为仪表盘提供最近样本的 p50 / p99。
+多进程部署时每个进程用 export() 导出带进程标签的样本，由 render_merged() 合并为一份
+"""
+
+import math
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+# 秒；覆盖从本地处理（毫秒级）到长时间流式输出（分钟级）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    TYPE = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+
+    def samples(self, const_labels: Tuple[Tuple[str, str], ...] = ()) -> List[str]:
+        """样本行（不含 HELP / TYPE），const_labels 附加到每一行"""
+        return []
+
+    def _labels(self, key: Tuple[str, ...], const_labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+        names = self.labelnames + tuple(name for name, _ in const_labels)
+        values = tuple(key) + tuple(value for _, value in const_labels)
+        return _format_labels(names, values, extra)
+
+    def render(self) -> List[str]:
+        return self.header() + self.samples()
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def totals(self, by: Tuple[str, ...] = ()) -> Dict[str, float]:
+        """按部分标签汇总，键为标签值用 '/' 连接（by 为空时键为 'total'）"""
+        indexes = [self.labelnames.index(name) for name in by]
+        result: Dict[str, float] = {}
+        for key, value in self._values.items():
+            group = "/".join(key[i] for i in indexes) or "total"
+            result[group] = result.get(group, 0) + value
+        return result
+
+    def samples(self, const_labels: Tuple[Tuple[str, str], ...] = ()) -> List[str]:
+        return [f"{self.name}{self._labels(key, const_labels)} {_format_value(value)}"
+                for key, value in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    """
+    当前值指标
+
+    可以用 set() 写入，也可以传入 function 在导出时读取（适合连接池占用等随时变化的状态）。
+    """
+    TYPE = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def samples(self, const_labels: Tuple[Tuple[str, str], ...] = ()) -> List[str]:
+        lines = []
+        if self.function is not None:
+            lines.append(f"{self.name}{_format_labels([n for n, _ in const_labels], [v for _, v in const_labels])} "
+                         f"{_format_value(self.function())}")
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{self._labels(key, const_labels)} {_format_value(value)}")
+        return lines
+
+
+class _HistogramSeries:
+    __slots__ = ("bucket_counts", "sum", "count", "recent")
+
+    def __init__(self, n_buckets: int, recent: int):
+        self.bucket_counts = [0] * n_buckets
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=recent)
+
+
+class Histogram(_Metric):
+    """
+    Prometheus 直方图
+
+    另外为每组标签保留最近的样本，用于仪表盘上的精确分位数（Prometheus 端请使用 histogram_quantile）。
+    """
+    TYPE = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS, recent: int = 500):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.recent = recent
+        self._series: Dict[Tuple[str, ...], _HistogramSeries] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _HistogramSeries(len(self.buckets), self.recent)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series.bucket_counts[i] += 1
+                break
+        series.sum += value
+        series.count += 1
+        series.recent.append(value)
+
+    def summary(self, by: Tuple[str, ...] = ()) -> Dict[str, Dict[str, Optional[float]]]:
+        """按部分标签合并最近样本，返回 count / p50_ms / p99_ms"""
+        indexes = [self.labelnames.index(name) for name in by]
+        groups: Dict[str, List[float]] = {}
+        counts: Dict[str, int] = {}
+        for key, series in self._series.items():
+            group = "/".join(key[i] for i in indexes) or "total"
+            groups.setdefault(group, []).extend(series.recent)
+            counts[group] = counts.get(group, 0) + series.count
+        result = {}
+        for group, samples in groups.items():
+            samples.sort()
+            result[group] = {
+                "count": counts[group],
+                "p50_ms": round(_nearest_rank(samples, 0.50) * 1000) if samples else None,
+                "p99_ms": round(_nearest_rank(samples, 0.99) * 1000) if samples else None,
+            }
+        return result
+
+    def samples(self, const_labels: Tuple[Tuple[str, str], ...] = ()) -> List[str]:
+        lines = []
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series.bucket_counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{self._labels(key, const_labels, le)} {cumulative}")
+            labels = self._labels(key, const_labels)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series.sum)}")
+            lines.append(f"{self.name}_count{labels} {series.count}")
+        return lines
+
+
+def _nearest_rank(sorted_values: List[float], q: float) -> float:
+    index = max(0, math.ceil(q * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+class MetricsRegistry:
+    """按注册顺序导出所有指标"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric already registered: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+              function: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def export(self, const_labels: Dict[str, str]) -> Dict[str, List[str]]:
+        """导出带进程标签的样本行（可 JSON 序列化），供另一个进程用 render_merged() 合并"""
+        labels = tuple(const_labels.items())
+        return {name: metric.samples(labels) for name, metric in self._metrics.items()}
+
+    def render_merged(self, exports: Iterable[Dict[str, List[str]]]) -> str:
+        """合并多个进程的 export()；每个指标只输出一次 HELP / TYPE，样本按指标归组"""
+        exports = list(exports)
+        lines: List[str] = []
+        for name, metric in self._metrics.items():
+            lines.extend(metric.header())
+            for exported in exports:
+                lines.extend(exported.get(name, ()))
+        return "\n".join(lines) + "\n"
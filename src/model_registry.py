@@ -0,0 +1,157 @@
+"""
+模型注册表模块
+加载一次 models.json，将每个模型名/别名预解析为不可变的路由记录，并在文件变化时热重载
+"""
+
+import asyncio
+import json
+import os
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Optional, Tuple
+
+from src.log import get_logger
+
+log = get_logger(__name__)
+
+
+@dataclass(frozen=True)
+class ModelRoute:
+    """一个请求模型名解析后的路由信息"""
+    requested: str
+    target_model: str
+    thinking_mode: Optional[str] = None     # "low" / "high"
+    thinking_budget: Optional[int] = None
+    image_size: Optional[str] = None        # "1K" / "2K" / "4K"
+
+
+class ModelRegistry:
+    """缓存的模型注册表"""
+
+    # 思考模式后缀 -> 思考预算
+    THINKING_SUFFIXES = {
+        "-low": ("low", 8192),
+        "-high": ("high", 32768),
+    }
+
+    # 分辨率后缀 -> Vertex AI imageSize
+    RESOLUTION_SUFFIXES = {
+        "-1k": "1K",
+        "-2k": "2K",
+        "-4k": "4K",
+    }
+
+    FALLBACK_MODELS = ("gemini-1.5-pro", "gemini-1.5-flash")
+
+    # 未在配置中出现的模型名的解析缓存上限
+    MAX_ADHOC_ROUTES = 256
+
+    def __init__(self, filepath: str = "models.json", check_interval: float = 2.0):
+        self.filepath = filepath
+        self.check_interval = check_interval
+        self._models: Tuple[str, ...] = self.FALLBACK_MODELS
+        self._alias_map: Dict[str, str] = {}
+        self._routes: Dict[str, ModelRoute] = {}
+        self._adhoc_routes: Dict[str, ModelRoute] = {}
+        self._targets: FrozenSet[str] = frozenset()
+        self._mtime: float = 0
+        self.reload_count = 0
+        self.load()
+
+    def load(self) -> bool:
+        """同步加载配置（仅在启动时调用）"""
+        try:
+            mtime = os.stat(self.filepath).st_mtime
+            config = self._read()
+        except Exception as e:
+            log.warning("⚠️ Error loading %s: %s", self.filepath, e)
+            return False
+        self._apply(config, mtime)
+        return True
+
+    def _read(self) -> Dict:
+        with open(self.filepath, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _apply(self, config: Dict, mtime: float) -> None:
+        models = tuple(config.get('models') or self.FALLBACK_MODELS)
+        alias_map = dict(config.get('alias_map') or {})
+
+        routes = {}
+        for name in list(models) + list(alias_map):
+            routes[name] = self._build_route(name, alias_map)
+
+        # 整体替换，读取方无需加锁
+        self._models = models
+        self._alias_map = alias_map
+        self._routes = routes
+        self._adhoc_routes = {}
+        self._targets = frozenset(route.target_model for route in routes.values())
+        self._mtime = mtime
+        self.reload_count += 1
+        log.info("📚 Model registry loaded: %s models, %s aliases", len(models), len(alias_map))
+
+    @classmethod
+    def _build_route(cls, requested: str, alias_map: Dict[str, str]) -> ModelRoute:
+        target = alias_map.get(requested, requested)
+
+        thinking_mode = None
+        thinking_budget = None
+        for suffix, (mode, budget) in cls.THINKING_SUFFIXES.items():
+            if target.endswith(suffix):
+                target = target[:-len(suffix)]
+                thinking_mode, thinking_budget = mode, budget
+                break
+
+        image_size = None
+        for suffix, size in cls.RESOLUTION_SUFFIXES.items():
+            if target.endswith(suffix):
+                target = target[:-len(suffix)]
+                image_size = size
+                break
+
+        return ModelRoute(
+            requested=requested,
+            target_model=target,
+            thinking_mode=thinking_mode,
+            thinking_budget=thinking_budget,
+            image_size=image_size,
+        )
+
+    def resolve(self, model: str) -> ModelRoute:
+        """解析请求的模型名，命中时只需一次字典查找"""
+        route = self._routes.get(model)
+        if route is not None:
+            return route
+        route = self._adhoc_routes.get(model)
+        if route is None:
+            route = self._build_route(model, self._alias_map)
+            if len(self._adhoc_routes) < self.MAX_ADHOC_ROUTES:
+                self._adhoc_routes[model] = route
+        return route
+
+    def metric_label(self, model: str) -> str:
+        """指标中使用的模型标签：配置中的目标模型，其余（客户端随意填写的）统一为 "unknown"，避免标签基数无限增长"""
+        target = self.resolve(model).target_model
+        return target if target in self._targets else "unknown"
+
+    @property
+    def models(self) -> Tuple[str, ...]:
+        return self._models
+
+    async def watch(self) -> None:
+        """后台轮询文件修改时间，变化时在线程池中重新加载"""
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                mtime = (await asyncio.to_thread(os.stat, self.filepath)).st_mtime
+            except FileNotFoundError:
+                continue
+            if mtime == self._mtime:
+                continue
+            try:
+                config = await asyncio.to_thread(self._read)
+                self._apply(config, mtime)
+            except Exception as e:
+                # 保留旧配置，等待下一次修改
+                self._mtime = mtime
+                log.warning("⚠️ Error reloading %s: %s", self.filepath, e)
@@ -0,0 +1,201 @@
+"""
+自适应限速模块
+按（模型, 凭证槽位）维护令牌桶，用 AIMD 学习上游的真实配额：
+出现 429 / "Resource exhausted" 时按比例降低速率（乘性减），持续成功时缓慢提高（加性增），
+请求在发送前按学到的速率排队，从而稳定在配额之下，而不是反复撞上配额再付出刷新凭证的代价
+"""
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from src.log import get_logger
+
+log = get_logger(__name__)
+
+WINDOW = 60.0  # 秒；配额按每分钟请求数（RPM）计算
+
+
+class _Bucket:
+    __slots__ = ("rpm", "tokens", "refilled", "last_decrease", "sends",
+                 "paced", "unpaced", "exhausted", "decreases", "waited")
+
+    def __init__(self, rpm: Optional[float] = None):
+        self.rpm = rpm                 # None 表示尚未学到限制（不限速）
+        self.tokens = 1.0
+        self.refilled = time.monotonic()
+        self.last_decrease = 0.0
+        self.sends = deque()           # 最近 WINDOW 秒内的发送时间，用于估计实际速率
+        self.paced = 0
+        self.unpaced = 0
+        self.exhausted = 0
+        self.decreases = 0
+        self.waited = 0.0
+
+    def observed_rpm(self, now: float) -> float:
+        while self.sends and now - self.sends[0] > WINDOW:
+            self.sends.popleft()
+        return len(self.sends) * 60.0 / WINDOW
+
+
+class AdaptiveRateLimiter:
+    """
+    AIMD 令牌桶限速器
+
+    学到的速率写入 state（键为 "模型|槽位"），由调用方负责持久化（on_change 在每次变化后调用）。
+    """
+
+    def __init__(self, enabled: bool = True, min_rpm: float = 1.0, max_rpm: float = 600.0,
+                 decrease: float = 0.5, increase: float = 2.0, burst_seconds: float = 2.0,
+                 max_wait: float = 20.0, decrease_interval: float = 10.0,
+                 state: Optional[Dict[str, Dict[str, float]]] = None,
+                 on_change: Optional[Callable[[], None]] = None, state_ttl: float = 86400.0):
+        """
+        Args:
+            min_rpm / max_rpm: 速率的下限 / 上限；加性增超过上限后恢复为不限速
+            decrease: 触发配额错误时速率乘以的系数
+            increase: 以学到的速率持续成功时，每分钟提高的 RPM
+            burst_seconds: 令牌桶容量（按该速率下的秒数计算，至少 1 个请求）
+            max_wait: 单个请求最长的排队秒数；超过时不再等待直接发送
+            decrease_interval: 两次乘性减之间的最短间隔（同一波并发的 429 只降一次）
+            state: 已持久化的速率，过期（state_ttl 秒未更新）的条目会被忽略
+        """
+        self.enabled = enabled
+        self.min_rpm = min_rpm
+        self.max_rpm = max_rpm
+        self.decrease = decrease
+        self.increase = increase
+        self.burst_seconds = burst_seconds
+        self.max_wait = max_wait
+        self.decrease_interval = decrease_interval
+        self.state = state if state is not None else {}
+        self.on_change = on_change or (lambda: None)
+        self._buckets: Dict[Tuple[str, str], _Bucket] = {}
+        self._load(state_ttl)
+
+    @staticmethod
+    def _state_key(model: str, slot_id: str) -> str:
+        return f"{model}|{slot_id}"
+
+    def _load(self, state_ttl: float) -> None:
+        now = time.time()
+        for key, entry in list(self.state.items()):
+            model, sep, slot_id = key.partition("|")
+            rpm = entry.get("rpm") if isinstance(entry, dict) else None
+            if not sep or rpm is None or now - entry.get("updated", 0) > state_ttl:
+                del self.state[key]
+                continue
+            self._buckets[(model, slot_id)] = _Bucket(max(self.min_rpm, min(float(rpm), self.max_rpm)))
+
+    def _bucket(self, model: str, slot_id: str) -> _Bucket:
+        bucket = self._buckets.get((model, slot_id))
+        if bucket is None:
+            bucket = self._buckets[(model, slot_id)] = _Bucket()
+        return bucket
+
+    def _persist(self, model: str, slot_id: str, bucket: _Bucket) -> None:
+        key = self._state_key(model, slot_id)
+        if bucket.rpm is None:
+            self.state.pop(key, None)
+        else:
+            self.state[key] = {"rpm": round(bucket.rpm, 3), "updated": time.time()}
+        self.on_change()
+
+    def _capacity(self, bucket: _Bucket) -> float:
+        return max(1.0, bucket.rpm / 60.0 * self.burst_seconds)
+
+    def _refill(self, bucket: _Bucket, now: float) -> None:
+        if bucket.rpm is not None:
+            bucket.tokens = min(self._capacity(bucket), bucket.tokens + (now - bucket.refilled) * bucket.rpm / 60.0)
+        bucket.refilled = now
+
+    def delay(self, model: str, slot_id: str) -> float:
+        """不排队的情况下，该槽位还要等待多少秒才能发送下一个请求"""
+        bucket = self._buckets.get((model, slot_id))
+        if not self.enabled or bucket is None or bucket.rpm is None:
+            return 0.0
+        self._refill(bucket, time.monotonic())
+        return max(0.0, (1.0 - bucket.tokens) * 60.0 / bucket.rpm)
+
+    def throttled(self, model: str, slot_ids: Iterable[str]) -> Tuple[str, ...]:
+        """当前需要等待的槽位（选择凭证时优先避开）"""
+        return tuple(slot_id for slot_id in slot_ids if self.delay(model, slot_id) > 0)
+
+    def take(self, model: str, slot_id: str) -> float:
+        """
+        预订一个令牌并返回需要等待的秒数（不等待）
+
+        预计等待超过 max_wait 时不预订，直接放行并返回 0。
+        """
+        bucket = self._bucket(model, slot_id)
+        now = time.monotonic()
+        bucket.sends.append(now)
+        if not self.enabled or bucket.rpm is None:
+            return 0.0
+        self._refill(bucket, now)
+        wait = max(0.0, (1.0 - bucket.tokens) * 60.0 / bucket.rpm)
+        if wait > self.max_wait:
+            bucket.unpaced += 1
+            return 0.0
+        bucket.tokens -= 1.0
+        if wait > 0:
+            bucket.paced += 1
+            bucket.waited += wait
+        return wait
+
+    async def acquire(self, model: str, slot_id: str) -> float:
+        """按学到的速率等待发送时机，返回实际等待的秒数"""
+        wait = self.take(model, slot_id)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def record(self, model: str, slot_id: str, success: bool, exhausted: bool) -> None:
+        """根据一次上游请求的结果调整速率（其他失败不影响速率）"""
+        if not self.enabled or not (success or exhausted):
+            return
+        bucket = self._bucket(model, slot_id)
+        now = time.monotonic()
+        observed = bucket.observed_rpm(now)
+
+        if exhausted:
+            bucket.exhausted += 1
+            self._refill(bucket, now)
+            bucket.tokens = min(bucket.tokens, 0.0)
+            if now - bucket.last_decrease < self.decrease_interval:
+                return
+            base = bucket.rpm if bucket.rpm is not None else max(observed, self.min_rpm)
+            bucket.rpm = max(self.min_rpm, min(base, max(observed, self.min_rpm)) * self.decrease)
+            bucket.last_decrease = now
+            bucket.decreases += 1
+            log.warning("🐢 Quota exhausted on %s (slot: %s), pacing at %.1f RPM", model, slot_id, bucket.rpm)
+            self._persist(model, slot_id, bucket)
+            return
+
+        # 只有实际以接近限制的速率发送时才提高（空闲时的成功说明不了配额）
+        if bucket.rpm is None or observed < bucket.rpm * 0.5:
+            return
+        bucket.rpm += self.increase / bucket.rpm
+        if bucket.rpm >= self.max_rpm:
+            bucket.rpm = None
+        self._persist(model, slot_id, bucket)
+
+    def to_stats(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        stats = []
+        for (model, slot_id), bucket in sorted(self._buckets.items()):
+            if bucket.rpm is None and not bucket.exhausted:
+                continue
+            stats.append({
+                "model": model,
+                "slot": slot_id,
+                "rpm": round(bucket.rpm, 1) if bucket.rpm is not None else None,
+                "observed_rpm": round(bucket.observed_rpm(now), 1),
+                "paced": bucket.paced,
+                "unpaced": bucket.unpaced,
+                "avg_wait_ms": round(bucket.waited / bucket.paced * 1000) if bucket.paced else None,
+                "exhausted": bucket.exhausted,
+                "decreases": bucket.decreases,
+            })
+        return stats
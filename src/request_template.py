@@ -0,0 +1,114 @@
+"""
+请求模板模块
+在凭证更新时把抓取到的 GraphQL 请求体和 Headers 预编译一次，每次请求只需填充可变字段
+"""
+
+import json
+from typing import Any, Dict, List, Optional
+
+
+# 关闭所有安全过滤（常量，所有请求共享，只读）
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_CIVIC_INTEGRITY", "threshold": "BLOCK_NONE"},
+]
+
+# 由 httpx / 网络层处理、或可能引起冲突的 Headers（小写）
+STRIPPED_HEADERS = {"content-length", "host", "connection", "accept-encoding"}
+
+# 每次请求都会被覆盖的变量，无需保留在模板中
+PER_REQUEST_VARIABLES = ("contents", "safetySettings", "model", "generationConfig")
+
+
+def _copy_config(value: Any) -> Any:
+    """复制 generationConfig（只包含 dict / list / 标量，比 deepcopy 快）"""
+    if isinstance(value, dict):
+        return {k: _copy_config(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy_config(v) for v in value]
+    return value
+
+
+class RequestTemplate:
+    """由一份抓取凭证编译出的请求模板"""
+
+    def __init__(self, harvest: Dict[str, Any]):
+        """
+        Args:
+            harvest: 凭证数据（headers / url / body 字符串）
+
+        Raises:
+            ValueError: body 不是有效的 JSON
+        """
+        try:
+            body = json.loads(harvest['body'])
+        except (KeyError, TypeError, json.JSONDecodeError) as e:
+            raise ValueError(f"Invalid harvested body: {e}") from e
+
+        self.url: str = harvest['url']
+        self.query_signature = body.get('querySignature')
+        self.operation_name = body.get('operationName')
+
+        variables = dict(body.get('variables') or {})
+        generation_config = variables.get('generationConfig')
+        self.base_generation_config: Dict[str, Any] = generation_config if isinstance(generation_config, dict) else {}
+        for key in PER_REQUEST_VARIABLES:
+            variables.pop(key, None)
+        # 保留上下文/元数据（region、recaptchaToken、systemInstruction 等）
+        self.base_variables: Dict[str, Any] = variables
+
+        headers = {k: v for k, v in (harvest.get('headers') or {}).items() if k.lower() not in STRIPPED_HEADERS}
+        for key in [k for k in headers if k.lower() == 'content-type']:
+            del headers[key]
+        headers['content-type'] = 'application/json'
+        # httpx 不会修改传入的 headers，可以在请求间共享
+        self.headers: Dict[str, str] = headers
+
+    def new_generation_config(self) -> Dict[str, Any]:
+        """返回抓取时 generationConfig 的独立副本，供单次请求修改"""
+        return _copy_config(self.base_generation_config)
+
+    def build_body(self, contents: List[Dict[str, Any]], system_instruction: Optional[str],
+                   model: str, generation_config: Dict[str, Any]) -> Dict[str, Any]:
+        """填充可变字段，生成完整请求体"""
+        variables = dict(self.base_variables)
+        variables['contents'] = contents
+        if system_instruction:
+            variables['systemInstruction'] = {"parts": [{"text": system_instruction}]}
+        variables['safetySettings'] = SAFETY_SETTINGS
+        variables['model'] = model
+        variables['generationConfig'] = generation_config
+        return {
+            "querySignature": self.query_signature,
+            "operationName": self.operation_name,
+            "variables": variables,
+        }
+
+    def build_body_bytes(self, contents_json: bytes, system_instruction: Optional[str],
+                         model: str, generation_config: Dict[str, Any]) -> bytes:
+        """
+        与 build_body 相同，但 contents 使用预先序列化好的 JSON（见 serialize_contents）
+
+        多模态对话的 contents 可能有几十 MB，每个请求只序列化一次；重试 / 对冲时只需重新序列化
+        其余很小的部分再拼接。
+        """
+        body = self.build_body([], system_instruction, model, generation_config)
+        variables = body["variables"]
+        del variables["contents"]
+        head = json.dumps({"querySignature": self.query_signature, "operationName": self.operation_name},
+                          ensure_ascii=False, separators=(",", ":"))
+        # variables 至少包含 safetySettings / model / generationConfig，不会是 "{}"
+        variables_json = json.dumps(variables, ensure_ascii=False, separators=(",", ":"))
+        return b"".join((
+            head[:-1].encode("utf-8"), b',"variables":{"contents":', contents_json,
+            b",", variables_json[1:].encode("utf-8"), b"}",
+        ))
+
+
+def serialize_contents(contents: List[Dict[str, Any]]) -> bytes:
+    """序列化 contents（每个请求一次，供 build_body_bytes 在各次尝试间复用）"""
+    # 默认的 ensure_ascii 输出纯 ASCII，对以 base64 为主的多模态内容编码最快
+    return json.dumps(contents, separators=(",", ":")).encode("ascii")
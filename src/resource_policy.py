@@ -0,0 +1,127 @@
+"""
+资源拦截策略模块
+抓取凭证只需要页面能运行 reCAPTCHA 并发出 StreamGenerateContent 请求，
+图片、字体、媒体和埋点脚本都可以在浏览器中直接拦截，以降低内存占用和页面加载时间
+"""
+
+import asyncio
+import re
+from typing import Any, Dict, Iterable, List, Optional, Pattern, Set
+
+# Playwright 资源类型 -> CDP Network.ResourceType（其余类型按首字母大写处理）
+CDP_RESOURCE_TYPES = {
+    "xhr": "XHR",
+    "websocket": "WebSocket",
+    "eventsource": "EventSource",
+    "texttrack": "TextTrack",
+    "cspviolationreport": "CSPViolationReport",
+}
+
+DEFAULT_BLOCKED_TYPES = ("image", "media", "font")
+DEFAULT_DENY_URLS = (
+    "google-analytics.com",
+    "googletagmanager.com",
+    "doubleclick.net",
+)
+# reCAPTCHA 必须正常加载，否则抓取到的凭证无效
+DEFAULT_ALLOW_URLS = ("recaptcha",)
+
+
+def parse_list(value: Optional[str], default: Iterable[str] = ()) -> tuple:
+    """解析逗号分隔的配置；未设置时使用默认值，设置为空字符串表示空列表"""
+    if value is None:
+        return tuple(default)
+    return tuple(item.strip() for item in value.split(",") if item.strip())
+
+
+def _compile_any(patterns: Iterable[str]) -> Optional[Pattern]:
+    patterns = [p for p in patterns if p]
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{p})" for p in patterns), re.IGNORECASE)
+
+
+class ResourcePolicy:
+    """
+    按资源类型和 URL 允许/拒绝列表拦截请求
+
+    资源类型拦截在 CDP 层完成（Fetch.enable 只暂停被拦截类型的请求），判断依据是浏览器报告的资源类型，
+    与 URL 是否带扩展名无关；其余请求（XHR、脚本等）不会进入 Python。URL 拒绝列表通过 Playwright 路由完成，
+    只有匹配的 URL 才会进入回调。允许列表优先于拒绝列表。URL 列表中的每一项都是正则表达式（普通域名 / 子串也可以直接使用）。
+    """
+
+    def __init__(self, blocked_types: Iterable[str] = DEFAULT_BLOCKED_TYPES,
+                 deny_urls: Iterable[str] = DEFAULT_DENY_URLS,
+                 allow_urls: Iterable[str] = DEFAULT_ALLOW_URLS):
+        self.blocked_types = frozenset(t.lower() for t in blocked_types)
+        self.deny_urls = tuple(deny_urls)
+        self.allow_urls = tuple(allow_urls)
+        self._deny = _compile_any(self.deny_urls)
+        self._allow = _compile_any(self.allow_urls)
+        # Playwright 路由只匹配拒绝列表；资源类型由 attach() 在 CDP 层拦截
+        self.route_pattern = self._deny
+        self.fetch_patterns: List[Dict[str, str]] = [
+            {"urlPattern": "*", "resourceType": CDP_RESOURCE_TYPES.get(t, t.capitalize()), "requestStage": "Request"}
+            for t in sorted(self.blocked_types)
+        ]
+        self.blocked: Dict[str, int] = {}
+        self.passed = 0
+        self._pending: Set["asyncio.Task"] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.route_pattern is not None or bool(self.fetch_patterns)
+
+    def should_block(self, resource_type: str, url: str) -> bool:
+        if self._allow is not None and self._allow.search(url):
+            return False
+        if resource_type in self.blocked_types:
+            return True
+        return self._deny is not None and self._deny.search(url) is not None
+
+    async def handle_route(self, route) -> None:
+        """Playwright 路由回调：拦截或交给下一个处理器"""
+        request = route.request
+        resource_type = request.resource_type
+        if self.should_block(resource_type, request.url):
+            self.blocked[resource_type] = self.blocked.get(resource_type, 0) + 1
+            await route.abort("blockedbyclient")
+        else:
+            self.passed += 1
+            await route.fallback()
+
+    async def attach(self, context, page) -> None:
+        """在标签页上启用 CDP 层的资源类型拦截（每个新建 / 回收后的标签页都要调用）"""
+        if not self.fetch_patterns:
+            return
+        session = await context.new_cdp_session(page)
+        session.on("Fetch.requestPaused", lambda event: self._spawn(self._on_paused(session, event)))
+        await session.send("Fetch.enable", {"patterns": self.fetch_patterns})
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.ensure_future(coro)
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _on_paused(self, session, event: Dict[str, Any]) -> None:
+        """CDP 回调：只会收到被拦截类型的请求，允许列表中的 URL 放行"""
+        request_id = event["requestId"]
+        url = event.get("request", {}).get("url", "")
+        resource_type = event.get("resourceType", "").lower()
+        try:
+            if self._allow is not None and self._allow.search(url):
+                self.passed += 1
+                await session.send("Fetch.continueRequest", {"requestId": request_id})
+            else:
+                self.blocked[resource_type] = self.blocked.get(resource_type, 0) + 1
+                await session.send("Fetch.failRequest", {"requestId": request_id, "errorReason": "BlockedByClient"})
+        except Exception:
+            pass  # 标签页已关闭 / 请求已取消
+
+    def to_stats(self) -> Dict[str, object]:
+        return {
+            "blocked_types": sorted(self.blocked_types),
+            "blocked": dict(self.blocked),
+            "blocked_total": sum(self.blocked.values()),
+            "passed": self.passed,
+        }
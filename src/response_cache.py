@@ -0,0 +1,226 @@
+"""
+响应缓存模块
+缓存确定性请求（temperature=0）的完整事件序列：内存 LRU（按条数和字节数限制）+ 可选磁盘层，
+命中时非流式直接聚合，流式按 SSE 重放
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import asdict
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from src.log import get_logger
+from src.stream_events import ChatDelta, Usage
+
+log = get_logger(__name__)
+
+CachedEvent = Union[ChatDelta, Usage]
+
+# 请求头：任一条件满足即跳过缓存（既不读也不写）
+BYPASS_HEADER = "x-cache-bypass"
+BYPASS_CACHE_CONTROL = ("no-cache", "no-store")
+
+
+def canonical_key(messages: List[Dict[str, Any]], route: Dict[str, Any], generation: Dict[str, Any]) -> str:
+    """消息、解析后的模型路由和生成参数的规范化哈希（键排序、紧凑分隔符）"""
+    payload = {
+        "messages": messages,
+        "route": route,
+        "generation": {k: v for k, v in generation.items() if v is not None},
+    }
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def is_bypass_requested(headers: Any) -> bool:
+    if str(headers.get(BYPASS_HEADER, "")).lower() in ("1", "true", "yes"):
+        return True
+    cache_control = str(headers.get("cache-control", "")).lower()
+    return any(directive in cache_control for directive in BYPASS_CACHE_CONTROL)
+
+
+def _encode(events: List[CachedEvent]) -> List[Dict[str, Any]]:
+    return [{"type": "usage" if isinstance(e, Usage) else "delta", **asdict(e)} for e in events]
+
+
+def _decode(items: List[Dict[str, Any]]) -> List[CachedEvent]:
+    events: List[CachedEvent] = []
+    for item in items:
+        item = dict(item)
+        kind = item.pop("type")
+        events.append(Usage(**item) if kind == "usage" else ChatDelta(**item))
+    return events
+
+
+def _size_of(events: List[CachedEvent]) -> int:
+    size = 64
+    for e in events:
+        if isinstance(e, ChatDelta):
+            size += 64 + len(e.content or "") + len(e.reasoning_content or "")
+        else:
+            size += 64
+    return size
+
+
+class ResponseCache:
+    """
+    确定性请求的响应缓存
+
+    只缓存以正常结束的完整响应（出错或被客户端中断的不缓存）。
+    """
+
+    def __init__(self, enabled: bool = False, max_entries: int = 1000, max_bytes: int = 64 * 1024 * 1024,
+                 ttl: float = 3600, disk_dir: Optional[str] = None, disk_max_entries: int = 10000):
+        """
+        Args:
+            max_entries / max_bytes: 内存层的条数和（近似）字节上限，超出时淘汰最久未使用的条目
+            ttl: 条目有效秒数（内存层和磁盘层相同）
+            disk_dir: 磁盘层目录，为空表示只使用内存
+        """
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir or None
+        self.disk_max_entries = disk_max_entries
+        self._entries: "OrderedDict[str, Tuple[float, int, List[CachedEvent]]]" = OrderedDict()
+        self._bytes = 0
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "evictions": 0, "invalidated": 0}
+        if self.enabled and self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @staticmethod
+    def cacheable(temperature: Any) -> bool:
+        """只有确定性请求（显式 temperature=0）才会被缓存"""
+        try:
+            return temperature is not None and float(temperature) == 0
+        except (TypeError, ValueError):
+            return False
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _remember(self, key: str, stored_at: float, events: List[CachedEvent]) -> None:
+        size = _size_of(events)
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old[1]
+        self._entries[key] = (stored_at, size, events)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.stats["evictions"] += 1
+
+    def _forget(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    async def get(self, key: str) -> Optional[List[CachedEvent]]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if now - entry[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[2]
+            self._forget(key)
+
+        if self.disk_dir:
+            record = await asyncio.to_thread(self._read_disk, key)
+            if record is not None and now - record["stored_at"] <= self.ttl:
+                events = _decode(record["events"])
+                self._remember(key, record["stored_at"], events)
+                self.stats["disk_hits"] += 1
+                return events
+
+        self.stats["misses"] += 1
+        return None
+
+    async def put(self, key: str, events: List[CachedEvent]) -> None:
+        stored_at = time.time()
+        events = list(events)
+        self._remember(key, stored_at, events)
+        self.stats["stores"] += 1
+        if self.disk_dir:
+            await asyncio.to_thread(self._write_disk, key, stored_at, events)
+
+    async def invalidate(self, key: str) -> None:
+        """删除一个条目（内存层和磁盘层）"""
+        self._forget(key)
+        self.stats["invalidated"] += 1
+        if self.disk_dir:
+            await asyncio.to_thread(self._remove_disk, key)
+
+    def _remove_disk(self, key: str) -> None:
+        try:
+            os.remove(self._disk_path(key))
+        except OSError:
+            pass
+
+    def _read_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning("⚠️ Discarding unreadable cache entry %s: %s", key[:12], e)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        if time.time() - record.get("stored_at", 0) > self.ttl:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return record
+
+    def _write_disk(self, key: str, stored_at: float, events: List[CachedEvent]) -> None:
+        path = self._disk_path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"stored_at": stored_at, "events": _encode(events)}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning("⚠️ Failed to write cache entry %s: %s", key[:12], e)
+            return
+        self._prune_disk()
+
+    def _prune_disk(self) -> None:
+        """磁盘层超过条数上限时删除最旧的文件"""
+        try:
+            entries = [e for e in os.scandir(self.disk_dir) if e.name.endswith(".json")]
+        except OSError:
+            return
+        excess = len(entries) - self.disk_max_entries
+        if excess <= 0:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for entry in entries[:excess]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def to_stats(self) -> Dict[str, Any]:
+        lookups = self.stats["hits"] + self.stats["disk_hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hit_rate": round((self.stats["hits"] + self.stats["disk_hits"]) / lookups, 3) if lookups else None,
+        }
@@ -0,0 +1,63 @@
+"""
+内部流事件模块
+上游响应先转换为类型化的事件，再分别由 SSE 编码器（流式）和聚合器（非流式）消费
+"""
+
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass(slots=True)
+class ChatDelta:
+    """一段增量输出（正文 / 思考内容 / 结束原因）"""
+    content: Optional[str] = None
+    reasoning_content: Optional[str] = None
+    finish_reason: Optional[str] = None
+
+    def to_openai(self) -> dict:
+        """转换为 OpenAI chunk 中的 delta 字段"""
+        delta = {}
+        if self.content is not None:
+            delta['content'] = self.content
+        if self.reasoning_content is not None:
+            delta['reasoning_content'] = self.reasoning_content
+        return delta
+
+
+@dataclass(slots=True)
+class Usage:
+    """一次成功请求的 token 用量（在流结束前产生一次）"""
+    prompt_tokens: int = 0
+    completion_tokens: int = 0     # 包含思考 token，与 OpenAI 口径一致
+    reasoning_tokens: int = 0
+    cached_tokens: int = 0
+    estimated: bool = False        # 上游未返回 usageMetadata，使用本地估算
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def to_openai(self) -> dict:
+        """转换为 OpenAI 响应中的 usage 字段"""
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+            "prompt_tokens_details": {"cached_tokens": self.cached_tokens},
+            "completion_tokens_details": {"reasoning_tokens": self.reasoning_tokens},
+        }
+
+
+@dataclass(slots=True)
+class StreamError:
+    """不可恢复的错误，流在此结束"""
+    message: str
+    type: str = "upstream_error"
+
+
+class UpstreamStreamError(Exception):
+    """非流式请求遇到 StreamError 时抛出"""
+
+    def __init__(self, error: StreamError):
+        super().__init__(error.message)
+        self.error = error
@@ -0,0 +1,191 @@
+"""
+流式 JSON 数组解析模块
+将 Google 返回的 `[obj, obj, ...]` 流按顶层元素增量切分，每个元素只解码一次
+"""
+
+import json
+import re
+from typing import Any, List
+
+from src.log import get_logger
+
+log = get_logger(__name__)
+
+
+class JSONArrayStreamParser:
+    """
+    增量式 JSON 数组元素切分器
+
+    基于字节的状态机：跟踪嵌套深度、字符串与转义状态，使用偏移量记录扫描位置，
+    不会反复切片或从头重新解码缓冲区。字符串内部（例如大段 base64 图片数据）
+    通过正则一次跳到下一个引号/反斜杠，整体开销与数据量呈线性关系。
+    """
+
+    # 字符串外需要关注的结构字符
+    _STRUCTURAL = re.compile(rb'[\[\]{}"]')
+    # 字符串内需要关注的字符
+    _STRING_SPECIAL = re.compile(rb'["\\]')
+    # 外层数组中两个元素之间：下一个元素的起始字符
+    _ELEMENT_START = re.compile(rb'[^\s,]')
+    # 顶层标量元素（数字 / true / false / null）的结束位置
+    _SCALAR_END = re.compile(rb'[\s,\]}]')
+
+    # 已消费数据超过该阈值时压缩缓冲区
+    COMPACT_THRESHOLD = 64 * 1024
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._pos = 0              # 下一个待扫描的字节
+        self._depth = 0            # 当前嵌套深度（包含外层数组）
+        self._outer_opened = False # 是否已进入外层数组
+        self._in_string = False
+        self._escape = False
+        self._in_scalar = False
+        self._element_start = -1   # 当前顶层元素起始偏移，-1 表示不在元素内
+        self._element_depth = 0    # 顶层元素所在深度
+        self.elements_decoded = 0
+        self.decode_errors = 0
+        self.scalar_elements = 0
+
+    def feed(self, data: bytes) -> List[Any]:
+        """
+        追加一段数据，返回本次新完成的所有顶层元素
+
+        Args:
+            data: 上游返回的原始字节块
+        """
+        if not data:
+            return []
+        self._buffer += data
+        results: List[Any] = []
+        self._scan(results)
+        self._compact()
+        return results
+
+    def _scan(self, results: List[Any]) -> None:
+        buf = self._buffer
+        end = len(buf)
+        pos = self._pos
+
+        while pos < end:
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                    pos += 1
+                    continue
+                m = self._STRING_SPECIAL.search(buf, pos)
+                if m is None:
+                    pos = end
+                    break
+                pos = m.start()
+                if buf[pos] == 0x5C:  # '\\'
+                    self._escape = True
+                    pos += 1
+                    continue
+                # 字符串结束
+                self._in_string = False
+                pos += 1
+                if self._element_start != -1 and self._depth == self._element_depth:
+                    # 顶层元素本身就是字符串
+                    self._emit(results, pos)
+                continue
+
+            if self._in_scalar:
+                m = self._SCALAR_END.search(buf, pos)
+                if m is None:
+                    pos = end
+                    break
+                pos = m.start()
+                self._in_scalar = False
+                self._emit_scalar(results, pos)
+                continue
+
+            if self._element_start == -1 and self._depth == 1:
+                # 外层数组中元素之间：数字 / true / false / null 没有结构字符，需要单独识别
+                m = self._ELEMENT_START.search(buf, pos)
+                if m is None:
+                    pos = end
+                    break
+                pos = m.start()
+                if buf[pos] not in b'[]{}"':
+                    self._element_start = pos
+                    self._element_depth = 1
+                    self._in_scalar = True
+                    continue
+
+            m = self._STRUCTURAL.search(buf, pos)
+            if m is None:
+                pos = end
+                break
+            pos = m.start()
+            ch = buf[pos]
+
+            if ch == 0x22:  # '"'
+                if self._element_start == -1:
+                    self._element_start = pos
+                    self._element_depth = self._depth
+                self._in_string = True
+                pos += 1
+            elif ch == 0x7B or ch == 0x5B:  # '{' '['
+                if ch == 0x5B and self._depth == 0 and not self._outer_opened:
+                    # 外层数组的起始括号
+                    self._outer_opened = True
+                    self._depth = 1
+                    pos += 1
+                    continue
+                if self._element_start == -1:
+                    self._element_start = pos
+                    self._element_depth = self._depth
+                self._depth += 1
+                pos += 1
+            else:  # '}' ']'
+                if self._depth == 0:
+                    # 多余的闭合括号，忽略
+                    pos += 1
+                    continue
+                self._depth -= 1
+                pos += 1
+                if self._element_start != -1 and self._depth == self._element_depth:
+                    self._emit(results, pos)
+                elif self._depth == 0 and self._outer_opened:
+                    # 外层数组结束，允许后续出现新的数组
+                    self._outer_opened = False
+
+        self._pos = pos
+
+    def _emit(self, results: List[Any], end: int) -> None:
+        raw = bytes(self._buffer[self._element_start:end])
+        self._element_start = -1
+        try:
+            results.append(json.loads(raw))
+            self.elements_decoded += 1
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            self.decode_errors += 1
+            log.warning("⚠️ Skipping malformed stream element (%s bytes): %s", len(raw), e)
+
+    def _emit_scalar(self, results: List[Any], end: int) -> None:
+        """顶层标量：上游协议中不应出现，解码后照常返回，但记录下来以便发现协议变化"""
+        raw = bytes(self._buffer[self._element_start:end])
+        decoded = len(results)
+        self._emit(results, end)
+        if len(results) > decoded:
+            self.scalar_elements += 1
+            log.warning("⚠️ Unexpected scalar stream element: %.40s", raw.decode("utf-8", "replace"))
+
+    def _compact(self) -> None:
+        # 只保留尚未完成的元素，摊还 O(n)
+        keep_from = self._element_start if self._element_start != -1 else self._pos
+        if keep_from < self.COMPACT_THRESHOLD and keep_from * 2 < len(self._buffer):
+            return
+        if keep_from == 0:
+            return
+        del self._buffer[:keep_from]
+        self._pos -= keep_from
+        if self._element_start != -1:
+            self._element_start -= keep_from
+
+    @property
+    def pending_bytes(self) -> int:
+        """尚未组成完整元素的字节数"""
+        start = self._element_start if self._element_start != -1 else self._pos
+        return len(self._buffer) - start
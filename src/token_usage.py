@@ -0,0 +1,89 @@
+"""
+Token 用量模块
+优先使用上游 usageMetadata 的真实计数；上游未返回时用本地估算补齐
+"""
+
+from typing import Any, Dict, List, Optional
+
+from src.stream_events import Usage
+
+
+# 一张图片大致占用的 token 数（Gemini 对输入 / 输出图片按固定值计费）
+IMAGE_INPUT_TOKENS = 258
+IMAGE_OUTPUT_TOKENS = 1290
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算文本 token 数
+
+    ASCII 约 4 个字符 1 个 token，CJK 等宽字符约 1 个字符 1 个 token。
+    """
+    if not text:
+        return 0
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    other_chars = len(text) - ascii_chars
+    return (ascii_chars + 3) // 4 + other_chars
+
+
+def estimate_prompt_tokens(contents: List[Dict[str, Any]], system_instruction: Optional[str]) -> int:
+    """估算已转换为 Gemini 格式的输入 token 数"""
+    total = estimate_tokens(system_instruction or "")
+    for content in contents:
+        for part in content.get('parts') or ():
+            if 'text' in part:
+                total += estimate_tokens(part['text'] or "")
+            elif 'inlineData' in part or 'fileData' in part:
+                total += IMAGE_INPUT_TOKENS
+    return total
+
+
+class UsageTracker:
+    """跟踪单次上游请求的用量：记录最后一次 usageMetadata，同时累计本地估算"""
+
+    __slots__ = ('metadata', 'estimated_content', 'estimated_reasoning')
+
+    def __init__(self):
+        self.metadata: Optional[Dict[str, Any]] = None
+        self.estimated_content = 0
+        self.estimated_reasoning = 0
+
+    def observe_metadata(self, metadata: Dict[str, Any]) -> None:
+        """usageMetadata 是累计值，保留最新一份即可"""
+        if metadata:
+            self.metadata = metadata
+
+    def add_text(self, text: str, thought: bool = False) -> None:
+        if thought:
+            self.estimated_reasoning += estimate_tokens(text)
+        else:
+            self.estimated_content += estimate_tokens(text)
+
+    def add_image(self) -> None:
+        self.estimated_content += IMAGE_OUTPUT_TOKENS
+
+    def result(self, contents: List[Dict[str, Any]], system_instruction: Optional[str]) -> Usage:
+        """生成最终用量；缺失的字段用本地估算补齐"""
+        meta = self.metadata or {}
+        estimated = False
+
+        prompt_tokens = meta.get('promptTokenCount')
+        if prompt_tokens is None:
+            prompt_tokens = estimate_prompt_tokens(contents, system_instruction)
+            estimated = True
+
+        candidates_tokens = meta.get('candidatesTokenCount')
+        reasoning_tokens = meta.get('thoughtsTokenCount')
+        if candidates_tokens is None:
+            candidates_tokens = self.estimated_content
+            if reasoning_tokens is None:
+                reasoning_tokens = self.estimated_reasoning
+            estimated = True
+
+        return Usage(
+            prompt_tokens=int(prompt_tokens),
+            completion_tokens=int(candidates_tokens) + int(reasoning_tokens or 0),
+            reasoning_tokens=int(reasoning_tokens or 0),
+            cached_tokens=int(meta.get('cachedContentTokenCount') or 0),
+            estimated=estimated,
+        )
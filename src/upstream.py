@@ -0,0 +1,231 @@
+"""
+上游模块
+- UpstreamPool: 到 Vertex AI 的连接池（可选 HTTP/2、分项超时、凭证更新后和空闲时预热连接）
+- UpstreamStream: 把一次已发出的流式请求封装为可以“先读到第一个元素再交给调用方”的对象，
+  用于对冲请求之间比较首包时间
+"""
+
+import asyncio
+import contextlib
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from src.log import get_logger
+from src.stream_parser import JSONArrayStreamParser
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持（pip install httpx[http2]）
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+log = get_logger(__name__)
+
+
+def origin_of(url: str) -> Optional[str]:
+    parts = urlsplit(url)
+    if not parts.scheme or not parts.netloc:
+        return None
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class UpstreamPool:
+    """
+    上游 HTTP 客户端
+
+    HTTP/2 下所有并发请求复用同一个 TLS 连接；凭证更新（目标主机可能变化）后和连接空闲时
+    主动发送一个轻量请求预热，让空闲后的第一个请求不必再付 TLS 握手的延迟。
+    """
+
+    def __init__(self, http2: bool = True, max_connections: int = 100, max_keepalive: int = 20,
+                 keepalive_expiry: float = 120.0, connect_timeout: float = 10.0, read_timeout: float = 120.0,
+                 write_timeout: float = 30.0, pool_timeout: float = 10.0, warm_connections: int = 2):
+        """
+        Args:
+            http2: 是否启用 HTTP/2（未安装 h2 时自动退回 HTTP/1.1）
+            read_timeout: 两个数据块之间的最长间隔（不是整个流的总时长）
+            pool_timeout: 连接池占满时等待空闲连接的秒数
+            warm_connections: HTTP/1.1 下每个主机预热的连接数（HTTP/2 只需一个）
+        """
+        if http2 and not HTTP2_AVAILABLE:
+            log.warning("⚠️ HTTP/2 requested but the 'h2' package is not installed, falling back to HTTP/1.1")
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.connect_timeout = connect_timeout
+        self.warm_connections = 1 if self.http2 else max(1, min(warm_connections, max_keepalive))
+        self.client = httpx.AsyncClient(
+            http2=self.http2,
+            timeout=httpx.Timeout(connect=connect_timeout, read=read_timeout,
+                                  write=write_timeout, pool=pool_timeout),
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_keepalive,
+                                keepalive_expiry=keepalive_expiry),
+        )
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._last_used: Dict[str, float] = {}  # origin -> monotonic
+        self.stats = {"requests": 0, "warmups": 0, "warmup_failures": 0}
+
+    @contextlib.asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs):
+        """与 httpx.AsyncClient.stream 相同，另外统计并发数并记录主机最近使用时间"""
+        origin = origin_of(url)
+        self.stats["requests"] += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            async with self.client.stream(method, url, **kwargs) as response:
+                yield response
+        finally:
+            self.in_flight -= 1
+            if origin:
+                self._last_used[origin] = time.monotonic()
+
+    @property
+    def open_connections(self) -> Optional[int]:
+        """当前打开的连接数（依赖 httpcore 内部结构，取不到时返回 None）"""
+        pool = getattr(getattr(self.client, "_transport", None), "_pool", None)
+        connections = getattr(pool, "connections", None)
+        return len(connections) if connections is not None else None
+
+    async def _warm_one(self, origin: str) -> bool:
+        try:
+            # 响应内容无关紧要，只为建立（或保持）TLS 连接
+            response = await self.client.head(origin + "/", timeout=self.connect_timeout + 5)
+            await response.aclose()
+            return True
+        except Exception as e:
+            log.warning("⚠️ Upstream warm-up to %s failed: %s", origin, e)
+            return False
+
+    async def warm(self, urls: Iterable[str]) -> None:
+        """为每个目标主机预热连接"""
+        origins = {o for o in (origin_of(u) for u in urls) if o}
+        if not origins:
+            return
+        attempts = [self._warm_one(o) for o in origins for _ in range(self.warm_connections)]
+        results = await asyncio.gather(*attempts)
+        self.stats["warmups"] += sum(1 for ok in results if ok)
+        self.stats["warmup_failures"] += sum(1 for ok in results if not ok)
+        now = time.monotonic()
+        for origin in origins:
+            self._last_used.setdefault(origin, now)
+
+    async def run_warmer(self, signal: Any, urls: Callable[[], Iterable[str]], idle_interval: float) -> None:
+        """
+        后台预热任务
+
+        Args:
+            signal: 凭证代数信号（GenerationSignal），凭证更新时立即预热新目标主机
+            urls: 返回当前所有凭证目标 URL
+            idle_interval: 主机空闲超过该秒数时重新预热，避免连接因空闲被关闭（<= 0 表示只在凭证更新时预热）
+        """
+        generation = signal.generation
+        await self.warm(urls())
+        while True:
+            timeout = idle_interval if idle_interval > 0 else 3600
+            changed = await signal.wait_past(generation, timeout)
+            generation = signal.generation
+            if changed:
+                await self.warm(urls())
+            elif idle_interval > 0:
+                now = time.monotonic()
+                current = {origin_of(u) for u in urls()}
+                idle = [o for o, used in self._last_used.items()
+                        if o in current and now - used >= idle_interval and self.in_flight == 0]
+                if idle:
+                    await self.warm(idle)
+
+    def to_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "http2": self.http2,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "max_connections": self.max_connections,
+            "saturation": round(self.in_flight / self.max_connections, 3) if self.max_connections else None,
+            "open_connections": self.open_connections,
+        }
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+class UpstreamStream:
+    """
+    一个已打开的上游响应
+
+    用作异步上下文管理器：进入时返回 httpx 响应，退出时关闭连接。
+    """
+
+    def __init__(self, slot: Any, stream_cm: Any):
+        self.slot = slot
+        self._cm = stream_cm
+        self.response = None
+        self.parser = JSONArrayStreamParser()
+        self._chunks: Optional[AsyncIterator[bytes]] = None
+        self._buffered: List[Any] = []
+        self._closed = False
+        self.started = time.monotonic()
+        self.connect_time: Optional[float] = None  # 发出请求到收到响应头的秒数
+        self.first_byte: Optional[float] = None    # 发出请求到收到第一个数据块的秒数
+        self.ttfb: Optional[float] = None          # 发出请求到解析出第一个元素的秒数
+
+    async def open(self) -> "UpstreamStream":
+        """发出请求并等待响应头"""
+        self.response = await self._cm.__aenter__()
+        self.connect_time = time.monotonic() - self.started
+        return self
+
+    @property
+    def ok(self) -> bool:
+        return self.response is not None and self.response.status_code == 200
+
+    async def read_first(self) -> bool:
+        """读取直到解析出第一个完整元素（或流结束），返回是否读到了内容"""
+        if self._buffered:
+            return True
+        if self._chunks is None:
+            self._chunks = self.response.aiter_bytes()
+        async for chunk in self._chunks:
+            if self.first_byte is None:
+                self.first_byte = time.monotonic() - self.started
+            objects = self.parser.feed(chunk)
+            if objects:
+                self.ttfb = time.monotonic() - self.started
+                self._buffered.extend(objects)
+                return True
+        return False
+
+    async def objects(self) -> AsyncIterator[Any]:
+        """依次产出所有解析出的元素（包括竞速阶段已经读到的）"""
+        buffered, self._buffered = self._buffered, []
+        for obj in buffered:
+            yield obj
+        if self._chunks is None:
+            self._chunks = self.response.aiter_bytes()
+        async for chunk in self._chunks:
+            if self.first_byte is None:
+                self.first_byte = time.monotonic() - self.started
+            for obj in self.parser.feed(chunk):
+                if self.ttfb is None:
+                    self.ttfb = time.monotonic() - self.started
+                yield obj
+
+    async def aclose(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self.response is not None:
+            await self._cm.__aexit__(None, None, None)
+
+    async def __aenter__(self):
+        return self.response
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+        return False
@@ -1,16 +1,179 @@
 import json
+import os
+import atexit
 import asyncio
 from datetime import datetime, timezone, timedelta
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Set
 from collections import defaultdict
 
-class DailyStatsManager:
+from src.log import get_logger
+
+log = get_logger(__name__)
+
+
+def atomic_write_json(filepath: str, data: Any, **dump_kwargs) -> None:
+    """先写临时文件再 rename，避免写到一半时进程退出导致文件损坏"""
+    tmp_path = f"{filepath}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, **dump_kwargs)
+    os.replace(tmp_path, filepath)
+
+
+def _copy_nested(value: Any) -> Any:
+    """复制嵌套的 dict，作为落盘快照（避免后台线程序列化时数据被修改）"""
+    if isinstance(value, dict):
+        return {k: _copy_nested(v) for k, v in value.items()}
+    return value
+
+
+class BatchedJSONStore:
+    """
+    内存计数 + 批量落盘
+
+    更新只修改内存并标记脏数据；每隔 flush_interval 秒或累计 flush_every 次更新后，
+    在线程池中原子地写入文件。退出时会做最后一次同步落盘。
+    mark_dirty(key) 只标记一个顶层键，落盘时只重新复制变化过的键（其余沿用上次的快照）。
+    persist=False 时只读取文件、不写入（多 worker 模式下文件由 hub 进程负责）。
+    """
+
+    def __init__(self, filepath: str, flush_interval: float = 5.0, flush_every: int = 50,
+                 persist: bool = True, **dump_kwargs):
+        self.filepath = filepath
+        self.persist = persist
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self.dump_kwargs = dump_kwargs
+        self.stats: Dict[str, Any] = {}
+        self._dirty = 0
+        self._changed: Optional[Set[str]] = None  # 自上次落盘以来变化的顶层键；None 表示全部
+        self._snapshot: Dict[str, Any] = {}
+        self._flush_lock = None
+        self._flush_task = None
+        atexit.register(self.flush_sync)
+
+    def mark_dirty(self, key: Optional[str] = None) -> None:
+        """记录一次更新（key 为变化的顶层键，不指定表示全部），必要时安排后台落盘（O(1)，不做 I/O）"""
+        if not self.persist:
+            return
+        self._dirty += 1
+        if key is None:
+            self._changed = None
+        elif self._changed is not None:
+            self._changed.add(key)
+        if self._dirty >= self.flush_every and (self._flush_task is None or self._flush_task.done()):
+            try:
+                self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+            except RuntimeError:
+                # 不在事件循环中（例如 GUI 线程），等待定时落盘
+                pass
+
+    async def flush(self) -> None:
+        """在线程池中落盘当前快照"""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            snapshot = self._take_snapshot()
+            self._dirty = 0
+            try:
+                await asyncio.to_thread(atomic_write_json, self.filepath, snapshot, **self.dump_kwargs)
+            except Exception as e:
+                self.mark_dirty()  # 下次重试（完整复制）
+                log.warning("⚠️ Error saving %s: %s", self.filepath, e)
+
+    def _take_snapshot(self) -> Dict[str, Any]:
+        """更新落盘快照：只复制变化过的顶层键（快照只在 flush 持锁期间使用，不会被并发修改）"""
+        if self._changed is None:
+            self._snapshot = _copy_nested(self.stats)
+        else:
+            for key in self._changed:
+                if key in self.stats:
+                    self._snapshot[key] = _copy_nested(self.stats[key])
+                else:
+                    self._snapshot.pop(key, None)
+        self._changed = set()
+        return self._snapshot
+
+    def flush_sync(self) -> None:
+        """同步落盘（启动初始化 / 退出时使用）"""
+        if not self._dirty:
+            return
+        try:
+            atomic_write_json(self.filepath, _copy_nested(self.stats), **self.dump_kwargs)
+            self._dirty = 0
+        except Exception as e:
+            log.warning("⚠️ Error saving %s: %s", self.filepath, e)
+
+    def save_stats(self) -> None:
+        """立即同步保存（兼容旧接口）"""
+        if not self.persist:
+            return
+        self._dirty += 1
+        self.flush_sync()
+
+    async def run_flusher(self) -> None:
+        """后台定时落盘任务"""
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        finally:
+            # 任务被取消（服务关闭）时做最后一次落盘
+            self.flush_sync()
+
+
+class TokenStatsManager(BatchedJSONStore):
+    """累计 Token 统计（GUI 侧边栏使用）"""
+
+    def __init__(self, filepath="stats.json", persist: bool = True):
+        super().__init__(filepath, persist=persist, indent=2)
+        self.stats = {"total_requests": 0, "total_tokens": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self.load_stats()
+
+    def load_stats(self):
+        try:
+            with open(self.filepath, 'r', encoding='utf-8') as f:
+                self.stats = json.load(f)
+        except FileNotFoundError:
+            self.save_stats()
+        except Exception as e:
+            log.warning("⚠️ Error loading stats: %s", e)
+
+    async def update(self, prompt_tokens, completion_tokens):
+        self.stats["total_requests"] += 1
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["completion_tokens"] += completion_tokens
+        self.stats["total_tokens"] += (prompt_tokens + completion_tokens)
+        self.mark_dirty()
+
+
+class RateLimitStore(BatchedJSONStore):
+    """自适应限速学到的速率（{"模型|槽位": {"rpm": ..., "updated": ...}}），重启后继续使用"""
+
+    def __init__(self, filepath="rate_limits.json"):
+        super().__init__(filepath, indent=2)
+        self.stats = {}
+        self.load_stats()
+
+    def load_stats(self):
+        try:
+            with open(self.filepath, 'r', encoding='utf-8') as f:
+                self.stats = json.load(f)
+        except FileNotFoundError:
+            self.stats = {}
+        except Exception as e:
+            log.warning("⚠️ Error loading rate limits: %s", e)
+            self.stats = {}
+
+
+class DailyStatsManager(BatchedJSONStore):
     """管理按天、按模型的统计数据"""
     
-    def __init__(self, filepath="daily_stats.json"):
-        self.filepath = filepath
+    def __init__(self, filepath="daily_stats.json", persist: bool = True):
+        # 历史数据会持续增长，使用紧凑格式落盘
+        super().__init__(filepath, persist=persist, ensure_ascii=False, separators=(',', ':'))
         self.stats = {}  # {date: {model: {requests: 0, tokens: 0}}}
-        self.lock = asyncio.Lock()
         self.load_stats()
     
     def get_beijing_date(self) -> str:
@@ -24,47 +187,54 @@ class DailyStatsManager:
         try:
             with open(self.filepath, 'r', encoding='utf-8') as f:
                 self.stats = json.load(f)
-            print(f"📊 Loaded daily stats from {self.filepath}")
+            log.info("📊 Loaded daily stats from %s", self.filepath)
         except FileNotFoundError:
             self.stats = {}
             self.save_stats()
         except Exception as e:
-            print(f"⚠️ Error loading daily stats: {e}")
+            log.warning("⚠️ Error loading daily stats: %s", e)
             self.stats = {}
     
-    def save_stats(self):
-        """保存统计数据到文件"""
-        try:
-            with open(self.filepath, 'w', encoding='utf-8') as f:
-                json.dump(self.stats, f, indent=2, ensure_ascii=False)
-        except Exception as e:
-            print(f"⚠️ Error saving daily stats: {e}")
-    
     async def record_request(self, model: str, prompt_tokens: int = 0, completion_tokens: int = 0):
-        """记录一次请求"""
-        async with self.lock:
-            date = self.get_beijing_date()
-            
-            # 初始化日期
-            if date not in self.stats:
-                self.stats[date] = {}
-            
-            # 初始化模型
-            if model not in self.stats[date]:
-                self.stats[date][model] = {
-                    "requests": 0,
-                    "prompt_tokens": 0,
-                    "completion_tokens": 0,
-                    "total_tokens": 0
-                }
-            
-            # 更新统计
-            self.stats[date][model]["requests"] += 1
-            self.stats[date][model]["prompt_tokens"] += prompt_tokens
-            self.stats[date][model]["completion_tokens"] += completion_tokens
-            self.stats[date][model]["total_tokens"] += (prompt_tokens + completion_tokens)
-            
-            self.save_stats()
+        """记录一次请求（只更新内存，落盘由后台批量完成）"""
+        date = self.get_beijing_date()
+        
+        # 初始化日期
+        if date not in self.stats:
+            self.stats[date] = {}
+        
+        # 初始化模型
+        if model not in self.stats[date]:
+            self.stats[date][model] = {
+                "requests": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_tokens": 0
+            }
+        
+        # 更新统计
+        model_stats = self.stats[date][model]
+        model_stats["requests"] += 1
+        model_stats["prompt_tokens"] += prompt_tokens
+        model_stats["completion_tokens"] += completion_tokens
+        model_stats["total_tokens"] += (prompt_tokens + completion_tokens)
+        
+        self.mark_dirty(date)
+    
+    async def record_tokens(self, model: str, prompt_tokens: int, completion_tokens: int):
+        """累加一次已完成请求的 token 用量（请求数已在 record_request 中记录）"""
+        date = self.get_beijing_date()
+        model_stats = self.stats.setdefault(date, {}).setdefault(model, {
+            "requests": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0
+        })
+        model_stats["prompt_tokens"] += prompt_tokens
+        model_stats["completion_tokens"] += completion_tokens
+        model_stats["total_tokens"] += (prompt_tokens + completion_tokens)
+        
+        self.mark_dirty(date)
     
     def get_today_stats(self) -> Dict[str, Any]:
         """获取今天的统计数据"""
@@ -101,7 +271,7 @@ class DailyStatsManager:
         
         for date in dates_to_remove:
             del self.stats[date]
+            self.mark_dirty(date)
         
         if dates_to_remove:
-            print(f"🧹 Cleaned up {len(dates_to_remove)} days of old data")
-            self.save_stats()
\ No newline at end of file
+            log.info("🧹 Cleaned up %s days of old data", len(dates_to_remove))
\ No newline at end of file